@@ -36,12 +36,16 @@ def main(args):
         cookie_data = environ['HTTP_COOKIE']
     except KeyError:
         cookie_data = None
+    try:
+        if_none_match = environ['HTTP_IF_NONE_MATCH']
+    except KeyError:
+        if_none_match = None
 
     params = FieldStorage()
 
     # Call main server
     cookie_hdrs, response_data = serve(params, remote_addr, remote_host,
-            cookie_data)
+            cookie_data, if_none_match)
 
     # Package and send response
     if cookie_hdrs is not None:
@@ -56,8 +60,13 @@ def main(args):
     # Hack to support binary data and general Unicode for SVGs and JSON
     if isinstance(response_data[1], unicode):
         stdout.write(response_data[1].encode('utf-8'))
-    else:
+    elif isinstance(response_data[1], str):
         stdout.write(response_data[1])
+    else:
+        # Streamed, written as it is serialised
+        for chunk in response_data[1]:
+            stdout.write(chunk)
+            stdout.flush()
     return 0
 
 def profile_main(argv):
@@ -1315,7 +1315,7 @@ var AnnotatorUI = (function($, window, undefined) {
 
         arcOptions.type = type;
         arcOptions.comment = $('#arc_notes').val();
-        dispatcher.post('ajax', [arcOptions, 'edited']);
+        postEdit(arcOptions);
         return false;
       };
 
@@ -1522,7 +1522,7 @@ var AnnotatorUI = (function($, window, undefined) {
         arcOptions.action = 'reverseArc';
         delete arcOptions.old_target;
         delete arcOptions.old_type;
-        dispatcher.post('ajax', [arcOptions, 'edited']);
+        postEdit(arcOptions);
       };
 
       var deleteArc = function(evt) {
@@ -1532,7 +1532,7 @@ var AnnotatorUI = (function($, window, undefined) {
         var eventDataId = $(evt.target).attr('data-arc-ed');
         dispatcher.post('hideForm');
         arcOptions.action = 'deleteArc';
-        dispatcher.post('ajax', [arcOptions, 'edited']);
+        postEdit(arcOptions);
       };
 
       var reselectArc = function(evt) {
@@ -1798,7 +1798,7 @@ var AnnotatorUI = (function($, window, undefined) {
             var targetSpan = data.spans[id];
             if (arcOptions && arcOptions.old_target) {
               arcOptions.target = targetSpan.id;
-              dispatcher.post('ajax', [arcOptions, 'edited']);
+              postEdit(arcOptions);
             } else {
               arcOptions = {
                 action: 'createArc',
@@ -2099,7 +2099,7 @@ var AnnotatorUI = (function($, window, undefined) {
           'document': doc,
           tagger: taggerId,
         };
-        dispatcher.post('ajax', [tagOptions, 'edited']);
+        postEdit(tagOptions);
       }
 
       var setupTaggerUI = function(response) {
@@ -2302,6 +2302,43 @@ var AnnotatorUI = (function($, window, undefined) {
         args = _args;
       };
 
+      // Posts an editing action, asking the server to respond with only
+      // the changes to the annotations (see applyDelta)
+      var postEdit = function(options) {
+        options.delta = true;
+        dispatcher.post('ajax', [options, 'edited']);
+      };
+
+      // The categories of the source data that edits change records of,
+      // see DELTA_CATEGORIES in the server
+      var deltaCategories = ['entities', 'triggers', 'events', 'relations',
+          'attributes', 'normalizations', 'comments'];
+
+      // Returns the source data that results from applying the changes
+      // in the response to an edit to the current source data: all
+      // records keyed (by their first field) by a removed id are
+      // replaced by the records sent for them
+      var applyDelta = function(delta) {
+        var removed = {};
+        $.each(delta.removed, function(idNo, id) {
+          removed[id] = true;
+        });
+        var newSourceData = $.extend({}, sourceData);
+        $.each(deltaCategories, function(categoryNo, category) {
+          var records = $.grep(sourceData[category] || [], function(record) {
+            return !removed[record[0]];
+          });
+          newSourceData[category] = records.concat(delta[category] || []);
+        });
+        newSourceData.equivs = delta.equivs;
+        if (delta.sentence_offsets) {
+          newSourceData.sentence_offsets = delta.sentence_offsets;
+        }
+        newSourceData.mtime = delta.mtime;
+        newSourceData.ctime = delta.ctime;
+        return newSourceData;
+      };
+
       var undoStack = [];
       var edited = function(response) {
         var x = response.exception;
@@ -2327,7 +2364,13 @@ var AnnotatorUI = (function($, window, undefined) {
           } else {
             args.edited = response.edited;
           }
-          var sourceData = response.annotations;
+          var sourceData;
+          if (response.delta) {
+            sourceData = applyDelta(response.delta);
+            sourceData.document_version = response.document_version;
+          } else {
+            sourceData = response.annotations;
+          }
           sourceData.document = doc;
           sourceData.collection = coll;
           // this "prevent" is to protect against reloading (from the
@@ -2357,7 +2400,7 @@ var AnnotatorUI = (function($, window, undefined) {
           'document': doc,
         });
         spanOptions.offsets = JSON.stringify(spanOptions.offsets);
-        dispatcher.post('ajax', [spanOptions, 'edited']);
+        postEdit(spanOptions);
         dispatcher.post('hideForm');
         $('#waiter').dialog('open');
       };
@@ -2384,7 +2427,7 @@ var AnnotatorUI = (function($, window, undefined) {
           });
         spanOptions.offsets = JSON.stringify(spanOptions.offsets);
         dispatcher.post('hideForm');
-        dispatcher.post('ajax', [spanOptions, 'edited']);
+        postEdit(spanOptions);
         return false;
       });
       dispatcher.post('initForm', [splitForm, {
@@ -2446,7 +2489,7 @@ var AnnotatorUI = (function($, window, undefined) {
 
         spanOptions.normalizations = $.toJSON(spanNormalizations());
 
-        dispatcher.post('ajax', [spanOptions, 'edited']);
+        postEdit(spanOptions);
         dispatcher.post('hideForm');
         $('#waiter').dialog('open');
       };
@@ -2578,7 +2621,7 @@ var AnnotatorUI = (function($, window, undefined) {
         spanForm.parent().find('*').blur();
 
         $('#waiter').dialog('open');
-        dispatcher.post('ajax', [spanOptions, 'edited']);
+        postEdit(spanOptions);
         return false;
       };
       $('#span_notes').focus(function () {
@@ -2619,7 +2662,7 @@ var AnnotatorUI = (function($, window, undefined) {
           });
           $('#waiter').dialog('open');
           rapidSpanOptions.offsets = JSON.stringify(rapidSpanOptions.offsets);
-          dispatcher.post('ajax', [rapidSpanOptions, 'edited']);
+          postEdit(rapidSpanOptions);
         }
         return false;
       };
@@ -3033,6 +3033,10 @@ Util.profileReport();
       };
       var renderData = function(sourceData) {
         Util.profileEnd('invoke getDocument');
+        if (sourceData && sourceData.unchanged) {
+          // the document has not changed since it was last received
+          sourceData = currentSourceData();
+        }
         if (sourceData && sourceData.exception) {
           if (renderErrors[sourceData.exception]) {
             dispatcher.post('renderError:' + sourceData.exception, [sourceData]);
@@ -3062,13 +3066,23 @@ Util.profileReport();
         }
       };
 
+      var currentSourceData = function() {
+        return sourceData;
+      };
+
       var renderDocument = function() {
         Util.profileStart('invoke getDocument');
-        dispatcher.post('ajax', [{
+        var request = {
             action: 'getDocument',
             collection: coll,
             'document': doc,
-          }, 'renderData', {
+          };
+        // only have the server send the document if it has changed
+        if (sourceData && sourceData.document_version &&
+            sourceData.collection === coll && sourceData.document === doc) {
+          request.if_version = sourceData.document_version;
+        }
+        dispatcher.post('ajax', [request, 'renderData', {
             collection: coll,
             'document': doc
           }]);
@@ -82,6 +82,71 @@ MAX_SEARCH_RESULT_NUMBER = 1000
 
 DEBUG = False
 
+### VERIFY_ANNOTATION_WRITES
+# Set to True to parse modified annotation files back in before they
+# replace the original files, at the cost of slower saves
+
+VERIFY_ANNOTATION_WRITES = False
+
+### ANNOTATION_JOURNAL
+# Set to True to append edits to a journal next to each annotation file
+# (DOCUMENT.ann.journal) instead of rewriting the whole file on every
+# edit, which speeds up editing of large documents. The journal is folded
+# back into the annotation file when it grows larger than
+# ANNOTATION_JOURNAL_MAX_SIZE bytes or older than ANNOTATION_JOURNAL_MAX_AGE
+# seconds. Note that tools reading .ann files directly do not see the
+# edits that are still in a journal.
+
+ANNOTATION_JOURNAL = False
+ANNOTATION_JOURNAL_MAX_SIZE = 64 * 1024
+ANNOTATION_JOURNAL_MAX_AGE = 60 * 60
+
+### REUSE_ANNOTATION_IDS
+# New annotations get the lowest free id, which may be the id of a
+# deleted annotation. Set to False to always give them ids above the
+# highest one in use instead.
+
+REUSE_ANNOTATION_IDS = True
+
+### ANNOTATION_PARSE_CACHE
+# Parsed annotation files are cached under WORK_DIR and the cache is used
+# for as long as the annotation and text files are unchanged. Set to
+# False to always parse the annotation files. Cached parses that have not
+# been written for ANNOTATION_PARSE_CACHE_MAX_AGE seconds, such as those
+# of deleted documents, are removed about once a day; set to None to keep
+# them, the cache (WORK_DIR/annotation_cache) can then be cleared by hand
+# at any time.
+
+ANNOTATION_PARSE_CACHE = True
+ANNOTATION_PARSE_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
+### ANNOTATION_MEMORY_CACHE
+# A persistent server process (FastCGI) keeps the parsed annotations of
+# the most recently used documents in memory between requests, for as
+# long as their files are unchanged, so that edits to large documents do
+# not have to parse the files again. At most
+# ANNOTATION_MEMORY_CACHE_DOCUMENTS documents are kept, taking up an
+# estimated ANNOTATION_MEMORY_CACHE_BYTES bytes. Set
+# ANNOTATION_MEMORY_CACHE_DOCUMENTS to 0 to disable the cache. The
+# getAnnotationCacheStatistics action reports the hits, misses and
+# evictions of the cache to logged-in users.
+
+ANNOTATION_MEMORY_CACHE_DOCUMENTS = 16
+ANNOTATION_MEMORY_CACHE_BYTES = 256 * 1024 * 1024
+
+### TEXT_OFFSET_CACHE
+# The token and sentence offsets of each document text are cached under
+# WORK_DIR, so that a text is tokenised and sentence split only once
+# rather than for every request returning the document. Set to False to
+# always tokenise and sentence split the text. Cached offsets that have not
+# been written for TEXT_OFFSET_CACHE_MAX_AGE seconds, such as those of
+# deleted documents, are removed about once a day; set to None to keep
+# them, the cache (WORK_DIR/offset_cache) can then be cleared by hand at
+# any time.
+
+TEXT_OFFSET_CACHE = True
+TEXT_OFFSET_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
 ### TUTORIALS
 # Unauthorised users can create tutorials (but not edit without a login)
 TUTORIALS = False
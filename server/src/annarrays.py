@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+from __future__ import with_statement
+
+'''
+Columnar export of the annotations of whole collections into NumPy
+arrays, for corpus-wide distributions (span lengths, nesting depth,
+attribute values, argument types) computed by vectorized operations
+rather than by loading every document.
+
+The annotations are read one document at a time (see iter_annotations())
+into two tables of equal-length arrays, saved together in a .npz file:
+
+    ann_*  - one row per annotation: document, category, type, first
+             start and last end offset, total length of the spans and
+             nesting depth (text-bound annotations), trigger (events)
+             and value (attributes and normalizations)
+    arg_*  - one row per reference from an annotation to another: the
+             referencing row, the role and the referenced row; event
+             arguments, relation arguments (arg1 before arg2), equiv
+             members and the targets of attributes, normalizations and
+             comments
+
+Types, roles and values are stored as ids into a vocabulary, documents
+as ids into a list of document paths. Missing values are -1.
+
+Usage example (see also tools/exportarrays.py):
+
+    export_collections(['data/corpus'], 'corpus.npz')
+    arrays = load_arrays('corpus.npz')
+    print arrays.count_by_type(TEXTBOUND)
+
+Requires NumPy, which the rest of brat does not.
+'''
+
+from array import array
+from bisect import bisect_left, insort
+from os import listdir, walk
+from os.path import isdir, join as path_join
+
+from annotation import (AnnotationFileNotFoundError, AttributeAnnotation,
+        BinaryRelationAnnotation, EquivAnnotation, EventAnnotation,
+        NormalizationAnnotation, OnelineCommentAnnotation, TEXT_FILE_SUFFIX,
+        TextBoundAnnotation, ann_category, iter_annotations, split_role)
+from docpack import packed_document_names
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+### Constants
+ANNARRAYS_FORMAT_VERSION = 1
+# Category codes of the ann_category column
+TEXTBOUND = 0
+EVENT = 1
+RELATION = 2
+EQUIV = 3
+ATTRIBUTE = 4
+NORMALIZATION = 5
+COMMENT = 6
+CATEGORY_NAMES = ('textbound', 'event', 'relation', 'equiv', 'attribute',
+        'normalization', 'comment', )
+# Columns of the annotation and reference tables, with their types
+ANN_COLUMNS = (
+        ('ann_doc', 'int32'),
+        ('ann_category', 'int8'),
+        ('ann_type', 'int32'),
+        ('ann_start', 'int64'),
+        ('ann_end', 'int64'),
+        ('ann_length', 'int64'),
+        ('ann_depth', 'int32'),
+        ('ann_trigger', 'int64'),
+        ('ann_value', 'int32'),
+        )
+ARG_COLUMNS = (
+        ('arg_ann', 'int64'),
+        ('arg_role', 'int32'),
+        ('arg_target', 'int64'),
+        )
+NUMPY_MISSING_ERROR = ('Failed to import NumPy, which is required for the '
+        'columnar export of annotations. Please install NumPy from '
+        'http://www.numpy.org/')
+###
+
+_CATEGORY_BY_CLASS = {
+        TextBoundAnnotation: TEXTBOUND,
+        EventAnnotation: EVENT,
+        BinaryRelationAnnotation: RELATION,
+        EquivAnnotation: EQUIV,
+        AttributeAnnotation: ATTRIBUTE,
+        NormalizationAnnotation: NORMALIZATION,
+        OnelineCommentAnnotation: COMMENT,
+        }
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError(NUMPY_MISSING_ERROR)
+
+
+def collection_documents(directory):
+    '''
+    Return the paths (without suffix) of the documents of the collection
+    in the given directory, loose and packed.
+    '''
+
+    text_suffix = '.' + TEXT_FILE_SUFFIX
+    names = sorted(fn[:-len(text_suffix)] for fn in listdir(directory)
+            if fn.endswith(text_suffix))
+    names.extend(packed_document_names(directory, names))
+    return [path_join(directory, name) for name in names]
+
+
+class _ArrayBuilder(object):
+    '''
+    Accumulates the rows of the tables document by document, in arrays of
+    the standard library until they are converted once at the end.
+    '''
+
+    def __init__(self):
+        self.documents = []
+        self.vocabulary = []
+        self._string_id = {}
+        # 'l' is at least 32 bits, enough for the int32 columns as well
+        self.columns = dict((name, array('l'))
+                for name, _ in ANN_COLUMNS + ARG_COLUMNS)
+
+    def string_id(self, s):
+        s = unicode(s)
+        try:
+            return self._string_id[s]
+        except KeyError:
+            self._string_id[s] = len(self.vocabulary)
+            self.vocabulary.append(s)
+            return self._string_id[s]
+
+    def add_document(self, document, anns):
+        doc_i = len(self.documents)
+        self.documents.append(document)
+        c = self.columns
+        row_by_id = {}
+        # (row, role, referenced id) for each reference, resolved once all
+        # of the annotations of the document have been seen
+        refs = []
+        triggers = []
+        # (first start, -last end, row) of the text-bound annotations
+        textbounds = []
+
+        for ann in anns:
+            category = _CATEGORY_BY_CLASS.get(ann_category(ann))
+            if category is None:
+                # Unparsed or unknown lines
+                continue
+            row = len(c['ann_doc'])
+            ann_id = getattr(ann, 'id', None)
+            if ann_id is not None:
+                row_by_id[ann_id] = row
+
+            start = end = length = value = -1
+            if category == TEXTBOUND:
+                start, end = ann.first_start(), ann.last_end()
+                length = sum(e - s for s, e in ann.spans)
+                textbounds.append((start, -end, row))
+            elif category == EVENT:
+                triggers.append((row, ann.trigger))
+                for role, arg in ann.args:
+                    # Numbered roles ("Theme2") count as their base role
+                    refs.append((row, self.string_id(split_role(role)[0]),
+                        arg))
+            elif category == RELATION:
+                refs.append((row, self.string_id(ann.arg1l), ann.arg1))
+                refs.append((row, self.string_id(ann.arg2l), ann.arg2))
+            elif category == EQUIV:
+                for member in ann.entities:
+                    refs.append((row, -1, member))
+            else:
+                if category == ATTRIBUTE and ann.value != True:
+                    value = self.string_id(ann.value)
+                elif category == NORMALIZATION:
+                    value = self.string_id(ann.refdb)
+                refs.append((row, -1, ann.target))
+
+            c['ann_doc'].append(doc_i)
+            c['ann_category'].append(category)
+            c['ann_type'].append(self.string_id(ann.type))
+            c['ann_start'].append(start)
+            c['ann_end'].append(end)
+            c['ann_length'].append(length)
+            c['ann_depth'].append(-1)
+            c['ann_trigger'].append(-1)
+            c['ann_value'].append(value)
+
+        for row, trigger in triggers:
+            c['ann_trigger'][row] = row_by_id.get(trigger, -1)
+        for row, role, target in refs:
+            c['arg_ann'].append(row)
+            c['arg_role'].append(role)
+            c['arg_target'].append(row_by_id.get(target, -1))
+
+        # Nesting depth, the number of enclosing annotations; spans that
+        # cross rather than nest count only towards those enclosing both.
+        # In the order of (start, -end), the annotations enclosing one are
+        # those before it that end no earlier, counted in the sorted ends.
+        textbounds.sort()
+        ends = []
+        for start, neg_end, row in textbounds:
+            c['ann_depth'][row] = len(ends) - bisect_left(ends, -neg_end)
+            insort(ends, -neg_end)
+
+    def arrays(self):
+        arrays = {
+                'format': numpy.array([ANNARRAYS_FORMAT_VERSION]),
+                'documents': numpy.array(self.documents, dtype=unicode),
+                'vocabulary': numpy.array(self.vocabulary, dtype=unicode),
+                }
+        for name, dtype in ANN_COLUMNS + ARG_COLUMNS:
+            arrays[name] = numpy.array(self.columns[name], dtype=dtype)
+        return arrays
+
+
+def export_collections(directories, path, recursive=False, compressed=False):
+    '''
+    Export the annotations of the documents of the collections in the given
+    directories (and their subdirectories if recursive is True) into the
+    .npz file at the given path.
+
+    Returns:
+    The number of documents exported.
+    '''
+    _require_numpy()
+
+    if recursive:
+        directories = [dir_path for directory in directories
+                for dir_path, _, _ in walk(directory)]
+
+    builder = _ArrayBuilder()
+    for directory in directories:
+        if not isdir(directory):
+            continue
+        for document in collection_documents(directory):
+            try:
+                builder.add_document(document, iter_annotations(document))
+            except AnnotationFileNotFoundError:
+                # Nothing annotated yet
+                builder.add_document(document, ())
+
+    save = numpy.savez_compressed if compressed else numpy.savez
+    with open(path, 'wb') as npz_file:
+        save(npz_file, **builder.arrays())
+    return len(builder.documents)
+
+
+def load_arrays(path):
+    '''
+    Load the AnnotationArrays of a .npz file from export_collections().
+    '''
+    _require_numpy()
+
+    with numpy.load(path) as npz:
+        arrays = dict((name, npz[name]) for name in npz.files)
+    if int(arrays['format'][0]) != ANNARRAYS_FORMAT_VERSION:
+        raise ValueError('Unsupported annotation array format version %d '
+                'in %s' % (arrays['format'][0], path))
+    return AnnotationArrays(arrays)
+
+
+class AnnotationArrays(object):
+    '''
+    The annotation and reference tables of an export, with queries for
+    common aggregations. The columns are attributes named as in
+    ANN_COLUMNS and ARG_COLUMNS, for queries of one's own.
+    '''
+
+    def __init__(self, arrays):
+        self.documents = arrays['documents']
+        self.vocabulary = arrays['vocabulary']
+        for name, _ in ANN_COLUMNS + ARG_COLUMNS:
+            setattr(self, name, arrays[name])
+        self._string_id = None
+
+    def __len__(self):
+        return len(self.ann_doc)
+
+    def string_id(self, s):
+        '''
+        Return the vocabulary id of the given type, role or value, or -1
+        if it does not occur.
+        '''
+
+        if self._string_id is None:
+            self._string_id = dict((s, i)
+                    for i, s in enumerate(self.vocabulary))
+        return self._string_id.get(unicode(s), -1)
+
+    def select(self, category=None, type=None):
+        '''
+        Return a boolean mask of the annotation rows of the given category
+        and type (either or both).
+        '''
+
+        mask = numpy.ones(len(self), dtype=bool)
+        if category is not None:
+            mask &= self.ann_category == category
+        if type is not None:
+            mask &= self.ann_type == self.string_id(type)
+        return mask
+
+    def _counts(self, *columns):
+        # Counts of the distinct combinations of the values of the given
+        # equal-length columns of vocabulary ids (or -1), keyed by their
+        # strings (or None); the combinations are counted as single keys
+        base = len(self.vocabulary) + 1
+        keys = numpy.zeros(len(columns[0]), dtype='int64')
+        for column in columns:
+            keys = keys * base + (column + 1)
+        keys, counts = numpy.unique(keys, return_counts=True)
+
+        counts_by_strings = {}
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            strings = []
+            for _ in columns:
+                key, i = divmod(key, base)
+                strings.append(self.vocabulary[i - 1] if i else None)
+            strings.reverse()
+            counts_by_strings[tuple(strings) if len(columns) > 1
+                    else strings[0]] = count
+        return counts_by_strings
+
+    def count_by_type(self, category=None):
+        '''
+        Return the number of annotations of each type, of the given
+        category only if given.
+        '''
+
+        return self._counts(self.ann_type[self.select(category)])
+
+    def span_lengths(self, type=None):
+        '''
+        Return the span lengths (characters covered) of the text-bound
+        annotations, of the given type only if given.
+        '''
+
+        return self.ann_length[self.select(TEXTBOUND, type)]
+
+    def span_length_summary(self):
+        '''
+        Return (count, mean, median, max) of the span lengths of the
+        text-bound annotations of each type.
+        '''
+
+        mask = self.select(TEXTBOUND)
+        types = self.ann_type[mask]
+        lengths = self.ann_length[mask]
+        summary = {}
+        for type_id in numpy.unique(types):
+            type_lengths = lengths[types == type_id]
+            summary[self.vocabulary[type_id]] = (len(type_lengths),
+                    float(type_lengths.mean()),
+                    float(numpy.median(type_lengths)),
+                    int(type_lengths.max()))
+        return summary
+
+    def depth_counts(self, type=None):
+        '''
+        Return the number of text-bound annotations (of the given type only
+        if given) at each nesting depth, indexed by depth.
+        '''
+
+        return numpy.bincount(self.ann_depth[self.select(TEXTBOUND, type)])
+
+    def attribute_value_counts(self, type=None):
+        '''
+        Return the number of attributes with each (type, value), the value
+        being None for binary attributes.
+        '''
+
+        mask = self.select(ATTRIBUTE, type)
+        return self._counts(self.ann_type[mask], self.ann_value[mask])
+
+    def relation_type_pairs(self, type=None):
+        '''
+        Return the number of relations with each (relation type, arg1
+        type, arg2 type), None standing for undefined arguments.
+        '''
+
+        row_mask = self.select(RELATION, type)
+        # Each relation has two references, arg1 before arg2
+        refs = row_mask[self.arg_ann]
+        rows = self.arg_ann[refs][::2]
+        targets = self.arg_target[refs].reshape(-1, 2)
+        return self._counts(self.ann_type[rows],
+                self._target_types(targets[:, 0]),
+                self._target_types(targets[:, 1]))
+
+    def argument_type_counts(self, category=EVENT, type=None):
+        '''
+        Return the number of arguments with each (annotation type, role,
+        argument type) for the annotations of the given category, the role
+        being None for equiv members and targets of attributes etc.
+        '''
+
+        refs = self.select(category, type)[self.arg_ann]
+        return self._counts(self.ann_type[self.arg_ann[refs]],
+                self.arg_role[refs], self._target_types(self.arg_target[refs]))
+
+    def _target_types(self, targets):
+        # Types of the referenced rows, -1 for undefined references
+        if not len(targets):
+            return numpy.zeros(0, dtype=self.ann_type.dtype)
+        return numpy.where(targets != -1, self.ann_type[targets], -1)
+
+if __name__ == '__main__':
+    import unittest
+
+    class NestingDepthTest(unittest.TestCase):
+        def _depths(self, spans):
+            builder = _ArrayBuilder()
+            builder.add_document('doc', [TextBoundAnnotation(((s, e), ),
+                'T%d' % (i + 1), 'Entity', '\t') for i, (s, e)
+                in enumerate(spans)])
+            return list(builder.columns['ann_depth'])
+
+        def test_nested(self):
+            self.assertEqual(self._depths([(0, 10), (2, 8), (3, 4), (5, 6)]),
+                    [0, 1, 2, 2])
+
+        def test_identical(self):
+            self.assertEqual(self._depths([(0, 5), (0, 5)]), [0, 1])
+
+        def test_crossing(self):
+            # B crosses A, C is within both
+            self.assertEqual(self._depths([(0, 10), (5, 15), (6, 8)]),
+                    [0, 0, 2])
+
+        def test_crossing_after(self):
+            # C is within B only, A ended before it
+            self.assertEqual(self._depths([(0, 10), (5, 15), (11, 12)]),
+                    [0, 0, 1])
+
+    unittest.main()
@@ -14,19 +14,29 @@ Version:    2011-01-25
 # TODO: Major re-work, cleaning up and conforming with new server paradigm
 
 from logging import info as log_info
+from bisect import bisect_left, bisect_right
 from codecs import open as codecs_open
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
 from functools import partial
-from itertools import chain, takewhile
-from os import close as os_close, utime
+from gc import disable as gc_disable, enable as gc_enable
+from gc import isenabled as gc_isenabled
+from heapq import heappop, heappush
+from itertools import takewhile
+from os import close as os_close, fsync, remove, rename, utime
 from time import time
 from os.path import join as path_join
-from os.path import basename, splitext
+from os.path import basename, dirname, getsize, isfile, splitext
 from re import match as re_match
 from re import compile as re_compile
+from thread import allocate_lock
 
 from common import ProtocolError
+from docpack import packed_document
+from doctext import DocumentText
 from filelock import file_lock
 from message import Messager
+from workcache import prune_cache_dir
 
 
 ### Constants
@@ -37,6 +47,10 @@ JOINED_ANN_FILE_SUFF = 'ann'
 PARTIAL_ANN_FILE_SUFF = ['a1', 'a2', 'co', 'rel']
 KNOWN_FILE_SUFF = [JOINED_ANN_FILE_SUFF]+PARTIAL_ANN_FILE_SUFF
 TEXT_FILE_SUFFIX = 'txt'
+# Suffix appended to a joined annotation file name for its edit journal
+JOURNAL_FILE_SUFF = 'journal'
+# First field of the header line of an edit journal
+JOURNAL_HEADER = u'#brat-journal'
 # String used to catenate texts of discontinuous annotations in reference text
 DISCONT_SEP = ' '
 ###
@@ -53,6 +67,179 @@ BIONLP_ST_2013_NORMALIZATION_RES = [
     (re_compile(r'^(Reference) Referent:(\S+) Annotation:(\S+)'), r'\1 \3 \2'),
     ]
 
+# If True, modified annotation files are parsed back in before they are
+# moved into place to make sure that we never write a file that we can
+# not read. This doubles the cost of saving large documents.
+try:
+    from config import VERIFY_ANNOTATION_WRITES
+except ImportError:
+    VERIFY_ANNOTATION_WRITES = False
+
+# If True, edits to a joined annotation file are appended to a journal
+# (<document>.ann.journal) instead of rewriting the whole file, making the
+# cost of an edit independent of the size of the document. The journal is
+# folded back into the annotation file once it is larger than
+# ANNOTATION_JOURNAL_MAX_SIZE bytes or older than ANNOTATION_JOURNAL_MAX_AGE
+# seconds.
+try:
+    from config import ANNOTATION_JOURNAL
+except ImportError:
+    ANNOTATION_JOURNAL = False
+try:
+    from config import ANNOTATION_JOURNAL_MAX_SIZE
+except ImportError:
+    ANNOTATION_JOURNAL_MAX_SIZE = 64 * 1024
+try:
+    from config import ANNOTATION_JOURNAL_MAX_AGE
+except ImportError:
+    ANNOTATION_JOURNAL_MAX_AGE = 60 * 60
+
+# If True, get_new_id() returns the lowest free id for a prefix, re-using
+# the ids of deleted annotations, if False ids are always allocated above
+# the highest one used
+try:
+    from config import REUSE_ANNOTATION_IDS
+except ImportError:
+    REUSE_ANNOTATION_IDS = True
+
+# Parsed annotations are cached under WORK_DIR and restored for as long as
+# the files that they were parsed from remain unchanged, set to False in
+# config.py to always parse the annotation files
+try:
+    from config import ANNOTATION_PARSE_CACHE
+except ImportError:
+    ANNOTATION_PARSE_CACHE = True
+# Cached parses not written for ANNOTATION_PARSE_CACHE_MAX_AGE seconds are
+# removed (see workcache), set to None in config.py to keep them for ever
+try:
+    from config import ANNOTATION_PARSE_CACHE_MAX_AGE
+except ImportError:
+    ANNOTATION_PARSE_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+# Directory under WORK_DIR holding the parse cache
+PARSE_CACHE_DIR = 'annotation_cache'
+# Has to be increased whenever the parsing or the state that is cached for
+# the annotations changes, to invalidate the existing caches
+PARSE_CACHE_VERSION = 4
+# Attributes of Annotations holding the state after parsing, the lookups
+# for the annotations are rebuilt rather than cached as that is both faster
+# than unpickling them and far faster than pickling them
+PARSE_CACHE_ATTRS = ('failed_lines', '_lines', '_max_id_num_by_prefix',
+        '_source_line_by_ann', '_parsed_base_identity', '_journal_base',
+        '_journal_created', 'externally_referenced_triggers', )
+
+# Parsed annotations are kept in memory by persistent server processes
+# (FastCGI) between the requests for a document, for at most
+# ANNOTATION_MEMORY_CACHE_DOCUMENTS documents taking up an estimated
+# ANNOTATION_MEMORY_CACHE_BYTES bytes, set the former to 0 in config.py to
+# always read the annotations from disk
+try:
+    from config import ANNOTATION_MEMORY_CACHE_DOCUMENTS
+except ImportError:
+    ANNOTATION_MEMORY_CACHE_DOCUMENTS = 16
+try:
+    from config import ANNOTATION_MEMORY_CACHE_BYTES
+except ImportError:
+    ANNOTATION_MEMORY_CACHE_BYTES = 256 * 1024 * 1024
+# Estimated memory taken up by parsed annotations per byte of the files
+# that they were parsed from
+MEMORY_CACHE_BYTES_PER_FILE_BYTE = 20
+
+@contextmanager
+def _gc_paused():
+    # The cyclic garbage collector is triggered over and over again by the
+    # allocations when (un)pickling large numbers of objects, more than
+    # doubling the time taken
+    was_enabled = gc_isenabled()
+    gc_disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc_enable()
+
+class _MemoryCache(object):
+    '''
+    Least recently used cache of the state of parsed annotation objects,
+    see Annotations._checkout_memory_cache(). Entries are taken out of the
+    cache while in use, each is used by a single request at a time.
+    '''
+
+    def __init__(self):
+        self._lock = allocate_lock()
+        # (source key, estimated size, state) by key, least recently used
+        # first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def checkout(self, key, source_key):
+        '''
+        Take the state cached under the given key out of the cache and
+        return it, or None if there is none for files with the given
+        source key (see Annotations._parse_cache_key()).
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._bytes -= entry[1]
+            if entry[0] != source_key:
+                # The files have changed since
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[2]
+
+    def checkin(self, key, source_key, size, state):
+        # Cache the given state as the most recently used, evicting the
+        # least recently used states over the limits
+        if size > ANNOTATION_MEMORY_CACHE_BYTES:
+            return
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self._bytes -= old_entry[1]
+            self._entries[key] = (source_key, size, state)
+            self._bytes += size
+            while (len(self._entries) > ANNOTATION_MEMORY_CACHE_DOCUMENTS
+                    or self._bytes > ANNOTATION_MEMORY_CACHE_BYTES):
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def statistics(self):
+        with self._lock:
+            return {
+                    'documents': len(self._entries),
+                    'bytes': self._bytes,
+                    'max_documents': ANNOTATION_MEMORY_CACHE_DOCUMENTS,
+                    'max_bytes': ANNOTATION_MEMORY_CACHE_BYTES,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    }
+
+_memory_cache = _MemoryCache()
+
+def get_memory_cache_statistics():
+    '''
+    Return the counters of the in-memory cache of parsed annotations of
+    this process, for monitoring.
+    '''
+    return {'annotation_cache': _memory_cache.statistics()}
+
+
 class AnnotationLineSyntaxError(Exception):
     def __init__(self, line, line_num, filepath):
         self.line = line
@@ -219,8 +406,16 @@ def open_textfile(filename, mode='rU'):
         mode = mode + 'U'
     return codecs_open(filename, mode, encoding='utf8', errors='strict')
 
+# Annotation id: prefix, number and (rarely used) suffix
+ANN_ID_RE = re_compile(r'^([A-Za-z]+|#[A-Za-z]*)([0-9]+)(.*?)$')
+# Attribute annotation data, with and without (old format) a value
+ATTRIBUTE_DATA_RE = re_compile(r'(.+?) (.+?) (.+?)$')
+ATTRIBUTE_DATA_NO_VALUE_RE = re_compile(r'(.+?) (.+?)$')
+# Normalization annotation data
+NORMALIZATION_DATA_RE = re_compile(r'(\S+) (\S+) (\S+?):(\S+)')
+
 def __split_annotation_id(id):
-    m = re_match(r'^([A-Za-z]+|#[A-Za-z]*)([0-9]+)(.*?)$', id)
+    m = ANN_ID_RE.match(id)
     if m is None:
         raise InvalidIdError(id)
     pre, num_str, suf = m.groups()
@@ -256,6 +451,10 @@ class Annotations(object):
     text file to which the annotations apply.
     """
 
+    # Whether the highest id numbers in use are tracked for allocating new
+    # ids, which read-only views do without
+    _allocates_ids = True
+
     def get_document(self):
         return self._document
     
@@ -278,7 +477,7 @@ class Annotations(object):
                 # It is a joined file, let's load it
                 input_files = [document]
                 # Do we lack write permissions?
-                if not access(document, W_OK):
+                if not self._read_only and not access(document, W_OK):
                     #TODO: Should raise an exception or warning
                     self._read_only = True
             elif suff in PARTIAL_ANN_FILE_SUFF:
@@ -300,7 +499,7 @@ class Annotations(object):
                 # We found a joined file by adding the joined suffix
                 input_files = [sugg_path]
                 # Do we lack write permissions?
-                if not access(sugg_path, W_OK):
+                if not self._read_only and not access(sugg_path, W_OK):
                     #TODO: Should raise an exception or warning
                     self._read_only = True
             else:
@@ -313,11 +512,38 @@ class Annotations(object):
 
         return input_files
             
-    #TODO: DOC!
-    def __init__(self, document, read_only=False):
+    def _packed_input_files(self, document, read_only=True):
+        # The annotation files of a document read from the pack of its
+        # collection, named as they would be if the document was loose
+        from os import access, W_OK
+
+        self._packed = packed_document(_text_file_base(document))
+        if self._packed is None:
+            return []
+        self._read_only = read_only
+        suffixes = self._packed.get_suffixes()
+        if JOINED_ANN_FILE_SUFF in suffixes:
+            # Edits are written to loose files in the collection directory
+            if not read_only and not access(dirname(self._packed.document)
+                    or '.', W_OK):
+                self._read_only = True
+            suffixes = [JOINED_ANN_FILE_SUFF]
+        else:
+            self._read_only = True
+        return [self._packed.document + '.' + suff for suff in suffixes
+                if suff in KNOWN_FILE_SUFF]
+
+    def _read_input_file(self, input_file_path):
+        if self._packed is not None:
+            suffix = input_file_path[len(self._packed.document) + 1:]
+            return self._packed.read_file(suffix).decode('utf-8')
+        with open_textfile(input_file_path) as input_file:
+            return input_file.read()
+
+    def _line_parsers(self):
         # this decides which parsing function is invoked by annotation
         # ID prefix (first letter)
-        self._parse_function_by_id_prefix = {
+        return {
             'T': self._parse_textbound_annotation,
             'M': self._parse_modifier_annotation,
             'A': self._parse_attribute_annotation,
@@ -328,6 +554,10 @@ class Annotations(object):
             '#': self._parse_comment_annotation,
             }
 
+    #TODO: DOC!
+    def __init__(self, document, read_only=False):
+        self._parse_function_by_id_prefix = self._line_parsers()
+
         #TODO: DOC!
         #TODO: Incorparate file locking! Is the destructor called upon inter crash?
         from collections import defaultdict
@@ -341,21 +571,87 @@ class Annotations(object):
         self.externally_referenced_triggers = set()
 
         ### Here be dragons, these objects need constant updating and syncing
-        # Annotation for each line of the file
+        # Annotation for each line of the file, deleted annotations leave a
+        # None "tombstone" behind until the list is compacted
         self._lines = []
-        # Mapping between annotation objects and which line they occur on
+        # Number of tombstones in self._lines
+        self._tombstone_count = 0
+        # Mapping between annotation objects and their position in
+        # self._lines, positions are only renumbered on compaction
         # Range: [0, inf.) unlike [1, inf.) which is common for files
         self._line_by_ann = {}
-        # Maximum id number used for each id prefix, to speed up id generation
-        #XXX: This is effectively broken by the introduction of id suffixes
-        self._max_id_num_by_prefix = defaultdict(lambda : 1)
+        # Maximum id number used or reserved for each (prefix, suffix) pair
+        # of ids, new ids are allocated above it
+        self._max_id_num_by_prefix = defaultdict(int)
+        # If REUSE_ANNOTATION_IDS is set, the number below which all ids
+        # for each (prefix, suffix) pair have been handed out or found used
+        # and heaps of the numbers below it freed by deletions since
+        self._next_id_num_by_prefix = {}
+        self._free_id_nums_by_prefix = defaultdict(list)
         # Annotation by id, not includid non-ided annotations 
         self._ann_by_id = {}
+        # Annotations by category (see ANN_CATEGORIES), each category
+        # keeping its annotations in the order in which they appear
+        self._anns_by_category = defaultdict(OrderedDict)
+        # Number of events referencing each trigger id
+        self._event_count_by_trigger = defaultdict(int)
+        # Trigger id under which each event was last indexed
+        self._indexed_trigger_by_event = {}
+        # Annotations referencing each id
+        self._referencing_anns_by_id = defaultdict(set)
+        # Ids that each annotation was last indexed as referencing
+        self._indexed_deps_by_ann = {}
+        # Start offsets of all text-bound spans in sorted order and the
+        # (start, end, annotation) entry for each, built when first queried
+        # (see overlapping()) and maintained from then on
+        self._span_starts = None
+        self._span_entries = None
+        # Spans that each text-bound was last indexed with
+        self._indexed_spans_by_ann = {}
+        # Length of the longest span indexed, bounding the start offsets
+        # of the spans that can overlap a given range
+        self._max_span_length = 0
+        # Set when the annotations are changed after parsing, only modified
+        # annotations are written back to disk. Only changes made through
+        # this object are seen: annotations changed in place have to be
+        # reported with update_annotation(), the only supported way of
+        # changing them, or a change that leaves the indices as they were
+        # (e.g. of the type or text) is never written
+        self._modified = False
+        # Line in the annotation file of each parsed annotation, only kept
+        # when the edits are written to a journal (see ANNOTATION_JOURNAL)
+        self._source_line_by_ann = {}
+        # Parsed annotations changed, deleted (by their source line) and
+        # annotations added since the last write
+        self._changed_anns = set()
+        self._deleted_source_lines = []
+        self._added_anns = set()
+        # Cleared by parsing that reports problems to the user, which would
+        # go unreported if the parse was restored from the parse cache
+        self._parse_cacheable = True
+        # Parse cache key for the annotation files as they were parsed
+        self._parse_cache_source_key = None
+        # Number of nested batch() blocks being run and the equivs added in
+        # them, which are merged with the others at the end of the batch
+        self._batch_depth = 0
+        self._batch_equivs = []
+        # Annotations added or changed since the annotations were last
+        # sanity checked, only these are checked after changes
+        self._unchecked_anns = set()
+        # Annotations handed out to callers since the changes were last
+        # written, the only ones that can have been changed in place (see
+        # _reindex_stale()); not kept for read-only annotations
+        self._handed_out_anns = set()
         ###
 
         ## We use some heuristics to find the appropriate annotation files
         self._read_only = read_only
+        # The document as stored in the pack of its collection, if it is
+        # read from there (see docpack)
+        self._packed = None
         input_files = self._select_input_files(document)
+        if not input_files:
+            input_files = self._packed_input_files(document, read_only)
 
         if not input_files:
             with open('{}.{}'.format(document, JOINED_ANN_FILE_SUFF), 'w'):
@@ -369,12 +665,45 @@ class Annotations(object):
         #self._file_input = FileInput(openhook=hook_encoded('utf-8'))
         self._input_files = input_files
 
-        # Finally, parse the given annotation file
+        # Only joined annotation files can have an edit journal, and only
+        # loose ones (documents are copied out of the pack when edited)
+        if self._packed is None and (len(input_files) == 1 and
+                input_files[0].endswith(JOINED_ANN_FILE_SUFF)):
+            self._journal_path = input_files[0] + '.' + JOURNAL_FILE_SUFF
+        else:
+            self._journal_path = None
+        # Are edits to be written to the journal? (see ANNOTATION_JOURNAL)
+        self._journaling = (ANNOTATION_JOURNAL and not self._read_only
+                and self._journal_path is not None)
+        # Identity of the annotation file as it was parsed and of the file
+        # that the journal applies to, the latter being None if there is no
+        # journal or if it is stale
+        self._parsed_base_identity = None
+        self._journal_base = None
+        # Time at which the journal was started
+        self._journal_created = None
+
+        # Finally, parse the given annotation file, unless the parse is
+        # cached in memory or on disk
         try:
-            self._parse_ann_file()
-        
-            # Sanity checking that can only be done post-parse
-            self._sanity()
+            # Determined before parsing, in case the files change while
+            # parsing
+            self._parse_cache_source_key = self._parse_cache_key()
+            cached = (self._checkout_memory_cache()
+                    or self._load_parse_cache())
+            if not cached:
+                self._parse_ann_file()
+                # Sanity checking that can only be done post-parse, cached
+                # parses were checked before they were cached
+                self._sanity()
+                self._unchecked_anns.clear()
+            # Equivs merged while parsing are not modifications, nor are
+            # the annotations looked up while parsing handed out
+            self._modified = False
+            self._handed_out_anns.clear()
+
+            if not cached:
+                self._store_parse_cache()
         except UnicodeDecodeError:
             Messager.error('Encoding error reading annotation file: '
                     'nonstandard encoding or binary?', -1)
@@ -382,7 +711,10 @@ class Annotations(object):
             raise AnnotationFileNotFoundError(document)
 
         #XXX: Hack to get the timestamps after parsing
-        if (len(self._input_files) == 1 and
+        if self._packed is not None:
+            self.ann_mtime = self._packed.get_mtime()
+            self.ann_ctime = self.ann_mtime
+        elif (len(self._input_files) == 1 and
                 self._input_files[0].endswith(JOINED_ANN_FILE_SUFF)):
             self.ann_mtime = getmtime(self._input_files[0])
             self.ann_ctime = getctime(self._input_files[0])
@@ -391,20 +723,54 @@ class Annotations(object):
             self.ann_mtime = -1
             self.ann_ctime = -1
 
-    def _sanity(self):
+    def _sanity(self, anns=None):
+        '''
+        Check all of the annotations or, if anns is given, only the given
+        annotations and those directly referencing them, which are the
+        only ones affected by changes to the given annotations.
+        '''
         # Beware, we ONLY do format checking, leave your semantics hat at home
 
-        # Check that referenced IDs are defined
-        for ann in self:
-            for rid in chain(*ann.get_deps()):
+        if anns is None:
+            undefined_ids = [rid for rid in self._referencing_anns_by_id.keys()
+                    if rid not in self._ann_by_id]
+            events = self.get_events()
+            triggers = self.get_triggers()
+        else:
+            affected = set(a for a in anns if a in self._line_by_ann)
+            for ann in list(affected):
                 try:
-                    self.get_ann_by_id(rid)
-                except AnnotationNotFoundError:
-                    # TODO: do more than just send a message for this error?
-                    Messager.error('ID '+rid+' not defined, referenced from annotation '+str(ann))
+                    affected.update(self._referencing_anns_by_id.get(ann.id,
+                        ()))
+                except AttributeError:
+                    # Only annotations with ids can be referenced
+                    pass
+            affected = self._ordered(affected)
+            dep_ids = set()
+            for ann in affected:
+                dep_ids.update(self._indexed_deps_by_ann.get(ann, ()))
+            undefined_ids = sorted(rid for rid in dep_ids
+                    if rid not in self._ann_by_id)
+            events = [a for a in affected if isinstance(a, EventAnnotation)]
+            # The triggers referenced by the affected annotations or among
+            # them, other triggers can't have gained references
+            trigger_ids = dep_ids | set(a.id for a in affected
+                    if isinstance(a, TextBoundAnnotation))
+            triggers = self._ordered(self._ann_by_id[tid]
+                    for tid in trigger_ids
+                    if tid in self._event_count_by_trigger
+                    and tid in self._ann_by_id)
+
+        # Check that referenced IDs are defined
+        for rid in undefined_ids:
+            # Reported to the user, which a cached parse would not be
+            self._parse_cacheable = False
+            for ann in self.get_dependants(rid):
+                # TODO: do more than just send a message for this error?
+                Messager.error('ID '+rid+' not defined, referenced from annotation '+str(ann))
 
         # Check that each event has a trigger
-        for e_ann in self.get_events():
+        for e_ann in events:
             try:
                 tr_ann = self.get_ann_by_id(e_ann.trigger)
 
@@ -416,22 +782,11 @@ class Annotations(object):
                 raise EventWithoutTriggerError(e_ann)
 
         # Check that every trigger is only referenced by events
-
-        # Create a map for non-event references
-        referenced_to_referencer = {}
-        for non_e_ann in (a for a in self
-                if not isinstance(a, EventAnnotation)
-                and isinstance(a, IdedAnnotation)):
-            for ref in chain(*non_e_ann.get_deps()):
-                try:
-                    referenced_to_referencer[ref].add(non_e_ann.id)
-                except KeyError:
-                    referenced_to_referencer[ref] = set((non_e_ann.id, ))
-
-        # Ensure that no non-event references a trigger
-        for tr_ann in self.get_triggers():
-            if tr_ann.id in referenced_to_referencer:
-                conflict_ann_ids = referenced_to_referencer[tr_ann.id]
+        for tr_ann in triggers:
+            conflict_ann_ids = set(a.id for a in self.get_dependants(tr_ann.id)
+                    if not isinstance(a, EventAnnotation)
+                    and isinstance(a, IdedAnnotation))
+            if conflict_ann_ids:
                 if BIONLP_ST_2013_COMPATIBILITY:
                     # Special-case processing for BioNLP ST 2013: allow
                     # Relations to reference event triggers (#926).
@@ -448,39 +803,48 @@ class Annotations(object):
                     referencer = self.get_ann_by_id(list(conflict_ann_ids)[0])
                     raise TriggerReferenceError(tr_ann, referencer)
         
+    def _hand_out(self, anns):
+        # Note the given annotations as handed out to a caller, returns them
+        if not self._read_only:
+            self._handed_out_anns.update(anns)
+        return anns
+
+    def _get_category(self, category):
+        # Copy the keys, callers regularly delete while iterating
+        return iter(self._hand_out(self._anns_by_category[category].keys()))
+
     def get_events(self):
-        return (a for a in self if isinstance(a, EventAnnotation))
+        return self._get_category(EventAnnotation)
     
     def get_attributes(self):
-        return (a for a in self if isinstance(a, AttributeAnnotation))
+        return self._get_category(AttributeAnnotation)
 
     def get_equivs(self):
-        return (a for a in self if isinstance(a, EquivAnnotation))
+        return self._get_category(EquivAnnotation)
 
     def get_textbounds(self):
-        return (a for a in self if isinstance(a, TextBoundAnnotation))
+        return self._get_category(TextBoundAnnotation)
 
     def get_relations(self):
-        return (a for a in self if isinstance(a, BinaryRelationAnnotation))
+        return self._get_category(BinaryRelationAnnotation)
 
     def get_normalizations(self):
-        return (a for a in self if isinstance(a, NormalizationAnnotation))
+        return self._get_category(NormalizationAnnotation)
 
     def get_entities(self):
         # Entities are textbounds that are not triggers
-        triggers = [t for t in self.get_triggers()]
-        return (a for a in self if (isinstance(a, TextBoundAnnotation) and
-                                    not a in triggers))
+        return (a for a in self.get_textbounds()
+                if a.id not in self._event_count_by_trigger)
     
     def get_oneline_comments(self):
         #XXX: The status exception is for the document status protocol
         #       which is yet to be formalised
-        return (a for a in self if isinstance(a, OnelineCommentAnnotation)
-                and a.type != 'STATUS')
+        return (a for a in self._get_category(OnelineCommentAnnotation)
+                if a.type != 'STATUS')
 
     def get_statuses(self):
-        return (a for a in self if isinstance(a, OnelineCommentAnnotation)
-                and a.type == 'STATUS')
+        return (a for a in self._get_category(OnelineCommentAnnotation)
+                if a.type == 'STATUS')
 
     def get_triggers(self):
         # Triggers are text-bounds referenced by events
@@ -488,6 +852,340 @@ class Annotations(object):
         # (for one reason or another -- brat shouldn't define any.)
         return (self.get_ann_by_id(e.trigger) for e in self.get_events())
 
+    def overlapping(self, start, end):
+        '''
+        Return the text-bound annotations with a span overlapping the given
+        range, in the order in which they appear. For an empty range this
+        is the annotations with a span strictly crossing the offset.
+        '''
+        starts, entries = self._span_index()
+        first = bisect_right(starts, start - self._max_span_length)
+        last = bisect_left(starts, end)
+        return self._ordered(e_ann for _, e_end, e_ann in entries[first:last]
+                if e_end > start)
+
+    def crossed_offsets(self, offsets):
+        '''
+        Return the set of the given offsets that a span of a text-bound
+        annotation strictly crosses (see overlapping()), in a single sweep
+        over the spans in order.
+        '''
+        starts, entries = self._span_index()
+        crossed = set()
+        i = 0
+        # Furthest end of the spans starting before the offset
+        max_end = -1
+        for offset in sorted(set(offsets)):
+            last = bisect_left(starts, offset, i)
+            for _, e_end, _ in entries[i:last]:
+                if e_end > max_end:
+                    max_end = e_end
+            i = last
+            if max_end > offset:
+                crossed.add(offset)
+        return crossed
+
+    def containing(self, start, end):
+        '''
+        Return the text-bound annotations with a span containing the given
+        range, in the order in which they appear.
+        '''
+        starts, entries = self._span_index()
+        first = bisect_left(starts, end - self._max_span_length)
+        last = bisect_right(starts, start)
+        return self._ordered(e_ann for _, e_end, e_ann in entries[first:last]
+                if e_end >= end)
+
+    def same_span(self, spans, type=None):
+        '''
+        Return the text-bound annotations with the given spans (in any
+        order) and of the given type, if any, in the order in which they
+        appear.
+        '''
+        spans = set((start, end) for start, end in spans)
+        if not spans:
+            return []
+        starts, entries = self._span_index()
+        first_start = min(start for start, _ in spans)
+        first = bisect_left(starts, first_start)
+        last = bisect_right(starts, first_start)
+        return self._ordered(e_ann for _, _, e_ann in entries[first:last]
+                if (type is None or e_ann.type == type)
+                and set(e_ann.spans) == spans)
+
+    def _ordered(self, anns):
+        return self._hand_out(sorted(set(anns),
+            key=self._line_by_ann.__getitem__))
+
+    def _span_index(self):
+        if self._span_starts is None:
+            entries = []
+            # Not handed out, building the index changes nothing
+            for ann in self._anns_by_category[TextBoundAnnotation]:
+                self._indexed_spans_by_ann[ann] = ann.spans
+                for start, end in ann.spans:
+                    entries.append((start, end, ann))
+                    self._max_span_length = max(self._max_span_length,
+                            end - start)
+            entries.sort(key=lambda e: e[0])
+            self._span_entries = entries
+            self._span_starts = [e[0] for e in entries]
+        return self._span_starts, self._span_entries
+
+    def _drop_span_index(self):
+        # The index is rebuilt when next queried
+        self._span_starts = None
+        self._span_entries = None
+        self._indexed_spans_by_ann = {}
+        self._max_span_length = 0
+
+    def _index_spans(self, ann):
+        if (self._span_starts is None
+                or not isinstance(ann, TextBoundAnnotation)):
+            return
+        self._indexed_spans_by_ann[ann] = ann.spans
+        for start, end in ann.spans:
+            i = bisect_right(self._span_starts, start)
+            self._span_starts.insert(i, start)
+            self._span_entries.insert(i, (start, end, ann))
+            self._max_span_length = max(self._max_span_length, end - start)
+
+    def _unindex_spans(self, ann):
+        # Spans are looked up as indexed, they may have changed since
+        for start, end in self._indexed_spans_by_ann.pop(ann, ()):
+            i = bisect_left(self._span_starts, start)
+            while self._span_entries[i] != (start, end, ann):
+                i += 1
+            del self._span_starts[i]
+            del self._span_entries[i]
+
+    def _index_annotation(self, ann):
+        category = ann_category(ann)
+        if category is not None:
+            self._anns_by_category[category][ann] = True
+        self._index_references(ann)
+        self._index_spans(ann)
+
+    def _unindex_annotation(self, ann):
+        category = ann_category(ann)
+        if category is not None:
+            del self._anns_by_category[category][ann]
+        self._unindex_references(ann)
+        self._unindex_spans(ann)
+
+    def _index_references(self, ann):
+        if isinstance(ann, EventAnnotation):
+            self._event_count_by_trigger[ann.trigger] += 1
+            self._indexed_trigger_by_event[ann] = ann.trigger
+
+        soft_deps, hard_deps = ann.get_deps()
+        deps = soft_deps | hard_deps
+        if deps:
+            self._indexed_deps_by_ann[ann] = deps
+            for dep_id in deps:
+                self._referencing_anns_by_id[dep_id].add(ann)
+
+    def _unindex_references(self, ann):
+        try:
+            trigger = self._indexed_trigger_by_event.pop(ann)
+            self._event_count_by_trigger[trigger] -= 1
+            if not self._event_count_by_trigger[trigger]:
+                del self._event_count_by_trigger[trigger]
+        except KeyError:
+            # Not an event
+            pass
+
+        for dep_id in self._indexed_deps_by_ann.pop(ann, ()):
+            referencing = self._referencing_anns_by_id[dep_id]
+            referencing.discard(ann)
+            if not referencing:
+                del self._referencing_anns_by_id[dep_id]
+
+    def get_dependants(self, id):
+        '''
+        Return the annotations that reference the given id, in the order
+        in which they appear.
+        '''
+        return self._ordered(self._referencing_anns_by_id.get(id, ()))
+
+    def get_equivs_containing(self, id):
+        '''
+        Return the equivs that the given id is a member of, in the order in
+        which they appear.
+        '''
+        return [ann for ann in self.get_dependants(id)
+                if isinstance(ann, EquivAnnotation)]
+
+    def _equivs_containing_any(self, ids):
+        # The reference index maps each member to the equivs that it is in
+        equivs = set()
+        for id in ids:
+            for ann in self._referencing_anns_by_id.get(id, ()):
+                if isinstance(ann, EquivAnnotation):
+                    equivs.add(ann)
+        return sorted(equivs, key=self._line_by_ann.__getitem__)
+
+    def _extend_equiv(self, eq_ann, entities):
+        # Append the entities that are not yet members to an equiv, updating
+        # the indices for the new members only rather than re-indexing the
+        # whole equiv through update_annotation(), which would make loading
+        # files with long chains of merged equivs quadratic
+        members = self._indexed_deps_by_ann.setdefault(eq_ann, set())
+        for ent in entities:
+            if ent not in members:
+                eq_ann.entities.append(ent)
+                members.add(ent)
+                self._referencing_anns_by_id[ent].add(eq_ann)
+        if eq_ann in self._source_line_by_ann:
+            self._changed_anns.add(eq_ann)
+        self._unchecked_anns.add(eq_ann)
+        self._modified = True
+
+    def update_annotation(self, ann):
+        '''
+        Re-index an annotation after it has been modified in place. Code
+        that changes the attributes of an annotation held by this object
+        (e.g. the type, spans or arguments) has to call this for the change
+        to be reflected by the category accessors and the dependency lookup
+        and for the annotations to be written back to disk. Changed
+        references and spans that were not reported are re-indexed when
+        the changes are written (see _reindex_stale()), other changes are
+        lost.
+        '''
+        self._unindex_references(ann)
+        self._index_references(ann)
+        self._unindex_spans(ann)
+        self._index_spans(ann)
+        if ann in self._source_line_by_ann:
+            self._changed_anns.add(ann)
+        self._unchecked_anns.add(ann)
+        self._modified = True
+
+    def _reindex_stale(self):
+        # Catch annotations changed in place without update_annotation(),
+        # which would otherwise be left stale in the indices and not be
+        # sanity checked nor written; only what is indexed can be compared,
+        # other changes (e.g. of the type) go unnoticed. Only annotations
+        # handed out since the last write can have changed, a write costs
+        # as much as the lookups of the edit rather than the whole document.
+        handed_out = sorted(self._handed_out_anns,
+                key=self._line_by_ann.__getitem__)
+        self._handed_out_anns = set()
+        stale = []
+        for ann in handed_out:
+            if isinstance(ann, EventAnnotation):
+                if self._indexed_trigger_by_event.get(ann) != ann.trigger:
+                    stale.append(ann)
+                    continue
+            soft_deps, hard_deps = ann.get_deps()
+            if (soft_deps | hard_deps) != self._indexed_deps_by_ann.get(ann,
+                    set()):
+                stale.append(ann)
+            elif (ann in self._indexed_spans_by_ann
+                    and self._indexed_spans_by_ann[ann] != ann.spans):
+                stale.append(ann)
+        for ann in stale:
+            log_info(u'annotation changed without update_annotation(): %s'
+                    % unicode(ann).rstrip('\n'))
+            self.update_annotation(ann)
+
+    def _touch(self):
+        # Update the modification time, once for a whole batch
+        if not self._batch_depth:
+            self.ann_mtime = time()
+
+    @contextmanager
+    def batch(self):
+        '''
+        Group a number of changes to the annotations, such as the output
+        of a tagger, doing the bookkeeping for them once at the end of the
+        (outermost) batch rather than once per change: the span index (see
+        overlapping()) is rebuilt when next queried, the equivs added are
+        merged with the others, the modification time is updated and the
+        annotations are sanity checked. Equivs added inside a batch are
+        not visible until it ends.
+
+        Usage example:
+
+            with ann_obj.batch():
+                for ann in anns:
+                    ann_obj.add_annotation(ann)
+        '''
+        if not self._batch_depth:
+            # Cheaper to rebuild than to insert into for many changes
+            self._drop_span_index()
+        self._batch_depth += 1
+        completed = False
+        try:
+            yield self
+            completed = True
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self._end_batch(completed)
+
+    def _end_batch(self, check):
+        equivs, self._batch_equivs = self._batch_equivs, []
+        for ann in equivs:
+            self.add_annotation(ann)
+        self._touch()
+        if check:
+            self._check_changes()
+
+    def _check_changes(self):
+        # Sanity check the annotations changed since the last check, they
+        # remain unchecked if the check fails
+        if self._unchecked_anns:
+            self._sanity(set(self._unchecked_anns))
+            self._unchecked_anns = set()
+
+    def add_many(self, anns):
+        '''
+        Add the given annotations in a single batch (see batch()).
+        '''
+        if self._read_only:
+            raise AnnotationsIsReadOnlyError(self.get_document())
+        with self.batch():
+            for ann in anns:
+                self.add_annotation(ann)
+
+    def delete_many(self, ids, tracker=None):
+        '''
+        Delete the annotations with the given ids in a single batch (see
+        batch()). Unlike with del_annotation() an annotation can be deleted
+        along with annotations referencing it if these are among the ones
+        deleted. Attributes, equivs, notes and normalizations on the
+        annotations are deleted with them.
+
+        Nothing is deleted if any id is not found (AnnotationNotFoundError)
+        or if any annotation is referenced by one that is neither deleted
+        nor deleted with it (DependingAnnotationDeleteError).
+        '''
+        if self._read_only:
+            raise AnnotationsIsReadOnlyError(self.get_document())
+
+        anns = [self.get_ann_by_id(id) for id in ids]
+        deleted = set(anns)
+        for ann in anns:
+            ann_deps = [d for d in self.get_dependants(ann.id)
+                    if d not in deleted and not isinstance(d, (
+                        AttributeAnnotation, EquivAnnotation,
+                        OnelineCommentAnnotation, NormalizationAnnotation))]
+            if ann_deps:
+                raise DependingAnnotationDeleteError(ann, ann_deps)
+
+        with self.batch():
+            for ann in anns:
+                if ann not in self._line_by_ann:
+                    # Given more than once
+                    continue
+                self._del_modifiers(ann, [d for d in
+                        self.get_dependants(ann.id) if d not in deleted],
+                        tracker)
+                if tracker is not None:
+                    tracker.deletion(ann)
+                self._atomic_del_annotation(ann)
+
     # TODO: getters for other categories of annotations
     #TODO: Remove read and use an internal and external version instead
     def add_annotation(self, ann, read=False):
@@ -496,63 +1194,60 @@ class Annotations(object):
         #TODO: Check read only
         if not read and self._read_only:
             raise AnnotationsIsReadOnlyError(self.get_document())
+        if not read:
+            self._modified = True
 
         # Equivs have to be merged with other equivs
-        try:
-            # Bail as soon as possible for non-equivs
-            ann.entities # TODO: what is this?
+        if isinstance(ann, EquivAnnotation):
+            if self._batch_depth:
+                # Merged at the end of the batch
+                self._batch_equivs.append(ann)
+                return
+
+            # Equivs are kept disjoint, so the equivs to merge with are those
+            # having an entity in common with the new one. Each is merged
+            # into the next in the order in which they appear, the last one
+            # taking the place of all of them.
             merge_cand = ann
-            for eq_ann in self.get_equivs():
-                try:
-                    # Make sure that this Equiv duck quacks
-                    eq_ann.entities
-                except AttributeError, e:
-                    assert False, 'got a non-entity from an entity call'
-
-                # Do we have an entitiy in common with this equiv?
-                for ent in merge_cand.entities:
-                    if ent in eq_ann.entities:
-                        for m_ent in merge_cand.entities:
-                            if m_ent not in eq_ann.entities: 
-                                eq_ann.entities.append(m_ent)
-                        # Don't try to delete ann since it never was added
-                        if merge_cand != ann:
-                            try:
-                                self.del_annotation(merge_cand)
-                            except DependingAnnotationDeleteError:
-                                assert False, ('Equivs lack ids and should '
-                                        'never have dependent annotations')
-                        merge_cand = eq_ann
-                        # We already merged it all, break to the next ann
-                        break
-
-            if merge_cand != ann:
+            for eq_ann in self._equivs_containing_any(ann.entities):
+                self._extend_equiv(eq_ann, merge_cand.entities)
+                # Don't try to delete ann since it never was added. Equivs
+                # lack ids and never have dependent annotations, and are
+                # merged while parsing read-only annotations too.
+                if merge_cand is not ann:
+                    self._atomic_del_annotation(merge_cand)
+                merge_cand = eq_ann
+
+            if merge_cand is not ann:
                 # The proposed annotation was simply merged, no need to add it
-                # Update the modification time
-                from time import time
-                self.ann_mtime = time()
+                self._touch()
                 return
 
-        except AttributeError:
-            #XXX: This can catch a ton more than we want to! Ugly!
-            # It was not an Equiv, skip along
-            pass
-
         # Register the object id
         try:
             self._ann_by_id[ann.id] = ann
-            pre, num = annotation_id_prefix(ann.id), annotation_id_number(ann.id)
-            self._max_id_num_by_prefix[pre] = max(num, self._max_id_num_by_prefix[pre])
         except AttributeError:
             # The annotation simply lacked an id which is fine
             pass
+        else:
+            # Read-only views never allocate ids, see AnnotationsView
+            if self._allocates_ids:
+                id_match = ANN_ID_RE.match(ann.id)
+                if id_match is None:
+                    raise InvalidIdError(ann.id)
+                pre, num, suf = id_match.groups()
+                num = int(num)
+                if num > self._max_id_num_by_prefix[(pre, suf)]:
+                    self._max_id_num_by_prefix[(pre, suf)] = num
 
         # Add the annotation as the last line
         self._lines.append(ann)
-        self._line_by_ann[ann] = len(self) - 1
-        # Update the modification time
-        from time import time
-        self.ann_mtime = time()
+        self._line_by_ann[ann] = len(self._lines) - 1
+        self._index_annotation(ann)
+        if not read:
+            self._added_anns.add(ann)
+            self._unchecked_anns.add(ann)
+            self._touch()
 
     def del_annotation(self, ann, tracker=None):
         #TODO: Check read only
@@ -571,18 +1266,11 @@ class Annotations(object):
             if tracker is not None:
                 tracker.deletion(ann)
             self._atomic_del_annotation(ann)
-            # Update the modification time
-            from time import time
-            self.ann_mtime = time()
+            self._touch()
             return
 
         # collect annotations dependending on ann
-        ann_deps = []
-
-        for other_ann in self:
-            soft_deps, hard_deps = other_ann.get_deps()
-            if unicode(ann.id) in soft_deps | hard_deps:
-                ann_deps.append(other_ann)
+        ann_deps = self.get_dependants(unicode(ann.id))
               
         # If all depending are AttributeAnnotations or EquivAnnotations,
         # delete all modifiers recursively (without confirmation) and remove
@@ -596,39 +1284,7 @@ class Annotations(object):
             and not isinstance(d, OnelineCommentAnnotation)
             and not isinstance(d, NormalizationAnnotation)
             ))):
-
-            for d in ann_deps:
-                if isinstance(d, AttributeAnnotation):
-                    if tracker is not None:
-                        tracker.deletion(d)
-                    self._atomic_del_annotation(d)
-                elif isinstance(d, EquivAnnotation):
-                    if len(d.entities) <= 2:
-                        # An equiv has to have more than one member
-                        self._atomic_del_annotation(d)
-                        if tracker is not None:
-                            tracker.deletion(d)
-                    else:
-                        if tracker is not None:
-                            before = unicode(d)
-                        d.entities.remove(unicode(ann.id))
-                        if tracker is not None:
-                            tracker.change(before, d)
-                elif isinstance(d, OnelineCommentAnnotation):
-                    #TODO: Can't anything refer to comments?
-                    self._atomic_del_annotation(d)
-                    if tracker is not None:
-                        tracker.deletion(d)
-                elif isinstance(d, NormalizationAnnotation):
-                    # Nothing should be able to reference normalizations
-                    self._atomic_del_annotation(d)
-                    if tracker is not None:
-                        tracker.deletion(d)
-                else:
-                    # all types we allow to be deleted along with
-                    # annotations they depend on should have been
-                    # covered above.
-                    assert False, "INTERNAL ERROR"
+            self._del_modifiers(ann, ann_deps, tracker)
             ann_deps = []
             
         if ann_deps:
@@ -638,40 +1294,91 @@ class Annotations(object):
             tracker.deletion(ann)
         self._atomic_del_annotation(ann)
 
+    def _del_modifiers(self, ann, ann_deps, tracker):
+        # Delete the attributes, notes and normalizations on an annotation
+        # and remove it from its equivs, ann_deps being the annotations
+        # depending on it
+        for d in ann_deps:
+            if isinstance(d, AttributeAnnotation):
+                if tracker is not None:
+                    tracker.deletion(d)
+                self._atomic_del_annotation(d)
+            elif isinstance(d, EquivAnnotation):
+                if len(d.entities) <= 2:
+                    # An equiv has to have more than one member
+                    self._atomic_del_annotation(d)
+                    if tracker is not None:
+                        tracker.deletion(d)
+                else:
+                    if tracker is not None:
+                        before = unicode(d)
+                    d.entities.remove(unicode(ann.id))
+                    self.update_annotation(d)
+                    if tracker is not None:
+                        tracker.change(before, d)
+            elif isinstance(d, OnelineCommentAnnotation):
+                #TODO: Can't anything refer to comments?
+                self._atomic_del_annotation(d)
+                if tracker is not None:
+                    tracker.deletion(d)
+            elif isinstance(d, NormalizationAnnotation):
+                # Nothing should be able to reference normalizations
+                self._atomic_del_annotation(d)
+                if tracker is not None:
+                    tracker.deletion(d)
+            else:
+                # all types we allow to be deleted along with
+                # annotations they depend on should have been
+                # covered above.
+                assert False, "INTERNAL ERROR"
+
     def _atomic_del_annotation(self, ann):
         #TODO: DOC
         # Erase the ann by id shorthand
         try:
             del self._ann_by_id[ann.id]
+            if REUSE_ANNOTATION_IDS:
+                pre, num, suf = ANN_ID_RE.match(ann.id).groups()
+                num = int(num)
+                if num < self._next_id_num_by_prefix.get((pre, suf), 1):
+                    heappush(self._free_id_nums_by_prefix[(pre, suf)], num)
         except AttributeError:
             # So, we did not have id to erase in the first place
             pass
 
-        ann_line = self._line_by_ann[ann]
-        # Erase the main annotation
-        del self._lines[ann_line]
-        # Erase the ann by line shorthand
-        del self._line_by_ann[ann]
-        # Update the line shorthand of every annotation after this one
-        # to reflect the new self._lines
-        for l_num in xrange(ann_line, len(self)):
-            self._line_by_ann[self[l_num]] = l_num
-        # Update the modification time
-        from time import time
-        self.ann_mtime = time()
+        self._unindex_annotation(ann)
+
+        # Leave a tombstone in place of the annotation rather than shifting
+        # every following line, the lines are compacted lazily
+        self._lines[self._line_by_ann.pop(ann)] = None
+        self._tombstone_count += 1
+        self._modified = True
+        self._added_anns.discard(ann)
+        self._changed_anns.discard(ann)
+        self._unchecked_anns.discard(ann)
+        self._handed_out_anns.discard(ann)
+        source_line = self._source_line_by_ann.pop(ann, None)
+        if source_line is not None:
+            self._deleted_source_lines.append(source_line)
+        self._touch()
     
     def get_ann_by_id(self, id):
         #TODO: DOC
         try:
-            return self._ann_by_id[id]
+            ann = self._ann_by_id[id]
         except KeyError:
             raise AnnotationNotFoundError(id)
+        if not self._read_only:
+            self._handed_out_anns.add(ann)
+        return ann
 
     def get_new_id(self, prefix, suffix=None):
         '''
         Return a new valid unique id for this annotation file for the given
-        prefix. No ids are re-used for traceability over time for annotations,
-        but this only holds for the lifetime of the annotation object. If the
+        prefix. By default this is the lowest free id, which may be that of
+        an annotation deleted earlier. If REUSE_ANNOTATION_IDS is unset no
+        ids are re-used for traceability over time for annotations, but this
+        only holds for the lifetime of the annotation object. If the
         annotation file is parsed once again into an annotation object the
         next assigned id will be the maximum seen for a given prefix plus one
         which could have been deleted during a previous annotation session.
@@ -679,32 +1386,70 @@ class Annotations(object):
         Warning: get_new_id('T') == get_new_id('T')
         Just calling this method does not reserve the id, you need to
         add the annotation with the returned id to the annotation object in
-        order to reserve it.
+        order to reserve it, or use reserve_ids().
 
         Argument(s):
-        id_pre - an annotation prefix on the format [A-Za-z]+
+        prefix - an annotation prefix on the format [A-Za-z]+
+        suffix - an optional suffix for the id
 
         Returns:
         An id that is guaranteed to be unique for the lifetime of the
         annotation.
         '''
-        #XXX: We have changed this one radically!
-        #XXX: Stupid and linear
         if suffix is None:
             suffix = ''
-        #XXX: Arbitrary constant!
-        for suggestion in (prefix + unicode(i) + suffix for i in xrange(1, 2**15)):
-            # This is getting more complicated by the minute, two checks since
-            # the developers no longer know when it is an id or string.
-            if suggestion not in self._ann_by_id:
-                return suggestion
+        return self._allocate_id(prefix, suffix, False)
+
+    def reserve_ids(self, prefix, count, suffix=None):
+        '''
+        Reserve count new ids for the given prefix (and suffix), for adding
+        large numbers of annotations at once. Unlike the id returned by
+        get_new_id() the reserved ids are not returned again by get_new_id(),
+        even before annotations with them have been added.
+
+        Returns:
+        A list of the reserved ids.
+        '''
+        if suffix is None:
+            suffix = ''
+        return [self._allocate_id(prefix, suffix, True)
+                for _ in xrange(count)]
+
+    def _allocate_id(self, prefix, suffix, reserve):
+        # Allocation only ever moves forward from the highest id used (or
+        # the lowest one not known to be used) and ids freed below that are
+        # kept in a heap, making the cost of allocation constant amortized
+        key = (prefix, suffix)
+        if REUSE_ANNOTATION_IDS:
+            free_nums = self._free_id_nums_by_prefix.get(key)
+            while free_nums:
+                suggestion = prefix + unicode(free_nums[0]) + suffix
+                if suggestion not in self._ann_by_id:
+                    if reserve:
+                        heappop(free_nums)
+                    return suggestion
+                # Taken again since it was freed
+                heappop(free_nums)
+            num = self._next_id_num_by_prefix.get(key, 1)
+        else:
+            num = self._max_id_num_by_prefix[key] + 1
+
+        # Only ids changed in place can be above the maximum
+        while prefix + unicode(num) + suffix in self._ann_by_id:
+            num += 1
+
+        if REUSE_ANNOTATION_IDS:
+            self._next_id_num_by_prefix[key] = num + 1 if reserve else num
+        elif reserve:
+            self._max_id_num_by_prefix[key] = num
+        return prefix + unicode(num) + suffix
 
     # XXX: This syntax is subject to change
     def _parse_attribute_annotation(self, id, data, data_tail, input_file_path):
-        match = re_match(r'(.+?) (.+?) (.+?)$', data)
+        match = ATTRIBUTE_DATA_RE.match(data)
         if match is None:
             # Is it an old format without value?
-            match = re_match(r'(.+?) (.+?)$', data)
+            match = ATTRIBUTE_DATA_NO_VALUE_RE.match(data)
 
             if match is None:
                 raise IdedAnnotationLineSyntaxError(id, self.ann_line,
@@ -716,9 +1461,7 @@ class Annotations(object):
             _type, target, value = match.groups()
 
         # Verify that the ID is indeed valid
-        try:
-            annotation_id_number(target)
-        except InvalidIdError:
+        if ANN_ID_RE.match(target) is None:
             raise IdedAnnotationLineSyntaxError(id, self.ann_line,
                     self.ann_line_num + 1, input_file_path)
 
@@ -726,10 +1469,8 @@ class Annotations(object):
 
     def _parse_event_annotation(self, id, data, data_tail, input_file_path):
         #XXX: A bit nasty, we require a single space
-        try:
-            type_delim = data.index(' ')
-            type_trigger, type_trigger_tail = (data[:type_delim], data[type_delim:])
-        except ValueError:
+        type_trigger, type_delim, type_trigger_tail = data.partition(' ')
+        if not type_delim:
             type_trigger = data.rstrip('\r\n')
             type_trigger_tail = None
 
@@ -749,10 +1490,8 @@ class Annotations(object):
 
 
     def _parse_relation_annotation(self, id, data, data_tail, input_file_path):
-        try:
-            type_delim = data.index(' ')
-            type, type_tail = (data[:type_delim], data[type_delim:])
-        except ValueError:
+        type, type_delim, type_tail = data.partition(' ')
+        if not type_delim:
             # cannot have a relation with just a type (contra event)
             raise IdedAnnotationLineSyntaxError(id, self.ann_line, self.ann_line_num+1, input_file_path)
             
@@ -824,14 +1563,14 @@ class Annotations(object):
     def _parse_normalization_annotation(self, _id, data, data_tail, input_file_path):
         # special-case processing for BioNLP ST 2013 variant of
         # normalization format
-        if BIONLP_ST_2013_COMPATIBILITY:
+        if BIONLP_ST_2013_COMPATIBILITY and u'Referent:' in data:
             for r, s in BIONLP_ST_2013_NORMALIZATION_RES:
                 d = r.sub(s, data, count=1)
                 if d != data:
                     data = d
                     break
             
-        match = re_match(r'(\S+) (\S+) (\S+?):(\S+)', data)
+        match = NORMALIZATION_DATA_RE.match(data)
         if match is None:
             raise IdedAnnotationLineSyntaxError(_id, self.ann_line, self.ann_line_num + 1, input_file_path)
         _type, target, refdb, refid = match.groups()
@@ -848,80 +1587,339 @@ class Annotations(object):
     def _parse_ann_file(self):
         self.ann_line_num = -1
         for input_file_path in self._input_files:
-            with open_textfile(input_file_path) as input_file:
-                #for self.ann_line_num, self.ann_line in enumerate(self._file_input):
-                for self.ann_line in input_file:
-                    self.ann_line_num += 1
-                    try:
-                        # ID processing
-                        try:
-                            id, id_tail = self.ann_line.split('\t', 1)
-                        except ValueError:
-                            raise AnnotationLineSyntaxError(self.ann_line, self.ann_line_num+1, input_file_path)
-
-                        pre = annotation_id_prefix(id)
-
-                        if id in self._ann_by_id and pre != '*':
-                            raise DuplicateAnnotationIdError(id,
-                                    self.ann_line, self.ann_line_num+1,
-                                    input_file_path)
-
-                        # if the ID is not valid, need to fail with
-                        # AnnotationLineSyntaxError (not
-                        # IdedAnnotationLineSyntaxError).
-                        if not is_valid_id(id):
-                            raise AnnotationLineSyntaxError(self.ann_line, self.ann_line_num+1, input_file_path)
-
-                        # Cases for lines
-                        try:
-                            data_delim = id_tail.index('\t')
-                            data, data_tail = (id_tail[:data_delim],
-                                    id_tail[data_delim:])
-                        except ValueError:
-                            data = id_tail
-                            # No tail at all, although it should have a \t
-                            data_tail = ''
-
-                        new_ann = None
-
-                        #log_info('Will evaluate prefix: ' + pre)
-
-                        assert len(pre) >= 1, "INTERNAL ERROR"
-                        pre_first = pre[0]
-
-                        try:
-                            parse_func = self._parse_function_by_id_prefix[pre_first]
-                            new_ann = parse_func(id, data, data_tail, input_file_path)
-                        except KeyError:
-                            raise IdedAnnotationLineSyntaxError(id, self.ann_line, self.ann_line_num+1, input_file_path)
-
-                        assert new_ann is not None, "INTERNAL ERROR"
-                        self.add_annotation(new_ann, read=True)
-                    except IdedAnnotationLineSyntaxError, e:
-                        # Could parse an ID but not the whole line; add UnparsedIdedAnnotation
-                        self.add_annotation(UnparsedIdedAnnotation(e.id,
-                            e.line, source_id=e.filepath), read=True)
-                        self.failed_lines.append(e.line_num - 1)
-
-                    except AnnotationLineSyntaxError, e:
-                        # We could not parse even an ID on the line, just add it as an unknown annotation
-                        self.add_annotation(UnknownAnnotation(e.line,
-                            source_id=e.filepath), read=True)
-                        # NOTE: For access we start at line 0, not 1 as in here
-                        self.failed_lines.append(e.line_num - 1)
+            # Splits the same way as iterating over the file would, but
+            # without the considerable per line overhead of codecs
+            ann_lines = self._read_input_file(input_file_path).splitlines(True)
+            if self._journal_path is not None:
+                self._parsed_base_identity = (
+                        self._journal_base_identity())
+                ann_lines = self._replay_journal(ann_lines)
+            #for self.ann_line_num, self.ann_line in enumerate(self._file_input):
+            for self.ann_line in ann_lines:
+                self.ann_line_num += 1
+                new_ann = self._parse_line(input_file_path)
+                self.add_annotation(new_ann, read=True)
+                # Remember the parsed lines if edits are to be journaled
+                if self._journaling:
+                    self._source_line_by_ann[new_ann] = (
+                            self.ann_line.rstrip(u'\r\n'))
+
+    def _parse_line(self, input_file_path):
+        # Parse self.ann_line, recording it as failed if it can not be
+        # parsed (entirely). Syntax errors are rare, so the common case is
+        # handled without raising any exceptions
+        try:
+            # ID processing
+            id, id_delim, id_tail = self.ann_line.partition('\t')
+            if not id_delim:
+                raise AnnotationLineSyntaxError(self.ann_line, self.ann_line_num+1, input_file_path)
+
+            # if the ID is not valid, need to fail with
+            # AnnotationLineSyntaxError (not
+            # IdedAnnotationLineSyntaxError).
+            if id == '*':
+                pre_first = '*'
+            elif ANN_ID_RE.match(id) is not None:
+                if id in self._ann_by_id:
+                    raise DuplicateAnnotationIdError(id,
+                            self.ann_line, self.ann_line_num+1,
+                            input_file_path)
+                pre_first = id[0]
+            else:
+                raise AnnotationLineSyntaxError(self.ann_line, self.ann_line_num+1, input_file_path)
+
+            # Cases for lines
+            data, data_delim, data_tail = id_tail.partition('\t')
+            if data_delim:
+                data_tail = data_delim + data_tail
+            # else no tail at all, although it should have a \t
+
+            #log_info('Will evaluate prefix: ' + pre)
+
+            parse_func = self._parse_function_by_id_prefix.get(
+                    pre_first)
+            if parse_func is None:
+                raise IdedAnnotationLineSyntaxError(id, self.ann_line, self.ann_line_num+1, input_file_path)
+            new_ann = parse_func(id, data, data_tail, input_file_path)
+
+            assert new_ann is not None, "INTERNAL ERROR"
+        except IdedAnnotationLineSyntaxError, e:
+            # Could parse an ID but not the whole line; add UnparsedIdedAnnotation
+            new_ann = UnparsedIdedAnnotation(e.id, e.line,
+                    source_id=e.filepath)
+            self.failed_lines.append(e.line_num - 1)
+
+        except AnnotationLineSyntaxError, e:
+            # We could not parse even an ID on the line, just add it as an unknown annotation
+            new_ann = UnknownAnnotation(e.line,
+                    source_id=e.filepath)
+            # NOTE: For access we start at line 0, not 1 as in here
+            self.failed_lines.append(e.line_num - 1)
+
+        return new_ann
+
+    def _parse_cache_path(self):
+        try:
+            from config import WORK_DIR
+        except ImportError:
+            return None
+        from hashlib import sha1
+        from os.path import abspath
+        doc_key = u'%s\t%s' % (self.__class__.__name__,
+                abspath(self._document))
+        return path_join(WORK_DIR, PARSE_CACHE_DIR,
+                sha1(doc_key.encode('utf-8')).hexdigest() + '.pickle')
+
+    def _parse_cache_sources(self):
+        # Files that the parsed annotations depend upon
+        if self._packed is not None:
+            return [self._packed.pack.path]
+        sources = list(self._input_files)
+        if self._journal_path is not None:
+            sources.append(self._journal_path)
+        return sources
+
+    def _parse_cache_key(self):
+        from os import stat
+        key = [PARSE_CACHE_VERSION, BIONLP_ST_2013_COMPATIBILITY,
+                self._journaling]
+        for path in self._parse_cache_sources():
+            try:
+                st = stat(path)
+                key.append((path, st.st_ino, st.st_size, st.st_mtime))
+            except OSError:
+                key.append((path, None))
+        return key
+
+    def _load_parse_cache(self):
+        '''
+        Restore the parsed annotations from the parse cache, returns False
+        if there is no cached parse for the current annotation files.
+        '''
+        if not ANNOTATION_PARSE_CACHE:
+            return False
+        cache_path = self._parse_cache_path()
+        if cache_path is None:
+            return False
+
+        from cPickle import load as pickle_load
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                if pickle_load(cache_file) != self._parse_cache_source_key:
+                    return False
+                with _gc_paused():
+                    state = pickle_load(cache_file)
+        except IOError:
+            # Most likely not cached yet
+            return False
+        except Exception, e:
+            log_info('ignoring broken parse cache %s: %s' % (cache_path, e))
+            return False
+
+        self._max_id_num_by_prefix.update(state.pop('_max_id_num_by_prefix'))
+        self.__dict__.update(state)
+        self._index_lines()
+        return True
+
+    def _index_lines(self):
+        # Build the lookups for the annotations in self._lines, which may
+        # not contain tombstones
+        for l_num, ann in enumerate(self._lines):
+            self._line_by_ann[ann] = l_num
+            try:
+                self._ann_by_id[ann.id] = ann
+            except AttributeError:
+                pass
+            self._index_annotation(ann)
+
+    def _store_parse_cache(self):
+        if (not ANNOTATION_PARSE_CACHE or self.failed_lines
+                or not self._parse_cacheable):
+            return
+        cache_path = self._parse_cache_path()
+        if cache_path is None:
+            return
+
+        from cPickle import dump as pickle_dump, HIGHEST_PROTOCOL
+        from os import makedirs
+        from os.path import isdir
+        from tempfile import mkstemp
+
+        self._compact()
+        state = dict((a, getattr(self, a)) for a in PARSE_CACHE_ATTRS)
+        # The default factory of the defaultdict can't be pickled
+        state['_max_id_num_by_prefix'] = dict(self._max_id_num_by_prefix)
+
+        tmp_fname = None
+        try:
+            cache_dir = dirname(cache_path)
+            if not isdir(cache_dir):
+                makedirs(cache_dir)
+            tmp_fh, tmp_fname = mkstemp(dir=cache_dir)
+            os_close(tmp_fh)
+            with open(tmp_fname, 'wb') as tmp_file:
+                pickle_dump(self._parse_cache_source_key, tmp_file,
+                        HIGHEST_PROTOCOL)
+                with _gc_paused():
+                    pickle_dump(state, tmp_file, HIGHEST_PROTOCOL)
+            rename(tmp_fname, cache_path)
+            # Those of documents since renamed or deleted would pile up
+            prune_cache_dir(cache_dir, ANNOTATION_PARSE_CACHE_MAX_AGE)
+        except Exception, e:
+            # The cache is only an optimisation, never fail because of it
+            log_info('failed to write parse cache %s: %s' % (cache_path, e))
+            if tmp_fname is not None:
+                try:
+                    remove(tmp_fname)
+                except OSError:
+                    pass
+
+    def _memory_cache_key(self):
+        from os.path import abspath
+        return (self.__class__.__name__, abspath(self._document),
+                self._read_only)
+
+    def _checkout_memory_cache(self):
+        '''
+        Take over the state of the annotations as left by an earlier
+        request of this process (see _checkin_memory_cache()), returns
+        False if it is not cached for the current annotation files.
+        '''
+        if ANNOTATION_MEMORY_CACHE_DOCUMENTS <= 0:
+            return False
+        state = _memory_cache.checkout(self._memory_cache_key(),
+                self._parse_cache_source_key)
+        if state is None:
+            return False
+        self.__dict__.update(state)
+        return True
+
+    def _checkin_memory_cache(self):
+        # Hand the state of the annotations, which has to match the files
+        # identified by the parse cache key, over to later requests. The
+        # object must not be used after this.
+        if (ANNOTATION_MEMORY_CACHE_DOCUMENTS <= 0 or self._modified
+                or self.failed_lines or not self._parse_cacheable):
+            return
+        # The key holds (path, inode, size, mtime) for each existing file
+        file_bytes = sum(source[2] for source in self._parse_cache_source_key
+                if isinstance(source, tuple) and len(source) == 4)
+        state = dict(self.__dict__)
+        # Bound to this object
+        del state['_parse_function_by_id_prefix']
+        _memory_cache.checkin(self._memory_cache_key(),
+                self._parse_cache_source_key,
+                file_bytes * MEMORY_CACHE_BYTES_PER_FILE_BYTE, state)
+
+    def _journal_base_identity(self):
+        # The annotation file is only replaced by renaming a new file onto
+        # it, so its inode and size identify the version of the file that a
+        # journal was started for. Journaling does not change either.
+        from os import stat
+        st = stat(self._input_files[0])
+        return u'%d\t%d' % (st.st_ino, st.st_size)
+
+    def _replay_journal(self, ann_lines):
+        '''
+        Apply the records of the edit journal of the annotation file to the
+        given lines of the file and return the resulting lines.
+
+        A journal starts with a header line identifying the annotation file
+        that it applies to, followed by records of the form "+\tLINE"
+        (append LINE), "-\tLINE" (remove LINE) or "<\tOLD" directly
+        followed by ">\tNEW" (replace OLD by NEW).
+        '''
+        from os.path import isfile
+
+        if not isfile(self._journal_path):
+            return ann_lines
+
+        with open_textfile(self._journal_path) as journal_file:
+            records = journal_file.readlines()
+
+        base_identity = self._parsed_base_identity
+        try:
+            header_fields = records[0].rstrip(u'\n').split(u'\t')
+            if (header_fields[0] != JOURNAL_HEADER
+                    or u'\t'.join(header_fields[1:3]) != base_identity):
+                raise ValueError
+            self._journal_created = float(header_fields[3])
+        except (IndexError, ValueError):
+            # Either empty, broken or written for a file that has since been
+            # replaced, the edits are then already in the annotation file
+            log_info('ignoring stale annotation journal %s' % (
+                self._journal_path, ))
+            return ann_lines
+        self._journal_base = base_identity
+
+        lines = list(ann_lines)
+        line_nums_by_line = defaultdict(list)
+        for line_num, line in enumerate(lines):
+            line_nums_by_line[line.rstrip(u'\r\n')].append(line_num)
+
+        replaced = None
+        for record in records[1:]:
+            if not record.endswith(u'\n'):
+                # Interrupted write of the last record
+                break
+            op, _, line = record[:-1].partition(u'\t')
+            if op == u'+':
+                line_nums_by_line[line].append(len(lines))
+                lines.append(line + u'\n')
+            elif op == u'-' or op == u'<':
+                line_nums = line_nums_by_line.get(line)
+                if not line_nums:
+                    log_info('annotation journal %s: no line "%s"' % (
+                        self._journal_path, line, ))
+                    replaced = None
+                    continue
+                line_num = line_nums.pop(0)
+                if op == u'-':
+                    lines[line_num] = None
+                else:
+                    replaced = line_num
+            elif op == u'>' and replaced is not None:
+                line_nums_by_line[line].append(replaced)
+                lines[replaced] = line + u'\n'
+                replaced = None
+        return [l for l in lines if l is not None]
 
     def __str__(self):
-        s = u'\n'.join(unicode(ann).rstrip(u'\r\n') for ann in self)
+        s = u'\n'.join(unicode(ann).rstrip(u'\r\n')
+                for ann in self._iter_lines())
         if not s:
             return u''
         else:
             return s if s[-1] == u'\n' else s + u'\n'
 
-    def __it__(self):
-        for ann in self._lines:
+    def _compact(self):
+        # Drop the tombstones left behind by deletions and renumber lines
+        if self._tombstone_count:
+            self._lines = [ann for ann in self._lines if ann is not None]
+            for l_num, ann in enumerate(self._lines):
+                self._line_by_ann[ann] = l_num
+            self._tombstone_count = 0
+
+    def __iter__(self):
+        for ann in self._iter_lines():
+            if not self._read_only:
+                self._handed_out_anns.add(ann)
             yield ann
 
+    def _iter_lines(self):
+        # Index-based, annotations added while iterating are included and
+        # deletions while iterating do not cause any to be skipped. Unlike
+        # iterating over the object, the annotations are not handed out.
+        l_num = 0
+        while l_num < len(self._lines):
+            ann = self._lines[l_num]
+            if ann is not None:
+                yield ann
+            l_num += 1
+
     def __getitem__(self, val):
+        # Positional access has to see the lines without tombstones
+        self._compact()
         try:
             # First, try to use it as a slice object
             return self._lines[val.start, val.stop, val.step]
@@ -930,76 +1928,186 @@ class Annotations(object):
             return self._lines[val]
 
     def __len__(self):
-        return len(self._lines)
+        return len(self._lines) - self._tombstone_count
 
     def __enter__(self):
         # No need to do any handling here, the constructor handles that
         return self
     
+    def _journal_records(self):
+        # Records for the changes since the annotations were parsed, the
+        # added annotations all follow the parsed ones
+        records = [u'-\t' + line for line in self._deleted_source_lines]
+        for ann in sorted(self._changed_anns,
+                key=self._line_by_ann.__getitem__):
+            line = unicode(ann).rstrip(u'\r\n')
+            if line != self._source_line_by_ann[ann]:
+                records.append(u'<\t' + self._source_line_by_ann[ann])
+                records.append(u'>\t' + line)
+        for ann in sorted(self._added_anns,
+                key=self._line_by_ann.__getitem__):
+            records.append(u'+\t' + unicode(ann).rstrip(u'\r\n'))
+        return records
+
+    def _write_journal(self):
+        '''
+        Append the changes to the edit journal of the annotation file.
+        Returns False if the changes have to be written by rewriting the
+        annotation file instead, either since the journal is due to be
+        compacted or since the annotation file was replaced after parsing.
+        '''
+        from os.path import isfile
+
+        base_identity = self._journal_base_identity()
+        if isfile(self._journal_path):
+            if (self._journal_base != base_identity
+                    or time() - self._journal_created
+                        > ANNOTATION_JOURNAL_MAX_AGE
+                    or getsize(self._journal_path)
+                        > ANNOTATION_JOURNAL_MAX_SIZE):
+                return False
+            # Never append to a record left incomplete by a failed write
+            with open(self._journal_path, 'rb') as journal_file:
+                journal_file.seek(-1, 2)
+                if journal_file.read(1) != '\n':
+                    return False
+            header = []
+        elif self._journal_base is None:
+            # Start a new journal for the file as it was parsed, unless it
+            # was replaced in the meantime
+            if base_identity != self._parsed_base_identity:
+                return False
+            self._journal_base = base_identity
+            self._journal_created = time()
+            header = [u'\t'.join((JOURNAL_HEADER, base_identity,
+                repr(self._journal_created)))]
+        else:
+            # The journal was removed by compaction after parsing
+            return False
+
+        with open_textfile(self._journal_path, 'a') as journal_file:
+            journal_file.write(u''.join(l + u'\n'
+                for l in header + self._journal_records()))
+            journal_file.flush()
+            fsync(journal_file.fileno())
+        # The modification time of the annotation file is used as the time
+        # of the last change to the document
+        utime(self._input_files[0], None)
+
+        for ann in self._changed_anns | self._added_anns:
+            self._source_line_by_ann[ann] = unicode(ann).rstrip(u'\r\n')
+        self._changed_anns.clear()
+        self._added_anns.clear()
+        self._deleted_source_lines = []
+        return True
+
+    def _write_ann_file(self):
+        # Replace the annotation file with the serialized annotations
+        out_str = unicode(self)
+
+        from tempfile import mkstemp
+        # The temporary file has to be on the same file system as
+        # the annotation file for the rename to be atomic, the dot
+        # prefix keeps it hidden from the collection listings
+        tmp_fh, tmp_fname = mkstemp(prefix='.', suffix='.ann',
+                dir=dirname(self._input_files[0]))
+        os_close(tmp_fh)
+        try:
+            with open_textfile(tmp_fname, 'w') as tmp_file:
+                tmp_file.write(out_str)
+                tmp_file.flush()
+                fsync(tmp_file.fileno())
+
+            if VERIFY_ANNOTATION_WRITES:
+                try:
+                    Annotations(tmp_fname, read_only=True)
+                except Exception, e:
+                    Messager.error('ERROR writing changes: generated annotations cannot be read back in!\n(This is almost certainly a system error, please contact the developers.)\n%s' % e, -1)
+                    raise
+
+            # mkstemp creates files only readable by their owner,
+            # keep the permissions of the file that we replace
+            from shutil import copymode
+            copymode(self._input_files[0], tmp_fname)
+            # Move the temporary file onto the old file
+            rename(tmp_fname, self._input_files[0])
+        except:
+            try:
+                remove(tmp_fname)
+            except Exception, e:
+                Messager.error("Error removing temporary file '%s'" % tmp_fname)
+            raise
+
+        # The edits in the journal, if any, are now part of the annotation
+        # file, which the journal no longer applies to since it was replaced
+        from os.path import isfile
+        if self._journal_path is not None and isfile(self._journal_path):
+            remove(self._journal_path)
+        self._journal_base = None
+        if self._journaling:
+            self._parsed_base_identity = self._journal_base_identity()
+            self._source_line_by_ann = dict((ann, unicode(ann).rstrip(u'\r\n'))
+                    for ann in self._iter_lines())
+        self._changed_anns.clear()
+        self._added_anns.clear()
+        self._deleted_source_lines = []
+
+        # As a matter of convention we adjust the modified
+        # time of the data dir when we write to it. This
+        # helps us to make back-ups
+        now = time()
+        #XXX: Disabled for now!
+        #utime(DATA_DIR, (now, now))
+
     def __exit__(self, type, value, traceback):
         #self._file_input.close()
+        if type is not None:
+            # Never write changes that failed half-way (or failed to pass
+            # the sanity check), nor keep the objects left by them
+            return
+
         if not self._read_only:
             assert len(self._input_files) == 1, 'more than one valid outfile'
 
-            # We are hitting the disk a lot more than we should here, what we
-            # should have is a modification flag in the object but we can't
-            # due to how we change the annotations.
-            
-            out_str = unicode(self)
-            with open_textfile(self._input_files[0], 'r') as old_ann_file:
-                old_str = old_ann_file.read()
-
+            self._reindex_stale()
             # Was it changed?
-            if out_str == old_str:
-                # Then just return
-                return
+            if self._modified:
+                self._write_changes()
 
-            from config import WORK_DIR
-            
-            # Protect the write so we don't corrupt the file
-            with file_lock(path_join(WORK_DIR,
-                    str(hash(self._input_files[0].replace('/', '_')))
-                        + '.lock')
-                    ) as lock_file:
-                #from tempfile import NamedTemporaryFile
-                from tempfile import mkstemp
-                # TODO: XXX: Is copyfile really atomic?
-                from shutil import copyfile
-                # XXX: NamedTemporaryFile only supports encoding for Python 3
-                #       so we hack around it.
-                #with NamedTemporaryFile('w', suffix='.ann') as tmp_file:
-                # Grab the filename, but discard the handle
-                tmp_fh, tmp_fname = mkstemp(suffix='.ann')
-                os_close(tmp_fh)
-                try:
-                    with open_textfile(tmp_fname, 'w') as tmp_file:
-                        #XXX: Temporary hack to make sure we don't write corrupted
-                        #       files, but the client will already have the version
-                        #       at this stage leading to potential problems upon
-                        #       the next change to the file.
-                        tmp_file.write(out_str)
-                        tmp_file.flush()
-
-                        try:
-                            with Annotations(tmp_file.name) as ann:
-                                # Move the temporary file onto the old file
-                                copyfile(tmp_file.name, self._input_files[0])
-                                # As a matter of convention we adjust the modified
-                                # time of the data dir when we write to it. This
-                                # helps us to make back-ups
-                                now = time()
-                                #XXX: Disabled for now!
-                                #utime(DATA_DIR, (now, now))
-                        except Exception, e:
-                            Messager.error('ERROR writing changes: generated annotations cannot be read back in!\n(This is almost certainly a system error, please contact the developers.)\n%s' % e, -1)
-                            raise
-                finally:
-                    try:
-                        from os import remove
-                        remove(tmp_fname)
-                    except Exception, e:
-                        Messager.error("Error removing temporary file '%s'" % tmp_fname)
-            return
+        self._checkin_memory_cache()
+
+    def flush(self):
+        '''
+        Write any changes to the annotations now rather than on leaving
+        the with block, e.g. to describe the files as written.
+        '''
+        if not self._read_only:
+            self._reindex_stale()
+        if not self._read_only and self._modified:
+            assert len(self._input_files) == 1, 'more than one valid outfile'
+            self._write_changes()
+
+    def _write_changes(self):
+        # Never write annotations that would fail to load
+        self._check_changes()
+
+        if self._packed is not None:
+            # Copy on write, the pack itself is never written to
+            self._packed.unpack()
+            self._packed = None
+
+        from config import WORK_DIR
+
+        # Protect the write so we don't corrupt the file
+        with file_lock(path_join(WORK_DIR,
+                str(hash(self._input_files[0].replace('/', '_')))
+                    + '.lock')
+                ) as lock_file:
+            if not (self._journaling and self._write_journal()):
+                self._write_ann_file()
+            self._modified = False
+            # The annotations now match the files as written
+            self._parse_cache_source_key = self._parse_cache_key()
 
     def __in__(self, other):
         #XXX: You should do this one!
@@ -1013,21 +2121,39 @@ class TextAnnotations(Annotations):
     the correctness of text-bound annotations against the text.
     """
     def __init__(self, document, read_only=False):
-        # First read the text or the Annotations can't verify the annotations
-        if document.endswith('.txt'):
-            textfile_path = document
-        else:
-            # Do we have a known extension?
-            _, file_ext = splitext(document)
-            if not file_ext or not file_ext in KNOWN_FILE_SUFF:
-                textfile_path = document
-            else:
-                textfile_path = document[:len(document) - len(file_ext)]
-
-        self._document_text = self._read_document_text(textfile_path)
+        # The text is needed to verify the annotations when parsing them,
+        # but annotations restored from the memory cache come with the
+        # text as read for them (see _checkout_memory_cache()). A missing
+        # text file is still reported before anything else.
+        textfile_path = _text_file_base(document)
+        self._text_base_path = textfile_path
+        self._text_file_path = textfile_path + '.' + TEXT_FILE_SUFFIX
+        self._document_text = None
+        if not isfile(self._text_file_path):
+            # Possibly packed (see docpack)
+            self._document_text = self._read_document_text(textfile_path)
         
         Annotations.__init__(self, document, read_only)
 
+    def _parse_cache_sources(self):
+        # Text-bounds are verified against the text when parsing
+        return (Annotations._parse_cache_sources(self) +
+                [self._text_file_path])
+
+    def _checkout_memory_cache(self):
+        if Annotations._checkout_memory_cache(self):
+            return True
+        # First read the text or the Annotations can't verify the annotations
+        if self._document_text is None:
+            self._document_text = self._read_document_text(
+                    self._text_base_path)
+        return False
+
+    def _checkin_memory_cache(self):
+        # Cached objects should not keep the text file open
+        self._document_text.close()
+        Annotations._checkin_memory_cache(self)
+
     def _parse_textbound_annotation(self, id, data, data_tail, input_file_path):
         type, spans = self._split_textbound_data(id, data, input_file_path)
 
@@ -1059,6 +2185,7 @@ class TextAnnotations(Annotations):
         # If the tail is empty, force a fill with the corresponding text.
         if data_tail.strip() == '' and spanlen > 0:
             Messager.error(u"Text-bound annotation missing text (expected format 'ID\\tTYPE START END\\tTEXT'). Filling from reference text. NOTE: This changes annotations on disk unless read-only.")
+            self._parse_cacheable = False
             text = "".join([self._document_text[start:end] for start, end in spans])
 
         elif data_tail[0] != '\t':
@@ -1082,6 +2209,7 @@ class TextAnnotations(Annotations):
                 oldstylereftext = ''.join(spantexts)
                 if text[:len(oldstylereftext)] == oldstylereftext:
                     Messager.warning(u'NOTE: replacing old-style (pre-1.3) discontinuous annotation text span with new-style one, i.e. adding space to "%s" in .ann' % text[:len(oldstylereftext)], -1)
+                    self._parse_cacheable = False
                     text = reftext
                     data_tail = ''
                 else:
@@ -1098,6 +2226,14 @@ class TextAnnotations(Annotations):
         return TextBoundAnnotationWithText(spans, id, type, text, data_tail, source_id=input_file_path)
 
     def get_document_text(self):
+        return self._document_text.get_text()
+
+    def get_document_text_accessor(self):
+        '''
+        Return the text of the document as a DocumentText, which can be
+        sliced by character offsets without decoding the whole text.
+        '''
+
         return self._document_text
 
     def _read_document_text(self, document):
@@ -1106,16 +2242,137 @@ class TextAnnotations(Annotations):
         # "PMID.txt", not "PMID.a1.txt"
         textfn = document + '.' + TEXT_FILE_SUFFIX
         try:
-            with open_textfile(textfn, 'r') as f:
-                return f.read()
+            return DocumentText(textfn)
         except IOError:
+            packed = packed_document(document)
+            if packed is not None:
+                return DocumentText(textfn, packed.read_file(TEXT_FILE_SUFFIX))
             Messager.error('Error reading document text from %s' % textfn)
         raise AnnotationTextFileNotFoundError(document)
 
+def _text_file_base(document):
+    # The path of the text file of a document without its suffix
+    if document.endswith('.txt'):
+        return document
+    # Do we have a known extension?
+    _, file_ext = splitext(document)
+    if not file_ext or not file_ext in KNOWN_FILE_SUFF:
+        return document
+    return document[:len(document) - len(file_ext)]
+
+class _AnnotationReader(Annotations):
+    """
+    Parser for the annotation files of a document that yields the
+    annotations one at a time rather than storing them, see
+    iter_annotations().
+    """
+    def __init__(self, document):
+        self._read_only = True
+        self._packed = None
+        self._input_files = self._select_input_files(document)
+        if not self._input_files:
+            self._input_files = self._packed_input_files(document)
+        if not self._input_files:
+            raise AnnotationFileNotFoundError(document)
+        self._parse_function_by_id_prefix = self._line_parsers()
+        # Never holds anything, the reader does not check for duplicate ids
+        self._ann_by_id = {}
+        self.failed_lines = []
+        self._parse_cacheable = True
+
+    def iter_lines(self, prefixes=None):
+        self.ann_line_num = -1
+        for input_file_path in self._input_files:
+            ann_lines = self._read_input_file(input_file_path).splitlines(True)
+            for self.ann_line in ann_lines:
+                self.ann_line_num += 1
+                if prefixes is not None and self.ann_line[:1] not in prefixes:
+                    continue
+                yield self._parse_line(input_file_path)
+
+class _TextAnnotationReader(_AnnotationReader, TextAnnotations):
+    def __init__(self, document):
+        self._document_text = self._read_document_text(
+                _text_file_base(document))
+        _AnnotationReader.__init__(self, document)
+
+class AnnotationsView(Annotations):
+    """
+    Read-only view of the annotations of a document, for the actions that
+    only read them (display, search, statistics). Parsed as Annotations
+    but without the bookkeeping that only editing needs: no write
+    permission checks, no tracking of the id numbers in use and no edit
+    journal state, and nothing is ever written back. Any attempt to change
+    the annotations raises AnnotationsIsReadOnlyError.
+    """
+    _allocates_ids = False
+
+    def __init__(self, document):
+        Annotations.__init__(self, document, read_only=True)
+
+    def _read_only_error(self, *args, **kwargs):
+        raise AnnotationsIsReadOnlyError(self.get_document())
+
+    update_annotation = _read_only_error
+    batch = _read_only_error
+    get_new_id = _read_only_error
+    reserve_ids = _read_only_error
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self._checkin_memory_cache()
+
+class TextAnnotationsView(AnnotationsView, TextAnnotations):
+    """
+    Read-only view of the annotations of a document and its text, see
+    AnnotationsView and TextAnnotations.
+    """
+    def __init__(self, document):
+        TextAnnotations.__init__(self, document, read_only=True)
+
+def iter_annotations(document, categories=None, with_text=False):
+    '''
+    Generate the annotations of a document in the order in which they
+    appear without building an Annotations object, for reading through
+    large numbers of documents. Nothing is kept from one annotation to the
+    next: equivs are generally not merged, ids are not checked for
+    uniqueness and references are not checked.
+
+    Argument(s):
+    document - the document, as for Annotations
+    categories - if given, only the annotations with an id prefix (e.g.
+        'T', 'E' or '*') in categories are parsed and generated
+    with_text - if True, text-bound annotations are verified against the
+        text of the document and include their text, as for TextAnnotations
+    '''
+    reader = (_TextAnnotationReader if with_text else _AnnotationReader)(
+            document)
+    prefixes = frozenset(categories) if categories is not None else None
+
+    input_files = reader._input_files
+    if (len(input_files) == 1 and input_files[0].endswith(
+            JOINED_ANN_FILE_SUFF) and isfile(input_files[0] + '.'
+            + JOURNAL_FILE_SUFF)):
+        # An edit journal applies, so we take the long way
+        view_class = TextAnnotationsView if with_text else AnnotationsView
+        for ann in view_class(document):
+            # The id prefix as on the annotation line
+            if prefixes is None or unicode(ann)[:1] in prefixes:
+                yield ann
+        return
+
+    for ann in reader.iter_lines(prefixes):
+        yield ann
+
+# All annotation classes declare __slots__ to keep their instances small,
+# annotations for whole collections may be held in memory at once. Any new
+# instance attribute has to be added to the __slots__ of its class.
 class Annotation(object):
     """
     Base class for all annotations.
     """
+    __slots__ = ('tail', 'source_id', )
+
     def __init__(self, tail, source_id=None):
         self.tail = tail
         self.source_id = source_id
@@ -1134,6 +2391,8 @@ class UnknownAnnotation(Annotation):
     Represents a line of annotation that could not be parsed.
     These are not discarded, but rather passed through unmodified.
     """
+    __slots__ = ()
+
     def __init__(self, line, source_id=None):
         Annotation.__init__(self, line, source_id=source_id)
 
@@ -1149,6 +2408,8 @@ class UnparsedIdedAnnotation(Annotation):
     """
     # duck-type instead of inheriting from IdedAnnotation as
     # that inherits from TypedAnnotation and we have no type
+    __slots__ = ('id', )
+
     def __init__(self, id, line, source_id=None):
         # (this actually is the whole line, not just the id tail,
         # although Annotation will assign it to self.tail)
@@ -1162,6 +2423,8 @@ class TypedAnnotation(Annotation):
     """
     Base class for all annotations with a type.
     """
+    __slots__ = ('type', )
+
     def __init__(self, type, tail, source_id=None):
         Annotation.__init__(self, tail, source_id=source_id)
         self.type = type
@@ -1173,6 +2436,8 @@ class IdedAnnotation(TypedAnnotation):
     """
     Base class for all annotations with an ID.
     """
+    __slots__ = ('id', )
+
     def __init__(self, id, type, tail, source_id=None):
         TypedAnnotation.__init__(self, type, tail, source_id=source_id)
         self.id = id
@@ -1213,6 +2478,8 @@ class EventAnnotation(IdedAnnotation):
 
     ID\tTYPE:TRIGGER [ROLE1:PART1 ROLE2:PART2 ...]
     """
+    __slots__ = ('trigger', 'args', )
+
     def __init__(self, trigger, args, id, type, tail, source_id=None):
         IdedAnnotation.__init__(self, id, type, tail, source_id=source_id)
         self.trigger = trigger
@@ -1285,6 +2552,8 @@ class EquivAnnotation(TypedAnnotation):
 
     Where "*" is the literal asterisk character.
     """
+    __slots__ = ('entities', )
+
     def __init__(self, type, entities, tail, source_id=None):
         TypedAnnotation.__init__(self, type, tail, source_id=source_id)
         self.entities = entities
@@ -1319,6 +2588,8 @@ class EquivAnnotation(TypedAnnotation):
         return '('+','.join([unicode(e) for e in self.entities])+')'
 
 class AttributeAnnotation(IdedAnnotation):
+    __slots__ = ('target', 'value', )
+
     def __init__(self, target, id, type, tail, value, source_id=None):
         IdedAnnotation.__init__(self, id, type, tail, source_id=source_id)
         self.target = target
@@ -1345,6 +2616,8 @@ class AttributeAnnotation(IdedAnnotation):
         return [self.target]
 
 class NormalizationAnnotation(IdedAnnotation):
+    __slots__ = ('target', 'refdb', 'refid', 'reftext', )
+
     def __init__(self, _id, _type, target, refdb, refid, tail, source_id=None):
         IdedAnnotation.__init__(self, _id, _type, tail, source_id=source_id)
         self.target = target
@@ -1374,6 +2647,8 @@ class NormalizationAnnotation(IdedAnnotation):
         return [self.target]
 
 class OnelineCommentAnnotation(IdedAnnotation):
+    __slots__ = ('target', )
+
     def __init__(self, target, id, type, tail, source_id=None):
         IdedAnnotation.__init__(self, id, type, tail, source_id=source_id)
         self.target = target
@@ -1416,12 +2691,21 @@ class TextBoundAnnotation(IdedAnnotation):
 
     with multiple START END pairs separated by semicolons.
     """
+    __slots__ = ('_spans', )
 
     def __init__(self, spans, id, type, tail, source_id=None):
         # Note: if present, the text goes into tail
         IdedAnnotation.__init__(self, id, type, tail, source_id=source_id)
         self.spans = spans
 
+    # The spans are stored as a tuple of (start, end) tuples, whatever
+    # sequence of pairs they are given as
+    def get_spans(self):
+        return self._spans
+    def set_spans(self, spans):
+        self._spans = tuple((start, end) for start, end in spans)
+    spans = property(get_spans, set_spans)
+
     # TODO: temp hack while building support for discontinuous
     # annotations; remove once done
     def get_start(self):
@@ -1505,6 +2789,8 @@ class TextBoundAnnotationWithText(TextBoundAnnotation):
 
     with multiple START END pairs separated by semicolons.
     """
+    __slots__ = ('text', 'text_tail', )
+
     def __init__(self, spans, id, type, text, text_tail="", source_id=None):
         IdedAnnotation.__init__(self, id, type, '\t'+text+text_tail, source_id=source_id)
         self.spans = spans
@@ -1550,6 +2836,8 @@ class BinaryRelationAnnotation(IdedAnnotation):
 
     Where ARG1 and ARG2 are arbitrary (but not identical) labels.
     """
+    __slots__ = ('arg1l', 'arg1', 'arg2l', 'arg2', )
+
     def __init__(self, id, type, arg1l, arg1, arg2l, arg2, tail, source_id=None):
         IdedAnnotation.__init__(self, id, type, tail, source_id=source_id)
         self.arg1l = arg1l
@@ -1574,6 +2862,35 @@ class BinaryRelationAnnotation(IdedAnnotation):
         hard_deps.add(self.arg2)
         return soft_deps, hard_deps
 
+# Annotation categories indexed separately by Annotations; the most
+# specific class must precede its base classes
+ANN_CATEGORIES = (
+        EventAnnotation,
+        AttributeAnnotation,
+        EquivAnnotation,
+        TextBoundAnnotation,
+        BinaryRelationAnnotation,
+        NormalizationAnnotation,
+        OnelineCommentAnnotation,
+        )
+_CATEGORY_BY_CLASS = {}
+
+def ann_category(ann):
+    '''
+    Return the class in ANN_CATEGORIES that the given annotation belongs
+    to, or None if the annotation belongs to none of them.
+    '''
+    try:
+        return _CATEGORY_BY_CLASS[ann.__class__]
+    except KeyError:
+        for category in ANN_CATEGORIES:
+            if isinstance(ann, category):
+                break
+        else:
+            category = None
+        _CATEGORY_BY_CLASS[ann.__class__] = category
+        return category
+
 if __name__ == '__main__':
     from sys import stderr, argv
     for ann_path_i, ann_path in enumerate(argv[1:]):
@@ -13,13 +13,14 @@ Version:    2011-04-22
 
 from __future__ import with_statement
 
+from itertools import chain
 from os.path import join as path_join
 from os.path import split as path_split
 from re import compile as re_compile
 
 from annotation import (OnelineCommentAnnotation, TEXT_FILE_SUFFIX,
-        TextAnnotations, DependingAnnotationDeleteError, TextBoundAnnotation,
-        EventAnnotation, EquivAnnotation, open_textfile,
+        TextAnnotations, TextAnnotationsView, DependingAnnotationDeleteError,
+        TextBoundAnnotation, EventAnnotation, EquivAnnotation,
         AnnotationsIsReadOnlyError, AttributeAnnotation, 
         NormalizationAnnotation, SpanOffsetOverlapError, DISCONT_SEP)
 from common import ProtocolError, ProtocolArgumentError
@@ -31,9 +32,13 @@ from document import real_directory
 from jsonwrap import loads as json_loads, dumps as json_dumps
 from message import Messager
 from projectconfig import ProjectConfiguration, ENTITY_CATEGORY, EVENT_CATEGORY, RELATION_CATEGORY, UNKNOWN_CATEGORY
+from projectconfig import options_get_validation
 
 ### Constants
 MUL_NL_REGEX = re_compile(r'\n+')
+# The spans of a text-bound and the trigger of an event as (un)parsed
+TEXTBOUND_SPANS_REGEX = re_compile(r'^[^\t]+\t\S+ (\d+ \d+(?:;\d+ \d+)*)')
+EVENT_TRIGGER_REGEX = re_compile(r'^[^\t]+\t[^:\s]+:(\S+)')
 ###
 
 #TODO: Couldn't we incorporate this nicely into the Annotations class?
@@ -57,6 +62,48 @@ class ModificationTracker(object):
     def change(self, before, after):
         self.__changed.append((before, after))
 
+    def changed_ids(self):
+        '''
+        Return the ids keying the records of the document JSON that the
+        modifications may have changed (see document._json_delta()).
+        '''
+        ids = set()
+        for ann in chain(self.__added, (a for _, a in self.__changed),
+                self.__deleted):
+            if isinstance(ann, OnelineCommentAnnotation):
+                # Comments are keyed by the annotation they comment on
+                ids.add(unicode(ann.target))
+            elif not isinstance(ann, EquivAnnotation):
+                # Equivs have no ids, they are always sent in full
+                ids.add(unicode(ann.id))
+            if isinstance(ann, EventAnnotation):
+                # The trigger may have become or stopped being one
+                ids.add(unicode(ann.trigger))
+        for before, after in self.__changed:
+            if isinstance(after, EventAnnotation):
+                m = EVENT_TRIGGER_REGEX.match(before)
+                if m:
+                    ids.add(unicode(m.group(1)))
+        return ids
+
+    def changed_spans(self):
+        '''
+        Return the spans of the text-bounds added, deleted or changed,
+        for the changed ones both before and after the change.
+        '''
+        spans = []
+        for ann in chain(self.__added, self.__deleted):
+            if isinstance(ann, TextBoundAnnotation):
+                spans.extend(ann.spans)
+        for before, after in self.__changed:
+            if isinstance(after, TextBoundAnnotation):
+                spans.extend(after.spans)
+                m = TEXTBOUND_SPANS_REGEX.match(before)
+                if m:
+                    spans.extend(tuple(int(o) for o in span.split(' '))
+                            for span in m.group(1).split(';'))
+        return spans
+
     def json_response(self, response=None):
         if response is None:
             response = {}
@@ -152,6 +199,30 @@ def _json_from_ann(ann_obj):
     _enrich_json_with_data(j_dic, ann_obj)
     return j_dic
 
+def _attach_annotations(json_dic, ann_obj, mods, delta=None):
+    # Attaches the latest annotation data to the response to an edit.
+    # If the client asked for a delta, only the records changed by the
+    # edit are sent (see document._json_delta()), unless the document
+    # has to be sent in full to report on unparsable lines or to
+    # validate it. Either way the response gives the version of the
+    # document, which the client sends back when reloading the document
+    # (see document.get_document()).
+    from document import _json_delta, _document_version
+    docdir = path_split(ann_obj.get_document())[0]
+    # The version has to describe the files as written
+    ann_obj.flush()
+    version = _document_version(ann_obj.get_document())
+    if (delta in (True, 'true', ) and mods is not None
+            and not ann_obj.failed_lines
+            and options_get_validation(docdir) not in ('all', 'full', )):
+        json_dic['delta'] = _json_delta(ann_obj, mods.changed_ids(),
+                mods.changed_spans())
+        json_dic['document_version'] = version
+    else:
+        json_dic['annotations'] = _json_from_ann(ann_obj)
+        json_dic['annotations']['document_version'] = version
+    return json_dic
+
 from logging import info as log_info
 from annotation import TextBoundAnnotation, TextBoundAnnotationWithText
 from copy import deepcopy
@@ -225,7 +296,9 @@ def _edit_span(ann_obj, mods, id, offsets, projectconf, attributes, type,
             before = unicode(tb_ann)
             #log_info('Will alter span of: "%s"' % str(to_edit_span).rstrip('\n'))
             tb_ann.spans = offsets[:]
-            tb_ann.text = _text_for_offsets(ann_obj._document_text, tb_ann.spans)
+            tb_ann.text = _text_for_offsets(
+                    ann_obj.get_document_text_accessor(), tb_ann.spans)
+            ann_obj.update_annotation(tb_ann)
             #log_info('Span altered')
             mods.change(before, tb_ann)
 
@@ -265,28 +338,30 @@ def _edit_span(ann_obj, mods, id, offsets, projectconf, attributes, type,
                         new_ann_trig.type = ann.type
                         # Update the old annotation to use this trigger
                         ann.trigger = unicode(new_ann_trig.id)
+                        ann_obj.update_annotation(ann)
                         ann_obj.add_annotation(new_ann_trig)
                         mods.addition(new_ann_trig)
                     else:
                         # Okay, we own the current trigger, but does an
                         # identical to our sought one already exist?
                         found = None
-                        for tb_ann in ann_obj.get_textbounds():
-                            if (_offsets_equal(tb_ann.spans, ann_trig.spans) and
-                                tb_ann.type == ann.type):
-                                found = tb_ann
-                                break
+                        for tb_ann in ann_obj.same_span(ann_trig.spans,
+                                ann.type):
+                            found = tb_ann
+                            break
 
                         if found is None:
                             # Just change the trigger type since we are the
                             # only users
                             before = unicode(ann_trig)
                             ann_trig.type = ann.type
+                            ann_obj.update_annotation(ann_trig)
                             mods.change(before, ann_trig)
                         else:
                             # Attach the new trigger THEN delete
                             # or the dep will hit you
                             ann.trigger = unicode(found.id)
+                            ann_obj.update_annotation(ann)
                             ann_obj.del_annotation(ann_trig)
                             mods.deletion(ann_trig)
             except AttributeError:
@@ -294,31 +369,24 @@ def _edit_span(ann_obj, mods, id, offsets, projectconf, attributes, type,
                 pass
 
             # Finally remember the change
+            ann_obj.update_annotation(ann)
             mods.change(before, ann)
     return tb_ann, e_ann
 
-def __create_span(ann_obj, mods, type, offsets, txt_file_path,
-        projectconf, attributes):
+def __create_span(ann_obj, mods, type, offsets, projectconf, attributes):
     # For event types, reuse trigger if a matching one exists.
     found = None
     if projectconf.is_event_type(type):
-        for tb_ann in ann_obj.get_textbounds():
-            try:
-                if (_offsets_equal(tb_ann.spans, offsets)
-                    and tb_ann.type == type):
-                    found = tb_ann
-                    break
-            except AttributeError:
-                # Not a trigger then
-                pass
-        
+        for tb_ann in ann_obj.same_span(offsets, type):
+            found = tb_ann
+            break
+
     if found is None:
         # Get a new ID
         new_id = ann_obj.get_new_id('T') #XXX: Cons
         # Get the text span
-        with open_textfile(txt_file_path, 'r') as txt_file:
-            text = txt_file.read()
-            text_span = _text_for_offsets(text, offsets)
+        text = ann_obj.get_document_text_accessor()
+        text_span = _text_for_offsets(text, offsets)
 
         # The below code resolves cases where there are newlines in the
         #   offsets by creating discontinuous annotations for each span
@@ -397,6 +465,7 @@ def _set_attributes(ann_obj, ann, attributes, mods, undo_resp={}):
             if existing_attr_ann.value != new_value:
                 before = unicode(existing_attr_ann)
                 existing_attr_ann.value = new_value
+                ann_obj.update_annotation(existing_attr_ann)
                 mods.change(before, existing_attr_ann)
 
     # The remaining annotations are new and should be created
@@ -422,13 +491,13 @@ def _json_offsets_to_list(offsets):
 
 #TODO: unshadow Python internals like "type" and "id"
 def create_span(collection, document, offsets, type, attributes=None,
-                normalizations=None, id=None, comment=None):
+                normalizations=None, id=None, comment=None, delta=None):
     # offsets should be JSON string corresponding to a list of (start,
     # end) pairs; convert once at this interface
     offsets = _json_offsets_to_list(offsets)
 
     return _create_span(collection, document, offsets, type, attributes,
-                        normalizations, id, comment)
+                        normalizations, id, comment, delta)
 
 def _set_normalizations(ann_obj, ann, normalizations, mods, undo_resp={}):
     # Find existing normalizations (if any)
@@ -466,6 +535,9 @@ def _set_normalizations(ann_obj, ann, normalizations, mods, undo_resp={}):
             if old_norm.reftext != new_reftext:
                 old = unicode(old_norm)
                 old_norm.reftext = new_reftext
+                # The text is written from the tail
+                old_norm.tail = u'\t' + new_reftext
+                ann_obj.update_annotation(old_norm)
                 mods.change(old, old_norm)
 
     # Process new normalizations
@@ -548,6 +620,7 @@ def _set_comments(ann_obj, ann, comment, mods, undo_resp={}):
             # XXX: Note the ugly tab, it is for parsing the tail
             before = unicode(found)
             found.tail = u'\t' + comment
+            ann_obj.update_annotation(found)
             mods.change(before, found)
         else:
             # Create a new comment
@@ -582,7 +655,7 @@ def _offset_overlaps(offsets):
 
 #TODO: ONLY determine what action to take! Delegate to Annotations!
 def _create_span(collection, document, offsets, _type, attributes=None,
-                 normalizations=None, _id=None, comment=None):
+                 normalizations=None, _id=None, comment=None, delta=None):
 
     if _offset_overlaps(offsets):
         raise SpanOffsetOverlapError(offsets)
@@ -600,8 +673,6 @@ def _create_span(collection, document, offsets, _type, attributes=None,
 
     projectconf = ProjectConfiguration(real_dir)
 
-    txt_file_path = document + '.' + TEXT_FILE_SUFFIX
-
     working_directory = path_split(document)[0]
 
     with TextAnnotations(document) as ann_obj:
@@ -617,7 +688,7 @@ def _create_span(collection, document, offsets, _type, attributes=None,
                     _attributes, _type, undo_resp=undo_resp)
         else:
             # We are to create a new annotation
-            tb_ann, e_ann = __create_span(ann_obj, mods, _type, offsets, txt_file_path,
+            tb_ann, e_ann = __create_span(ann_obj, mods, _type, offsets,
                     projectconf, _attributes)
 
             undo_resp['action'] = 'add_tb'
@@ -657,8 +728,7 @@ def _create_span(collection, document, offsets, _type, attributes=None,
 
         if undo_resp:
             mods_json['undo'] = json_dumps(undo_resp)
-        mods_json['annotations'] = _json_from_ann(ann_obj)
-        return mods_json
+        return _attach_annotations(mods_json, ann_obj, mods, delta)
 
 from annotation import BinaryRelationAnnotation
 
@@ -740,6 +810,7 @@ def _create_relation(ann_obj, projectconf, mods, origin, target, type,
             before = unicode(found)
             found.arg2 = target.id
             found.type = type
+            ann_obj.update_annotation(found)
             mods.change(before, found)
 
         target_ann = found
@@ -776,6 +847,7 @@ def _create_argument(ann_obj, projectconf, mods, origin, target, type,
             if arg_tup not in origin.args:
                 before = unicode(origin)
                 origin.add_argument(type, unicode(target.id))
+                ann_obj.update_annotation(origin)
                 mods.change(before, origin)
             else:
                 # It already existed as an arg, we were called to do nothing...
@@ -789,6 +861,7 @@ def _create_argument(ann_obj, projectconf, mods, origin, target, type,
                 before = unicode(origin)
                 origin.args.remove(old_arg_tup)
                 origin.add_argument(type, unicode(target.id))
+                ann_obj.update_annotation(origin)
                 mods.change(before, origin)
             else:
                 # Collision etc. don't do anything
@@ -810,11 +883,12 @@ def _create_argument(ann_obj, projectconf, mods, origin, target, type,
     # No addressing mechanism for arguments at the moment
     return None
 
-def reverse_arc(collection, document, origin, target, type, attributes=None):
+def reverse_arc(collection, document, origin, target, type, attributes=None,
+        delta=None):
     directory = collection
     #undo_resp = {} # TODO
     real_dir = real_directory(directory)
-    #mods = ModificationTracker() # TODO
+    mods = ModificationTracker()
     projectconf = ProjectConfiguration(real_dir)
     document = path_join(real_dir, document)
     with TextAnnotations(document) as ann_obj:
@@ -839,16 +913,17 @@ def reverse_arc(collection, document, origin, target, type, attributes=None):
                 Messager.error('reverse_arc: failed to identify target relation (from %s to %s, type %s) (deleted?)' % (str(origin), str(target), str(type)))
             else:
                 # found it; just adjust this
+                before = unicode(found)
                 found.arg1, found.arg2 = found.arg2, found.arg1
-                # TODO: modification tracker
+                ann_obj.update_annotation(found)
+                mods.change(before, found)
 
         json_response = {}
-        json_response['annotations'] = _json_from_ann(ann_obj)
-        return json_response
+        return _attach_annotations(json_response, ann_obj, mods, delta)
 
 # TODO: undo support
 def create_arc(collection, document, origin, target, type, attributes=None,
-        old_type=None, old_target=None, comment=None):
+        old_type=None, old_target=None, comment=None, delta=None):
     directory = collection
     undo_resp = {}
 
@@ -902,13 +977,11 @@ def create_arc(collection, document, origin, target, type, attributes=None,
             
 
         mods_json = mods.json_response()
-        mods_json['annotations'] = _json_from_ann(ann_obj)
-        return mods_json
+        return _attach_annotations(mods_json, ann_obj, mods, delta)
 
 # helper for delete_arc
 def _delete_arc_equiv(origin, target, type_, mods, ann_obj):
-    # TODO: this is slow, we should have a better accessor
-    for eq_ann in ann_obj.get_equivs():
+    for eq_ann in ann_obj.get_equivs_containing(unicode(origin)):
         # We don't assume that the ids only occur in one Equiv, we
         # keep on going since the data "could" be corrupted
         if (unicode(origin) in eq_ann.entities and 
@@ -917,6 +990,7 @@ def _delete_arc_equiv(origin, target, type_, mods, ann_obj):
             before = unicode(eq_ann)
             eq_ann.entities.remove(unicode(origin))
             eq_ann.entities.remove(unicode(target))
+            ann_obj.update_annotation(eq_ann)
             mods.change(before, eq_ann)
 
         if len(eq_ann.entities) < 2:
@@ -948,6 +1022,7 @@ def _delete_arc_event_arg(origin, target, type_, mods, ann_obj):
     if arg_tup in event_ann.args:
         before = unicode(event_ann)
         event_ann.args.remove(arg_tup)
+        ann_obj.update_annotation(event_ann)
         mods.change(before, event_ann)
     else:
         # What we were to remove did not even exist in the first place
@@ -969,7 +1044,7 @@ def _delete_arc_with_ann(origin, target, type_, mods, ann_obj, projectconf):
     else:
         Messager.error('Unknown annotation types for delete')
 
-def delete_arc(collection, document, origin, target, type):
+def delete_arc(collection, document, origin, target, type, delta=None):
     directory = collection
 
     real_dir = real_directory(directory)
@@ -988,13 +1063,12 @@ def delete_arc(collection, document, origin, target, type):
         _delete_arc_with_ann(origin, target, type, mods, ann_obj, projectconf)
 
         mods_json = mods.json_response()
-        mods_json['annotations'] = _json_from_ann(ann_obj)
-        return mods_json
+        return _attach_annotations(mods_json, ann_obj, mods, delta)
 
     # TODO: error handling?
 
 #TODO: ONLY determine what action to take! Delegate to Annotations!
-def delete_span(collection, document, id):
+def delete_span(collection, document, id, delta=None):
     directory = collection
 
     real_dir = real_directory(directory)
@@ -1031,8 +1105,7 @@ def delete_span(collection, document, id):
                     }
 
         mods_json = mods.json_response()
-        mods_json['annotations'] = _json_from_ann(ann_obj)
-        return mods_json
+        return _attach_annotations(mods_json, ann_obj, mods, delta)
 
 class AnnotationSplitError(ProtocolError):
     def __init__(self, message):
@@ -1046,7 +1119,7 @@ class AnnotationSplitError(ProtocolError):
         Messager.error(self.message)
         return json_dic
 
-def split_span(collection, document, args, id):
+def split_span(collection, document, args, id, delta=None):
     directory = collection
 
     real_dir = real_directory(directory)
@@ -1106,7 +1179,10 @@ def split_span(collection, document, args, id):
         for i, arg_combo in enumerate(argument_combos):
             # tweak args
             if i == 0:
+                before = unicode(ann)
                 ann.args = nonsplit_args[:] + arg_combo
+                ann_obj.update_annotation(ann)
+                mods.change(before, ann)
             else:
                 newann = deepcopy(ann)
                 newann.id = ann_obj.get_new_id("E") # TODO: avoid hard-coding ID prefix
@@ -1117,53 +1193,52 @@ def split_span(collection, document, args, id):
 
         # then, go through all the annotations referencing the original
         # event, and create appropriate copies
-        for a in ann_obj:
-            soft_deps, hard_deps = a.get_deps()
-            refs = soft_deps | hard_deps
-            if ann.id in refs:
-                # Referenced; make duplicates appropriately
-
-                if isinstance(a, EventAnnotation):
-                    # go through args and make copies for referencing
-                    new_args = []
-                    for arg, aid in a.args:
-                        if aid == ann.id:
-                            for newe in new_events:
-                                new_args.append((arg, newe.id))
-                    a.args.extend(new_args)
-
-                elif isinstance(a, AttributeAnnotation):
-                    for newe in new_events:
-                        newmod = deepcopy(a)
-                        newmod.target = newe.id
-                        newmod.id = ann_obj.get_new_id("A") # TODO: avoid hard-coding ID prefix
-                        ann_obj.add_annotation(newmod)
-                        mods.addition(newmod)
-
-                elif isinstance(a, BinaryRelationAnnotation):
-                    # TODO
-                    raise AnnotationSplitError("Cannot adjust annotation referencing split: not implemented for relations! (WARNING: annotations may be in inconsistent state, please reload!) (Please complain to the developers to fix this!)")
-
-                elif isinstance(a, OnelineCommentAnnotation):
-                    for newe in new_events:
-                        newcomm = deepcopy(a)
-                        newcomm.target = newe.id
-                        newcomm.id = ann_obj.get_new_id("#") # TODO: avoid hard-coding ID prefix
-                        ann_obj.add_annotation(newcomm)
-                        mods.addition(newcomm)
-                elif isinstance(a, NormalizationAnnotation):
-                    for newe in new_events:
-                        newnorm = deepcopy(a)
-                        newnorm.target = newe.id
-                        newnorm.id = ann_obj.get_new_id("N") # TODO: avoid hard-coding ID prefix
-                        ann_obj.add_annotation(newnorm)
-                        mods.addition(newnorm)
-                else:
-                    raise AnnotationSplitError("Cannot adjust annotation referencing split: not implemented for %s! (Please complain to the lazy developers to fix this!)" % a.__class__)
+        for a in ann_obj.get_dependants(ann.id):
+            # Referenced; make duplicates appropriately
+
+            if isinstance(a, EventAnnotation):
+                # go through args and make copies for referencing
+                new_args = []
+                for arg, aid in a.args:
+                    if aid == ann.id:
+                        for newe in new_events:
+                            new_args.append((arg, newe.id))
+                before = unicode(a)
+                a.args.extend(new_args)
+                ann_obj.update_annotation(a)
+                mods.change(before, a)
+
+            elif isinstance(a, AttributeAnnotation):
+                for newe in new_events:
+                    newmod = deepcopy(a)
+                    newmod.target = newe.id
+                    newmod.id = ann_obj.get_new_id("A") # TODO: avoid hard-coding ID prefix
+                    ann_obj.add_annotation(newmod)
+                    mods.addition(newmod)
+
+            elif isinstance(a, BinaryRelationAnnotation):
+                # TODO
+                raise AnnotationSplitError("Cannot adjust annotation referencing split: not implemented for relations! (WARNING: annotations may be in inconsistent state, please reload!) (Please complain to the developers to fix this!)")
+
+            elif isinstance(a, OnelineCommentAnnotation):
+                for newe in new_events:
+                    newcomm = deepcopy(a)
+                    newcomm.target = newe.id
+                    newcomm.id = ann_obj.get_new_id("#") # TODO: avoid hard-coding ID prefix
+                    ann_obj.add_annotation(newcomm)
+                    mods.addition(newcomm)
+            elif isinstance(a, NormalizationAnnotation):
+                for newe in new_events:
+                    newnorm = deepcopy(a)
+                    newnorm.target = newe.id
+                    newnorm.id = ann_obj.get_new_id("N") # TODO: avoid hard-coding ID prefix
+                    ann_obj.add_annotation(newnorm)
+                    mods.addition(newnorm)
+            else:
+                raise AnnotationSplitError("Cannot adjust annotation referencing split: not implemented for %s! (Please complain to the lazy developers to fix this!)" % a.__class__)
 
         mods_json = mods.json_response()
-        mods_json['annotations'] = _json_from_ann(ann_obj)
-        return mods_json
+        return _attach_annotations(mods_json, ann_obj, mods, delta)
 
 def set_status(directory, document, status=None):
     real_dir = real_directory(directory) 
@@ -1186,8 +1261,7 @@ def set_status(directory, document, status=None):
     return json_dic
 
 def get_status(directory, document):
-    with TextAnnotations(path_join(real_directory, document),
-            read_only=True) as ann:
+    with TextAnnotationsView(path_join(real_directory, document)) as ann:
 
         # XXX: Assume the last one is correct if we have more
         #       than one (which is a violation of protocol anyway)
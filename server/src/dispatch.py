@@ -21,13 +21,14 @@ from config import DATA_DIR
 from convert.convert import convert
 from docimport import save_import
 from document import (get_directory_information, get_document,
-        get_document_timestamp, get_configuration)
+        get_document_range, get_document_timestamp, get_configuration)
 from download import download_file, download_collection
 from inspect import getargspec
 from itertools import izip
 from jsonwrap import dumps
 from logging import info as log_info
 from annlog import log_annotation
+from annotation import get_memory_cache_statistics
 from message import Messager
 from svg import store_svg, retrieve_stored
 from session import get_session, load_conf, save_conf
@@ -48,7 +49,9 @@ def logging_no_op(collection, document, log):
 DISPATCHER = {
         'getCollectionInformation': get_directory_information,
         'getDocument': get_document,
+        'getDocumentRange': get_document_range,
         'getDocumentTimestamp': get_document_timestamp,
+        'getAnnotationCacheStatistics': get_memory_cache_statistics,
         'importDocument': save_import,
 
         'storeSVG': store_svg,
@@ -118,6 +121,7 @@ ANNOTATION_ACTION = set((
 # Actions that will be logged as annotator actions (if so configured)
 LOGGED_ANNOTATOR_ACTION = ANNOTATION_ACTION | set((
         'getDocument',
+        'getDocumentRange',
         'logAnnotatorAction',
         ))
 
@@ -134,12 +138,35 @@ REQUIRES_AUTHENTICATION = ANNOTATION_ACTION | set((
         'searchNoteInCollection',
 
         'tag',
+
+        # Monitoring, reveals the documents cached
+        'getAnnotationCacheStatistics',
+        ))
+
+# Actions with potentially large responses, sent as they are serialised
+STREAMED_RESPONSE_ACTION = set((
+        'getDocument',
+        'getCollectionInformation',
+
+        'searchTextInDocument',
+        'searchEntityInDocument',
+        'searchEventInDocument',
+        'searchRelationInDocument',
+        'searchNoteInDocument',
+        'searchTextInCollection',
+        'searchEntityInCollection',
+        'searchEventInCollection',
+        'searchRelationInCollection',
+        'searchNoteInCollection',
         ))
 
 # Sanity check
 for req_action in REQUIRES_AUTHENTICATION:
     assert req_action in DISPATCHER, (
             'INTERNAL ERROR: undefined action in REQUIRES_AUTHENTICATION set')
+for stream_action in STREAMED_RESPONSE_ACTION:
+    assert stream_action in DISPATCHER, (
+            'INTERNAL ERROR: undefined action in STREAMED_RESPONSE_ACTION set')
 ###
 
 
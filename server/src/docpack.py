@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+from __future__ import with_statement
+
+'''
+Packed collections, holding the texts and annotation files of all the
+documents of a collection in a single file from which the documents are
+read by name. Listing, statistics and search over collections of large
+numbers of small documents are otherwise dominated by the file system.
+
+A collection is packed when its directory holds a PACK_FILE_NAME file.
+Documents with a text file of their own in the directory ("loose"
+documents) take precedence over packed ones. Packed documents are read
+straight from the pack until they are edited, at which point they are
+copied out of the pack as loose files (see PackedDocument.unpack()).
+
+A pack consists of a header, the contents of the files one after the
+other and an index of the documents located through a trailer at the
+end of the file:
+
+    header  - PACK_MAGIC and the format version
+    files   - the text and annotation files, as they are on disk
+    index   - JSON list of [name, mtime, [[suffix, offset, length], ...]]
+              for each document, mtime being that of its annotation file
+    trailer - offset and length of the index, PACK_MAGIC
+
+Usage example (see also tools/packcollection.py):
+
+    build_pack('data/large-collection', remove_loose=True)
+'''
+
+from logging import error as log_error
+from mmap import mmap, ACCESS_READ
+from os import chmod, close as os_close, listdir, remove, rename, stat
+from os import umask, utime
+from os.path import basename, dirname, getmtime, isfile
+from os.path import join as path_join
+from struct import calcsize, pack as struct_pack, unpack as struct_unpack
+from tempfile import mkstemp
+
+from jsonwrap import dumps, loads
+from message import Messager
+
+### Constants
+PACK_FILE_NAME = 'collection.pack'
+PACK_MAGIC = 'BRATPACK'
+PACK_VERSION = 1
+HEADER_FORMAT = '<8sI'
+TRAILER_FORMAT = '<QQ8s'
+###
+
+# Packs opened by this process by path, with the identity of the file
+# that they were opened for
+_pack_by_path = {}
+
+
+class PackError(Exception):
+    def __init__(self, path, reason):
+        self.path = path
+        self.reason = reason
+
+    def __str__(self):
+        return 'Invalid collection pack %s: %s' % (self.path, self.reason)
+
+
+class CollectionPack(object):
+    '''
+    Read access to a pack file, use collection_pack() rather than creating
+    these directly to share them between requests.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as pack_file:
+            try:
+                self._map = mmap(pack_file.fileno(), 0, access=ACCESS_READ)
+            except ValueError:
+                # Empty files can't be mapped
+                raise PackError(path, 'empty file')
+
+        header_size = calcsize(HEADER_FORMAT)
+        trailer_size = calcsize(TRAILER_FORMAT)
+        if len(self._map) < header_size + trailer_size:
+            raise PackError(path, 'truncated file')
+        magic, version = struct_unpack(HEADER_FORMAT,
+                self._map[:header_size])
+        if magic != PACK_MAGIC:
+            raise PackError(path, 'not a pack file')
+        if version != PACK_VERSION:
+            raise PackError(path, 'unsupported version %d' % version)
+        index_offset, index_length, magic = struct_unpack(TRAILER_FORMAT,
+                self._map[-trailer_size:])
+        if magic != PACK_MAGIC:
+            raise PackError(path, 'truncated file')
+
+        # Document names in the order in which they were packed
+        self._names = []
+        # Modification time and (suffix, offset, length) of each file of
+        # each document by document name
+        self._entry_by_name = {}
+        try:
+            index = loads(self._map[index_offset:index_offset + index_length])
+            for name, mtime, files in index:
+                self._names.append(name)
+                self._entry_by_name[name] = (mtime, files)
+        except (TypeError, ValueError):
+            raise PackError(path, 'broken index')
+
+    def __contains__(self, name):
+        return name in self._entry_by_name
+
+    def __len__(self):
+        return len(self._names)
+
+    def get_names(self):
+        return list(self._names)
+
+    def get_mtime(self, name):
+        return self._entry_by_name[name][0]
+
+    def get_suffixes(self, name):
+        return [suffix for suffix, _, _ in self._entry_by_name[name][1]]
+
+    def read_file(self, name, suffix):
+        '''
+        Return the contents of the file of the given document with the
+        given suffix, as the bytes of the file. Raises KeyError if there is
+        no such document or file in the pack.
+        '''
+        for file_suffix, offset, length in self._entry_by_name[name][1]:
+            if file_suffix == suffix:
+                return self._map[offset:offset + length]
+        raise KeyError(suffix)
+
+
+class PackedDocument(object):
+    '''
+    A document read from the pack of its collection, see packed_document().
+    '''
+
+    def __init__(self, pack, document):
+        self.pack = pack
+        self.document = document
+        self.name = basename(document)
+
+    def get_mtime(self):
+        return self.pack.get_mtime(self.name)
+
+    def get_suffixes(self):
+        return self.pack.get_suffixes(self.name)
+
+    def read_file(self, suffix):
+        return self.pack.read_file(self.name, suffix)
+
+    def unpack(self):
+        '''
+        Copy the files of the document out of the pack as loose files,
+        after which the document is no longer read from the pack. Files
+        that already exist are left as they are.
+        '''
+        from annotation import JOINED_ANN_FILE_SUFF, TEXT_FILE_SUFFIX
+
+        # The text goes last, the document is read from the pack until then
+        for suffix in sorted(self.get_suffixes(),
+                key=lambda s: s == TEXT_FILE_SUFFIX):
+            file_path = self.document + '.' + suffix
+            if isfile(file_path):
+                continue
+            with open(file_path, 'wb') as loose_file:
+                loose_file.write(self.read_file(suffix))
+            if suffix == JOINED_ANN_FILE_SUFF and self.get_mtime() != -1:
+                # Keep the modification time shown for the document
+                utime(file_path, (self.get_mtime(), self.get_mtime()))
+
+
+def collection_pack(directory):
+    '''
+    Return the CollectionPack of the collection in the given directory, or
+    None if the collection is not packed. A pack that can't be read is
+    reported and the collection taken to be unpacked, leaving its loose
+    documents accessible until the pack is rebuilt.
+    '''
+
+    path = path_join(directory, PACK_FILE_NAME)
+    try:
+        st = stat(path)
+    except OSError:
+        _pack_by_path.pop(path, None)
+        return None
+
+    identity = (st.st_ino, st.st_size, st.st_mtime)
+    cached = _pack_by_path.get(path)
+    if cached is None or cached[0] != identity:
+        try:
+            pack = CollectionPack(path)
+        except (IOError, PackError), e:
+            # Reported once for each version of the file
+            log_error(unicode(e))
+            Messager.error(u'%s, the documents in it are not available'
+                    % (e, ), -1)
+            pack = None
+        cached = (identity, pack)
+        _pack_by_path[path] = cached
+    return cached[1]
+
+
+def packed_document(document):
+    '''
+    Return a PackedDocument for the given document (path without a suffix)
+    if it is read from the pack of its collection, otherwise None.
+    '''
+    from annotation import TEXT_FILE_SUFFIX
+
+    if isfile(document + '.' + TEXT_FILE_SUFFIX):
+        # Loose documents take precedence
+        return None
+    pack = collection_pack(dirname(document))
+    if pack is None or basename(document) not in pack:
+        return None
+    return PackedDocument(pack, document)
+
+
+def packed_document_names(directory, loose_names=()):
+    '''
+    Return the names of the documents of the collection in the given
+    directory that are read from its pack, that is all of the documents in
+    the pack except for those in loose_names.
+    '''
+
+    pack = collection_pack(directory)
+    if pack is None:
+        return []
+    loose_names = set(loose_names)
+    return [name for name in pack.get_names() if name not in loose_names]
+
+
+def _loose_document_files(document, suffixes):
+    # The files of a loose document with the given suffixes, with the
+    # contents of the annotation file as of its journal if it has one
+    from annotation import (AnnotationsView, JOINED_ANN_FILE_SUFF,
+            JOURNAL_FILE_SUFF)
+
+    ann_path = document + '.' + JOINED_ANN_FILE_SUFF
+    files = []
+    for suffix in suffixes:
+        file_path = document + '.' + suffix
+        if not isfile(file_path):
+            continue
+        if (suffix == JOINED_ANN_FILE_SUFF
+                and isfile(ann_path + '.' + JOURNAL_FILE_SUFF)):
+            data = unicode(AnnotationsView(document)).encode('utf-8')
+        else:
+            with open(file_path, 'rb') as loose_file:
+                data = loose_file.read()
+        files.append((suffix, data))
+    return files
+
+
+def build_pack(directory, remove_loose=False):
+    '''
+    Pack the documents of the collection in the given directory, both the
+    loose ones and those in its current pack (if any), replacing the pack.
+    If remove_loose is True the loose files packed are removed afterwards.
+
+    Returns:
+    The number of documents packed.
+    '''
+    from annotation import (JOINED_ANN_FILE_SUFF, JOURNAL_FILE_SUFF,
+            PARTIAL_ANN_FILE_SUFF, TEXT_FILE_SUFFIX)
+
+    suffixes = [TEXT_FILE_SUFFIX, JOINED_ANN_FILE_SUFF] + PARTIAL_ANN_FILE_SUFF
+    text_suffix = '.' + TEXT_FILE_SUFFIX
+    loose_names = sorted(fn[:-len(text_suffix)] for fn in listdir(directory)
+            if fn.endswith(text_suffix))
+    old_pack = collection_pack(directory)
+
+    tmp_fh, tmp_fname = mkstemp(prefix='.', suffix='.pack', dir=directory)
+    os_close(tmp_fh)
+    try:
+        index = []
+        with open(tmp_fname, 'wb') as pack_file:
+            pack_file.write(struct_pack(HEADER_FORMAT, PACK_MAGIC,
+                PACK_VERSION))
+            offset = calcsize(HEADER_FORMAT)
+
+            for name in loose_names:
+                document = path_join(directory, name)
+                try:
+                    mtime = getmtime(document + '.' + JOINED_ANN_FILE_SUFF)
+                except OSError:
+                    mtime = -1
+                files = []
+                for suffix, data in _loose_document_files(document,
+                        suffixes):
+                    pack_file.write(data)
+                    files.append([suffix, offset, len(data)])
+                    offset += len(data)
+                if len(files) == 1:
+                    # Only a text, as for a loose document opened for the
+                    # first time there are no annotations yet
+                    files.append([JOINED_ANN_FILE_SUFF, offset, 0])
+                index.append([name, mtime, files])
+
+            for name in packed_document_names(directory, loose_names):
+                files = []
+                for suffix in old_pack.get_suffixes(name):
+                    data = old_pack.read_file(name, suffix)
+                    pack_file.write(data)
+                    files.append([suffix, offset, len(data)])
+                    offset += len(data)
+                index.append([name, old_pack.get_mtime(name), files])
+
+            index_data = dumps(index)
+            if isinstance(index_data, unicode):
+                index_data = index_data.encode('utf-8')
+            pack_file.write(index_data)
+            pack_file.write(struct_pack(TRAILER_FORMAT, offset,
+                len(index_data), PACK_MAGIC))
+
+        # mkstemp creates files only readable by their owner
+        mask = umask(0)
+        umask(mask)
+        chmod(tmp_fname, 0666 & ~mask)
+        rename(tmp_fname, path_join(directory, PACK_FILE_NAME))
+    except:
+        remove(tmp_fname)
+        raise
+
+    if remove_loose:
+        for name in loose_names:
+            document = path_join(directory, name)
+            for suffix in suffixes + [JOINED_ANN_FILE_SUFF + '.'
+                    + JOURNAL_FILE_SUFF]:
+                if isfile(document + '.' + suffix):
+                    remove(document + '.' + suffix)
+    return len(index)
+
+
+def unpack_collection(directory, remove_pack=False):
+    '''
+    Copy the documents of the pack of the collection in the given directory
+    out as loose files, skipping documents that are loose already. If
+    remove_pack is True the pack is removed afterwards.
+
+    Returns:
+    The number of documents unpacked.
+    '''
+
+    pack = collection_pack(directory)
+    if pack is None:
+        return 0
+    unpacked = 0
+    for name in pack.get_names():
+        packed = packed_document(path_join(directory, name))
+        if packed is not None:
+            packed.unpack()
+            unpacked += 1
+    if remove_pack:
+        remove(pack.path)
+        _pack_by_path.pop(pack.path, None)
+    return unpacked
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+'''
+Memory-mapped access to the text of a document, decoding only the parts
+that are asked for.
+
+Annotation offsets count characters, but UTF-8 encodes characters in
+one to four bytes. The text is thus indexed by the runs of non-ASCII
+bytes it contains, which is all that is needed to translate a character
+offset into a byte offset; a text that is pure ASCII needs no index.
+'''
+
+from array import array
+from bisect import bisect_right
+from mmap import mmap, ACCESS_READ
+from re import compile as re_compile
+
+### Constants
+# Bytes outside of ASCII, never part of a UTF-8 character starting before
+# or ending after an ASCII byte
+NON_ASCII_RUN_REGEX = re_compile(r'[\x80-\xff]+')
+# Maximum number of characters per entry of the offset index, bounds the
+#   amount of text decoded to find an offset inside a run
+INDEX_RUN_LENGTH = 256
+###
+
+
+class DocumentText(object):
+    '''
+    The text of a document, read from a UTF-8 encoded file, that can be
+    sliced by character offsets like the unicode string it stands for.
+
+    Argument(s):
+    path - path to the text file, IOError is raised if it can't be read
+    data - the UTF-8 encoded text, if it is to be read from elsewhere than
+        the file (e.g. a pack, see docpack)
+    '''
+
+    def __init__(self, path, data=None):
+        self.path = path
+        # The whole text, once it has been decoded
+        self._text = None
+        # The encoded text, a string or the text file mapped into memory.
+        # The file is mapped again when needed after close().
+        self._map = data
+        if data is None:
+            self._map = self._map_file()
+
+        # Offset index, see _index()
+        self._run_char_starts = None
+        self._run_byte_starts = None
+        self._run_lengths = None
+        self._run_extra_bytes = None
+        self._length = None
+
+    def _map_file(self):
+        with open(self.path, 'rb') as text_file:
+            try:
+                return mmap(text_file.fileno(), 0, access=ACCESS_READ)
+            except ValueError:
+                # Empty files can't be mapped
+                return ''
+
+    def _encoded(self):
+        if self._map is None:
+            self._map = self._map_file()
+        return self._map
+
+    def _index(self):
+        '''
+        Build the index of the non-ASCII runs of the text, split into
+        entries of at most INDEX_RUN_LENGTH characters. For each entry
+        the index holds its character and byte offsets, its length in
+        characters and the number of bytes in excess of one per character
+        up to the end of it.
+        '''
+
+        char_starts = array('l')
+        byte_starts = array('l')
+        lengths = array('l')
+        extra_bytes = array('l')
+
+        encoded = self._encoded()
+        extra = 0
+        for m in NON_ASCII_RUN_REGEX.finditer(encoded):
+            # Decoding also catches any invalid byte sequences
+            run = m.group().decode('utf-8')
+            byte_start = m.start()
+            start = 0
+            while start < len(run):
+                end = min(start + INDEX_RUN_LENGTH, len(run))
+                if end < len(run) and u'\ud800' <= run[end - 1] <= u'\udbff':
+                    # Keep surrogate pairs together on narrow builds
+                    end += 1
+                byte_length = len(run[start:end].encode('utf-8'))
+                char_starts.append(byte_start - extra)
+                byte_starts.append(byte_start)
+                lengths.append(end - start)
+                extra += byte_length - (end - start)
+                extra_bytes.append(extra)
+                byte_start += byte_length
+                start = end
+
+        self._run_char_starts = char_starts
+        self._run_byte_starts = byte_starts
+        self._run_lengths = lengths
+        self._run_extra_bytes = extra_bytes
+        self._length = len(encoded) - extra
+
+    def _byte_offset(self, offset):
+        if self._length is None:
+            self._index()
+
+        i = bisect_right(self._run_char_starts, offset) - 1
+        if i < 0:
+            # Only ASCII before the offset
+            return offset
+
+        within = offset - self._run_char_starts[i]
+        if within >= self._run_lengths[i]:
+            # The offset is past the entry
+            return offset + self._run_extra_bytes[i]
+
+        byte_start = self._run_byte_starts[i]
+        extra_before = byte_start - self._run_char_starts[i]
+        byte_end = (byte_start + self._run_lengths[i] +
+                self._run_extra_bytes[i] - extra_before)
+        run = self._encoded()[byte_start:byte_end].decode('utf-8')
+        return byte_start + len(run[:within].encode('utf-8'))
+
+    def __len__(self):
+        if self._text is not None:
+            return len(self._text)
+        if self._length is None:
+            self._index()
+        return self._length
+
+    def __getitem__(self, key):
+        if self._text is not None:
+            return self._text[key]
+
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return self.get_text()[key]
+            if stop <= start:
+                return u''
+            return self._encoded()[self._byte_offset(start):
+                    self._byte_offset(stop)].decode('utf-8')
+
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('text index out of range')
+        return self[key:key + 1]
+
+    def get_text(self):
+        '''
+        Return the whole text as a unicode string.
+        '''
+
+        if self._text is None:
+            self._text = self._encoded()[:].decode('utf-8')
+            # Everything is served from the decoded text from now on
+            self.close()
+            self._map = None
+        return self._text
+
+    def __unicode__(self):
+        return self.get_text()
+
+    def close(self):
+        '''
+        Release the mapping of the text file, if any. The file is mapped
+        again if the text is read from it once more.
+        '''
+
+        if isinstance(self._map, mmap):
+            self._map.close()
+            self._map = None
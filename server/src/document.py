@@ -15,18 +15,20 @@ Version:    2011-04-21
 '''
 
 from os import listdir
-from os.path import abspath, dirname, isabs, isdir, normpath, getmtime
+from os.path import abspath, dirname, isabs, isdir, isfile, normpath, getmtime
 from os.path import join as path_join
 from re import match,sub
 from errno import ENOENT, EACCES
 
-from annotation import (TextAnnotations, TEXT_FILE_SUFFIX,
+from annotation import (TextAnnotationsView, TEXT_FILE_SUFFIX,
         AnnotationFileNotFoundError,
         AnnotationCollectionNotFoundError,
-        JOINED_ANN_FILE_SUFF,
+        JOINED_ANN_FILE_SUFF, JOURNAL_FILE_SUFF, KNOWN_FILE_SUFF,
         open_textfile,
         BIONLP_ST_2013_COMPATIBILITY)
 from common import ProtocolError, CollectionNotAccessibleError
+from docpack import packed_document, packed_document_names
+from offsetcache import text_offsets
 from config import BASE_DIR, DATA_DIR
 from projectconfig import (ProjectConfiguration, SEPARATOR_STR,
         SPAN_DRAWING_ATTRIBUTES, ARC_DRAWING_ATTRIBUTES,
@@ -35,6 +37,7 @@ from projectconfig import (ProjectConfiguration, SEPARATOR_STR,
         SPECIAL_RELATION_TYPES,
         options_get_validation, options_get_tokenization,
         options_get_ssplitter, get_annotation_config_section_labels,
+        get_config_paths,
         visual_options_get_arc_bundle,
         visual_options_get_text_direction)
 from stats import get_statistics
@@ -44,6 +47,18 @@ from annlog import annotation_logging_active
 
 from itertools import chain
 
+### Constants
+# Number of hexadecimal digits of the document versions given to the
+#   client, see _document_version()
+DOCUMENT_VERSION_LENGTH = 16
+# Categories of the records of the document JSON that edits can return
+#   changes to, see _json_delta()
+DELTA_CATEGORIES = ('entities', 'triggers', 'events', 'relations',
+        'attributes', 'normalizations', 'comments', )
+# Units of the windows of get_document_range()
+DOCUMENT_RANGE_UNITS = ('char', 'sentence', )
+###
+
 def _fill_type_configuration(nodes, project_conf, hotkey_by_type, all_connections=None):
     # all_connections is an optimization to reduce invocations of
     # projectconfig methods such as arc_types_from_to.
@@ -432,6 +447,24 @@ def _listdir(directory):
         Messager.error("Error listing %s: %s" % (directory, e))
         raise AnnotationCollectionNotFoundError(directory)
 
+def _document_names(real_dir):
+    # The documents of a collection, those with a text file in the
+    # directory followed by those only in the pack of the collection
+    base_names = [fn[0:-4] for fn in _listdir(real_dir)
+            if fn.endswith('txt')]
+    return base_names + [n for n in packed_document_names(real_dir,
+        base_names) if allowed_to_read(path_join(real_dir,
+            n + '.' + TEXT_FILE_SUFFIX))]
+
+def _document_mtime(document):
+    # Modification time of the annotations of a document, see _getmtime()
+    mtime = _getmtime(document + '.' + JOINED_ANN_FILE_SUFF)
+    if mtime == -1:
+        packed = packed_document(document)
+        if packed is not None:
+            return packed.get_mtime()
+    return mtime
+
 def _getmtime(file_path):
     '''
     Internal wrapper of getmtime that handles access denied and invalid paths
@@ -514,8 +547,7 @@ def get_directory_information(collection):
     assert_allowed_to_read(real_dir)
 
     # Get the document names
-    base_names = [fn[0:-4] for fn in _listdir(real_dir)
-            if fn.endswith('txt')]
+    base_names = _document_names(real_dir)
 
     doclist = base_names[:]
     doclist_header = [("Document", "string")]
@@ -523,9 +555,8 @@ def get_directory_information(collection):
     # Then get the modification times
     doclist_with_time = []
     for file_name in doclist:
-        file_path = path_join(DATA_DIR, real_dir,
-            file_name + "." + JOINED_ANN_FILE_SUFF)
-        doclist_with_time.append([file_name, _getmtime(file_path)])
+        doclist_with_time.append([file_name,
+            _document_mtime(path_join(DATA_DIR, real_dir, file_name))])
     doclist = doclist_with_time
     doclist_header.append(("Modified", "time"))
 
@@ -622,28 +653,15 @@ class IsDirectoryError(ProtocolError):
         return json_dic
 
 #TODO: All this enrichment isn't a good idea, at some point we need an object
-def _enrich_json_with_text(j_dic, txt_file_path, raw_text=None):
-    if raw_text is not None:
-        # looks like somebody read this already; nice
-        text = raw_text
-    else:
-        # need to read raw text
-        try:
-            with open_textfile(txt_file_path, 'r') as txt_file:
-                text = txt_file.read()
-        except IOError:
-            raise UnableToReadTextFile(txt_file_path)
-        except UnicodeDecodeError:
-            Messager.error('Error reading text file: nonstandard encoding or binary?', -1)
-            raise UnableToReadTextFile(txt_file_path)
-
-    j_dic['text'] = text
-
-    from logging import info as log_info
+def _offset_generators(directory):
+    '''
+    Return the functions generating the token and sentence offsets of the
+    texts of the documents in the given directory, as configured.
+    '''
 
-    tokeniser = options_get_tokenization(dirname(txt_file_path))
+    tokeniser = options_get_tokenization(directory)
 
-    # First, generate tokenisation
+    # First, choose the tokenisation
     if tokeniser == 'mecab':
         from tokenise import jp_token_boundary_gen
         tok_offset_gen = jp_token_boundary_gen
@@ -658,9 +676,8 @@ def _enrich_json_with_text(j_dic, txt_file_path, raw_text=None):
                 ', reverting to whitespace tokenisation.')
         from tokenise import whitespace_token_boundary_gen
         tok_offset_gen = whitespace_token_boundary_gen
-    j_dic['token_offsets'] = [o for o in tok_offset_gen(text)]
 
-    ssplitter = options_get_ssplitter(dirname(txt_file_path))
+    ssplitter = options_get_ssplitter(directory)
     if ssplitter == 'newline':
         from ssplit import newline_sentence_boundary_gen
         ss_offset_gen = newline_sentence_boundary_gen
@@ -672,32 +689,84 @@ def _enrich_json_with_text(j_dic, txt_file_path, raw_text=None):
                 ', reverting to newline sentence splitting.')
         from ssplit import newline_sentence_boundary_gen
         ss_offset_gen = newline_sentence_boundary_gen
-    j_dic['sentence_offsets'] = [o for o in ss_offset_gen(text)]
+
+    return tok_offset_gen, ss_offset_gen
+
+def _enrich_json_with_text(j_dic, txt_file_path, raw_text=None):
+    if raw_text is not None:
+        # looks like somebody read this already; nice
+        text = raw_text
+    else:
+        # need to read raw text
+        try:
+            with open_textfile(txt_file_path, 'r') as txt_file:
+                text = txt_file.read()
+        except IOError:
+            raise UnableToReadTextFile(txt_file_path)
+        except UnicodeDecodeError:
+            Messager.error('Error reading text file: nonstandard encoding or binary?', -1)
+            raise UnableToReadTextFile(txt_file_path)
+
+    j_dic['text'] = text
+
+    tok_offset_gen, ss_offset_gen = _offset_generators(
+            dirname(txt_file_path))
+
+    # The text never changes, the offsets are thus cached
+    j_dic['token_offsets'], j_dic['sentence_offsets'] = text_offsets(
+            txt_file_path, text, tok_offset_gen, ss_offset_gen)
 
     return True
 
-def _enrich_json_with_data(j_dic, ann_obj):
-    # TODO: figure out if there's a reason for all the unicode()
-    # invocations here; remove if not.
+# The JSON records of the annotations of each kind, as sent to the client
+# TODO: figure out if there's a reason for all the unicode()
+# invocations here; remove if not.
+
+# The records never share the containers of the annotations: responses
+# may be serialised (see jsonwrap.iterdumps()) after the annotations have
+# been handed over to the memory cache and changed by another request
 
+def _event_json(event_ann):
+    return [unicode(event_ann.id), unicode(event_ann.trigger),
+            list(event_ann.args)]
+
+def _relation_json(rel_ann):
+    return [unicode(rel_ann.id), unicode(rel_ann.type),
+            [(rel_ann.arg1l, rel_ann.arg1),
+             (rel_ann.arg2l, rel_ann.arg2)]]
+
+def _textbound_json(tb_ann):
+    #j_tb = [unicode(tb_ann.id), tb_ann.type, tb_ann.start, tb_ann.end]
+    return [unicode(tb_ann.id), tb_ann.type, list(tb_ann.spans)]
+
+def _equiv_json(eq_ann):
+    return ['*', eq_ann.type] + list(eq_ann.entities)
+
+def _attribute_json(att_ann):
+    return [unicode(att_ann.id), unicode(att_ann.type),
+            unicode(att_ann.target), att_ann.value]
+
+def _normalization_json(norm_ann):
+    return [unicode(norm_ann.id), unicode(norm_ann.type),
+            unicode(norm_ann.target), unicode(norm_ann.refdb),
+            unicode(norm_ann.refid), unicode(norm_ann.reftext)]
+
+def _comment_json(com_ann):
+    return [unicode(com_ann.target), unicode(com_ann.type),
+            com_ann.tail.strip()]
+
+def _enrich_json_with_data(j_dic, ann_obj):
     # We collect trigger ids to be able to link the textbound later on
     trigger_ids = set()
     for event_ann in ann_obj.get_events():
         trigger_ids.add(event_ann.trigger)
-        j_dic['events'].append(
-                [unicode(event_ann.id), unicode(event_ann.trigger), event_ann.args]
-                )
+        j_dic['events'].append(_event_json(event_ann))
 
     for rel_ann in ann_obj.get_relations():
-        j_dic['relations'].append(
-            [unicode(rel_ann.id), unicode(rel_ann.type),
-             [(rel_ann.arg1l, rel_ann.arg1),
-              (rel_ann.arg2l, rel_ann.arg2)]]
-            )
+        j_dic['relations'].append(_relation_json(rel_ann))
 
     for tb_ann in ann_obj.get_textbounds():
-        #j_tb = [unicode(tb_ann.id), tb_ann.type, tb_ann.start, tb_ann.end]
-        j_tb = [unicode(tb_ann.id), tb_ann.type, tb_ann.spans]
+        j_tb = _textbound_json(tb_ann)
 
         # If we spotted it in the previous pass as a trigger for an
         # event or if the type is known to be an event type, we add it
@@ -723,26 +792,16 @@ def _enrich_json_with_data(j_dic, ann_obj):
 
 
     for eq_ann in ann_obj.get_equivs():
-        j_dic['equivs'].append(
-                (['*', eq_ann.type]
-                    + [e for e in eq_ann.entities])
-                )
+        j_dic['equivs'].append(_equiv_json(eq_ann))
 
     for att_ann in ann_obj.get_attributes():
-        j_dic['attributes'].append(
-                [unicode(att_ann.id), unicode(att_ann.type), unicode(att_ann.target), att_ann.value]
-                )
+        j_dic['attributes'].append(_attribute_json(att_ann))
 
     for norm_ann in ann_obj.get_normalizations():
-        j_dic['normalizations'].append(
-                [unicode(norm_ann.id), unicode(norm_ann.type),
-                 unicode(norm_ann.target), unicode(norm_ann.refdb),
-                 unicode(norm_ann.refid), unicode(norm_ann.reftext)]
-                )
+        j_dic['normalizations'].append(_normalization_json(norm_ann))
 
     for com_ann in ann_obj.get_oneline_comments():
-        comment = [unicode(com_ann.target), unicode(com_ann.type),
-                com_ann.tail.strip()]
+        comment = _comment_json(com_ann)
         try:
             j_dic['comments'].append(comment)
         except KeyError:
@@ -794,6 +853,86 @@ def _enrich_json_with_data(j_dic, ann_obj):
     ann_files.sort()
     j_dic['source_files'] = ann_files
 
+def _sentences_crossed(sentence_offsets, spans):
+    # Does any of the spans cross the end of a sentence?
+    from bisect import bisect_right
+    s_ends = [s_end for _, s_end in sentence_offsets[:-1]]
+    for start, end in spans:
+        i = bisect_right(s_ends, start)
+        if i < len(s_ends) and s_ends[i] < end:
+            return True
+    return False
+
+def _json_delta(ann_obj, ids, spans):
+    '''
+    Return the changes to the document JSON (see _document_json_dict())
+    made by an edit that touched the annotations with the given ids and
+    the given text-bound spans (before and after the edit).
+
+    The records of the edited annotations replace all records of the
+    client that are keyed by the ids listed under "removed". The keys are
+    the first field of each record, the target id for comments. The
+    records come under the same categories (DELTA_CATEGORIES) as in the
+    document JSON. The equivs are given in full, and so are the sentence
+    offsets if the spans may have changed how the sentences are merged.
+    '''
+    from annotation import (AnnotationNotFoundError, AttributeAnnotation,
+            BinaryRelationAnnotation, EventAnnotation,
+            NormalizationAnnotation, OnelineCommentAnnotation,
+            TextBoundAnnotation)
+
+    delta = dict((category, []) for category in DELTA_CATEGORIES)
+    for id in ids:
+        try:
+            ann = ann_obj.get_ann_by_id(id)
+        except AnnotationNotFoundError:
+            # Deleted
+            continue
+        dependants = ann_obj.get_dependants(id)
+
+        if isinstance(ann, TextBoundAnnotation):
+            j_tb = _textbound_json(ann)
+            if any(isinstance(dep, EventAnnotation) and dep.trigger == id
+                    for dep in dependants):
+                delta['triggers'].append(j_tb)
+                # As in _enrich_json_with_data()
+                if (BIONLP_ST_2013_COMPATIBILITY and
+                        ann.id in ann_obj.externally_referenced_triggers):
+                    delta['entities'].append(j_tb)
+            else:
+                delta['entities'].append(j_tb)
+        elif isinstance(ann, EventAnnotation):
+            delta['events'].append(_event_json(ann))
+        elif isinstance(ann, BinaryRelationAnnotation):
+            delta['relations'].append(_relation_json(ann))
+        elif isinstance(ann, AttributeAnnotation):
+            delta['attributes'].append(_attribute_json(ann))
+        elif isinstance(ann, NormalizationAnnotation):
+            delta['normalizations'].append(_normalization_json(ann))
+
+        for dep in dependants:
+            if isinstance(dep, OnelineCommentAnnotation):
+                delta['comments'].append(_comment_json(dep))
+
+    delta['removed'] = sorted(ids)
+    delta['equivs'] = [_equiv_json(eq_ann) for eq_ann in ann_obj.get_equivs()]
+
+    # The sentences that annotations cross are merged, which can only
+    #   change for the sentences that the edited spans cross
+    if spans:
+        txt_file_path = ann_obj.get_document() + '.' + TEXT_FILE_SUFFIX
+        tok_offset_gen, ss_offset_gen = _offset_generators(
+                dirname(txt_file_path))
+        _, sentence_offsets = text_offsets(txt_file_path,
+                ann_obj.get_document_text(), tok_offset_gen, ss_offset_gen)
+        if _sentences_crossed(sentence_offsets, spans):
+            delta['sentence_offsets'] = _merge_crossed_sentences(
+                    sentence_offsets, ann_obj)
+
+    delta['mtime'] = ann_obj.ann_mtime
+    delta['ctime'] = ann_obj.ann_ctime
+    return delta
+
 def _enrich_json_with_base(j_dic):
     # TODO: Make the names here and the ones in the Annotations object conform
 
@@ -815,6 +954,25 @@ def _enrich_json_with_base(j_dic):
         ):
         j_dic[d] = []
 
+def _merge_crossed_sentences(sentence_offsets, ann_obj):
+    '''
+    Return the given sentence offsets with each sentence whose end is
+    crossed by a span of an annotation merged with the sentence after it.
+    '''
+    crossed = ann_obj.crossed_offsets(s_end
+            for _, s_end in sentence_offsets[:-1])
+    return _merge_sentences(sentence_offsets, crossed)
+
+def _merge_sentences(sentence_offsets, crossed):
+    # Merge each sentence ending at a crossed offset with the one after it
+    merged = []
+    for s_offsets in sentence_offsets:
+        if merged and merged[-1][1] in crossed:
+            merged[-1] = (merged[-1][0], s_offsets[1])
+        else:
+            merged.append(s_offsets)
+    return merged
+
 def _document_json_dict(document):
     #TODO: DOC!
 
@@ -825,55 +983,357 @@ def _document_json_dict(document):
     j_dic = {}
     _enrich_json_with_base(j_dic)
 
-    #TODO: We don't check if the files exist, let's be more error friendly
-    # Read in the textual data to make it ready to push
-    _enrich_json_with_text(j_dic, document + '.' + TEXT_FILE_SUFFIX)
+    txt_file_path = document + '.' + TEXT_FILE_SUFFIX
+    if not isfile(txt_file_path) and packed_document(document) is None:
+        raise UnableToReadTextFile(txt_file_path)
+
+    with TextAnnotationsView(document) as ann_obj:
+        # Read in the textual data to make it ready to push, the
+        #   annotations hold the text already
+        try:
+            text = ann_obj.get_document_text()
+        except UnicodeDecodeError:
+            Messager.error('Error reading text file: nonstandard encoding or binary?', -1)
+            raise UnableToReadTextFile(txt_file_path)
+        _enrich_json_with_text(j_dic, txt_file_path, text)
 
-    with TextAnnotations(document) as ann_obj:
         # Note: At this stage the sentence offsets can conflict with the
         #   annotations, we thus merge any sentence offsets that lie within
         #   annotations
-        # XXX: ~O(tb_ann * sentence_breaks), can be optimised
         # XXX: The merge strategy can lead to unforeseen consequences if two
         #   sentences are not adjacent (the format allows for this:
         #   S_1: [0, 10], S_2: [15, 20])
-        s_breaks = j_dic['sentence_offsets']
-        for tb_ann in ann_obj.get_textbounds():
-            s_i = 0
-            while s_i < len(s_breaks):
-                s_start, s_end = s_breaks[s_i]
-                # Does any subspan of the annotation strech over the
-                # end of the sentence?
-                found_spanning = False
-                for tb_start, tb_end in tb_ann.spans:
-                    if tb_start < s_end and tb_end > s_end:
-                        found_spanning = True
-                        break
-                if found_spanning:
-                    # Merge this sentence and the next sentence
-                    s_breaks[s_i] = (s_start, s_breaks[s_i + 1][1])
-                    del s_breaks[s_i + 1]
-                else:
-                    s_i += 1
+        j_dic['sentence_offsets'] = _merge_crossed_sentences(
+                j_dic['sentence_offsets'], ann_obj)
 
         _enrich_json_with_data(j_dic, ann_obj)
 
     return j_dic
 
-def get_document(collection, document):
+def _document_version(document):
+    '''
+    Return the version of the given document (path without a suffix) as
+    returned to the client, which changes whenever the files of the
+    document or the project configuration used for it change.
+    '''
+    from hashlib import sha1
+    from os import stat
+
+    source_paths = [document + '.' + suff for suff in chain(KNOWN_FILE_SUFF,
+            (JOINED_ANN_FILE_SUFF + '.' + JOURNAL_FILE_SUFF,
+                TEXT_FILE_SUFFIX))]
+    packed = packed_document(document)
+    if packed is not None:
+        source_paths.append(packed.pack.path)
+    source_paths.extend(get_config_paths(dirname(document)))
+
+    sources = []
+    for path in source_paths:
+        try:
+            st = stat(path)
+            sources.append(u'%s\t%d\t%d\t%r' % (path, st.st_ino,
+                st.st_size, st.st_mtime))
+        except (OSError, TypeError):
+            # Missing or, for configurations, the defaults
+            sources.append(u'%s' % (path, ))
+    return sha1(u'\n'.join(sources).encode('utf-8')).hexdigest()[
+            :DOCUMENT_VERSION_LENGTH]
+
+def get_document(collection, document, if_version=None):
     directory = collection
     real_dir = real_directory(directory)
     doc_path = path_join(real_dir, document)
-    return _document_json_dict(doc_path)
+
+    # Determined before reading the document, in case it changes meanwhile
+    version = _document_version(doc_path)
+    if if_version is not None and if_version == version:
+        # The client already has the document as it is
+        assert_allowed_to_read(real_dir)
+        return {
+                'unchanged': True,
+                'document_version': version,
+                }
+
+    j_dic = _document_json_dict(doc_path)
+    j_dic['document_version'] = version
+    return j_dic
+
+class InvalidDocumentRangeError(ProtocolError):
+    def __init__(self, start, end, unit):
+        self.start = start
+        self.end = end
+        self.unit = unit
+
+    def __str__(self):
+        return u'Invalid document range from %s to %s (unit "%s")' % (
+                self.start, self.end, self.unit)
+
+    def json(self, json_dic):
+        json_dic['exception'] = 'invalidDocumentRange'
+        return json_dic
+
+def _window_offsets(offsets, start, end):
+    # The offsets (in order, not overlapping) overlapping the window,
+    #   clipped to it
+    from bisect import bisect_left
+    first = max(bisect_left(offsets, (start, )) - 1, 0)
+    last = bisect_left(offsets, (end, ))
+    return [(max(o_start, start), min(o_end, end))
+            for o_start, o_end in offsets[first:last] if o_end > start]
+
+def _enrich_json_with_window_data(j_dic, ann_obj, start, end):
+    # As _enrich_json_with_data() for the annotations overlapping the
+    #   window from start to end, found through the span index and the
+    #   references to them. Returns the arcs with an end outside of it.
+    from annotation import (AttributeAnnotation, BinaryRelationAnnotation,
+            EquivAnnotation, EventAnnotation, NormalizationAnnotation,
+            OnelineCommentAnnotation)
+
+    textbounds = ann_obj.overlapping(start, end)
+    events = []
+    for tb_ann in textbounds:
+        for dep in ann_obj.get_dependants(tb_ann.id):
+            if isinstance(dep, EventAnnotation) and dep.trigger == tb_ann.id:
+                events.append(dep)
+    trigger_ids = set(e_ann.trigger for e_ann in events)
+    in_ids = set(chain((tb_ann.id for tb_ann in textbounds),
+        (e_ann.id for e_ann in events)))
+
+    for tb_ann in textbounds:
+        # Relative to the window and clipped to it
+        spans = [(max(t_start, start) - start, min(t_end, end) - start)
+                for t_start, t_end in tb_ann.spans
+                if t_start < end and t_end > start]
+        j_tb = [unicode(tb_ann.id), tb_ann.type, spans]
+        if tb_ann.id in trigger_ids:
+            j_dic['triggers'].append(j_tb)
+            # As in _enrich_json_with_data()
+            if (BIONLP_ST_2013_COMPATIBILITY and
+                    tb_ann.id in ann_obj.externally_referenced_triggers):
+                j_dic['entities'].append(j_tb)
+        else:
+            j_dic['entities'].append(j_tb)
+
+    external_arcs = []
+    for e_ann in events:
+        args = []
+        for role, arg in e_ann.args:
+            if arg in in_ids:
+                args.append((role, arg))
+            else:
+                external_arcs.append([unicode(e_ann.id), role,
+                    unicode(e_ann.id), unicode(arg)])
+        j_dic['events'].append(
+                [unicode(e_ann.id), unicode(e_ann.trigger), args])
+
+    # Whatever references the annotations in the window
+    seen = set()
+    equivs = []
+    modifier_target_ids = set(in_ids)
+    for id in sorted(in_ids):
+        for dep in ann_obj.get_dependants(id):
+            if dep in seen:
+                continue
+            seen.add(dep)
+            if isinstance(dep, EventAnnotation):
+                if dep.id not in in_ids:
+                    external_arcs.extend([unicode(dep.id), role,
+                        unicode(dep.id), unicode(arg)]
+                        for role, arg in dep.args if arg in in_ids)
+            elif isinstance(dep, BinaryRelationAnnotation):
+                if dep.arg1 in in_ids and dep.arg2 in in_ids:
+                    j_dic['relations'].append(_relation_json(dep))
+                    modifier_target_ids.add(dep.id)
+                else:
+                    external_arcs.append([unicode(dep.id), unicode(dep.type),
+                        unicode(dep.arg1), unicode(dep.arg2)])
+            elif isinstance(dep, EquivAnnotation):
+                equivs.append(dep)
+
+    for eq_ann in equivs:
+        members = [e for e in eq_ann.entities if e in in_ids]
+        if len(members) > 1:
+            j_dic['equivs'].append(['*', eq_ann.type] + members)
+        external_arcs.extend(['*', eq_ann.type, members[0], e]
+                for e in eq_ann.entities if e not in in_ids)
+
+    for id in sorted(modifier_target_ids):
+        for dep in ann_obj.get_dependants(id):
+            if isinstance(dep, AttributeAnnotation):
+                j_dic['attributes'].append(_attribute_json(dep))
+            elif isinstance(dep, NormalizationAnnotation):
+                j_dic['normalizations'].append(_normalization_json(dep))
+            elif isinstance(dep, OnelineCommentAnnotation):
+                j_dic['comments'].append(_comment_json(dep))
+
+    j_dic['mtime'] = ann_obj.ann_mtime
+    j_dic['ctime'] = ann_obj.ann_ctime
+    return external_arcs
+
+def get_document_range(collection, document, start, end, unit=None):
+    '''
+    Return the document JSON (see get_document()) for a window of the
+    document, the characters from start to end or for the unit "sentence"
+    the sentences from start to end (end excluded).
+
+    Only the text of the window, the tokens and sentences in it and the
+    annotations overlapping it are returned, with offsets relative to the
+    window and spans clipped to it. "window" gives the offsets of the
+    window in the document. Arcs with an end outside of the window are
+    left out of the events, relations and equivs and are listed under
+    "external_arcs" as [id, type, origin, target] instead, "*" being the
+    id of equivs and the id of the event that of its arguments.
+    '''
+
+    directory = collection
+    real_dir = real_directory(directory)
+    doc_path = path_join(real_dir, document)
+
+    if unit is None:
+        unit = 'char'
+    try:
+        start, end = int(start), int(end)
+    except ValueError:
+        raise InvalidDocumentRangeError(start, end, unit)
+    if unit not in DOCUMENT_RANGE_UNITS or start < 0 or end < start:
+        raise InvalidDocumentRangeError(start, end, unit)
+
+    # pointing at directory instead of document?
+    if isdir(doc_path):
+        raise IsDirectoryError(doc_path)
+    txt_file_path = doc_path + '.' + TEXT_FILE_SUFFIX
+    if not isfile(txt_file_path) and packed_document(doc_path) is None:
+        raise UnableToReadTextFile(txt_file_path)
+
+    # Determined before reading the document, in case it changes meanwhile
+    version = _document_version(doc_path)
+
+    j_dic = {}
+    _enrich_json_with_base(j_dic)
+    with TextAnnotationsView(doc_path) as ann_obj:
+        # The tokens and sentences are those of the whole text, cut at
+        #   the window edges, as tokenising or sentence splitting only the
+        #   text of the window could split them differently. Only the text
+        #   of the window is decoded once the offsets are cached.
+        text = ann_obj.get_document_text_accessor()
+        tok_offset_gen, ss_offset_gen = _offset_generators(
+                dirname(txt_file_path))
+        try:
+            token_offsets, sentence_offsets = text_offsets(txt_file_path,
+                    text, tok_offset_gen, ss_offset_gen)
+            if unit == 'sentence':
+                sentence_offsets = sentence_offsets[start:end]
+                if sentence_offsets:
+                    w_start = sentence_offsets[0][0]
+                    w_end = sentence_offsets[-1][1]
+                else:
+                    w_start = w_end = len(text)
+            else:
+                w_start, w_end = min(start, len(text)), min(end, len(text))
+                sentence_offsets = _window_offsets(sentence_offsets,
+                        w_start, w_end)
+            token_offsets = _window_offsets(token_offsets, w_start, w_end)
+            w_text = text[w_start:w_end]
+        except UnicodeDecodeError:
+            Messager.error('Error reading text file: nonstandard encoding or binary?', -1)
+            raise UnableToReadTextFile(txt_file_path)
+
+        # As in _document_json_dict(), for the sentence ends in the window
+        crossed = set(s_end for _, s_end in sentence_offsets[:-1]
+                if ann_obj.overlapping(s_end, s_end))
+        sentence_offsets = _merge_sentences(sentence_offsets, crossed)
+
+        j_dic['external_arcs'] = _enrich_json_with_window_data(j_dic,
+                ann_obj, w_start, w_end)
+
+    j_dic['text'] = w_text
+    j_dic['token_offsets'] = [(t_start - w_start, t_end - w_start)
+            for t_start, t_end in token_offsets]
+    j_dic['sentence_offsets'] = [(s_start - w_start, s_end - w_start)
+            for s_start, s_end in sentence_offsets]
+    j_dic['window'] = (w_start, w_end)
+    j_dic['document_version'] = version
+    return j_dic
 
 def get_document_timestamp(collection, document):
     directory = collection
     real_dir = real_directory(directory)
     assert_allowed_to_read(real_dir)
     doc_path = path_join(real_dir, document)
-    ann_path = doc_path + '.' + JOINED_ANN_FILE_SUFF
-    mtime = _getmtime(ann_path)
+    mtime = _document_mtime(doc_path)
 
     return {
             'mtime': mtime,
             }
+
+if __name__ == '__main__':
+    # Needs a configured installation, documents are written under DATA_DIR
+    from unittest import TestCase
+    from tempfile import mkdtemp
+    from shutil import rmtree
+    import unittest
+
+    from session import init_session
+
+    class _CollectionTest(TestCase):
+        def setUp(self):
+            init_session('127.0.0.1')
+            self.real_dir = mkdtemp(dir=DATA_DIR)
+            self.collection = '/%s/' % (self.real_dir[len(DATA_DIR):]
+                    .strip('/'), )
+            with open(path_join(self.real_dir, 'doc.txt'), 'w') as txt_file:
+                txt_file.write('Abc def ghi.\n')
+            with open(path_join(self.real_dir, 'doc.ann'), 'w') as ann_file:
+                ann_file.write('T1\tProtein 0 3\tAbc\n')
+
+        def tearDown(self):
+            rmtree(self.real_dir)
+
+    class DocumentVersionTest(_CollectionTest):
+        def _assert_current(self, version):
+            # The client sends the version that it has as if_version
+            self.assertTrue(get_document(self.collection, 'doc',
+                if_version=version).get('unchanged'),
+                'version %s not taken as current' % (version, ))
+
+        def test_unchanged(self):
+            version = get_document(self.collection, 'doc')['document_version']
+            self._assert_current(version)
+
+        def test_edited(self):
+            from annotator import create_span
+
+            version = get_document(self.collection, 'doc')['document_version']
+            response = create_span(self.collection, 'doc', '[[4, 7]]',
+                    'Protein', delta='true')
+            self.assertNotEqual(response['document_version'], version)
+            self._assert_current(response['document_version'])
+
+            response = create_span(self.collection, 'doc', '[[8, 11]]',
+                    'Protein')
+            self._assert_current(
+                    response['annotations']['document_version'])
+
+    class DocumentRangeTest(_CollectionTest):
+        def test_window_inside_word(self):
+            # "Cannot" is a single word but two tokens, the window starts
+            #   inside of "Can"
+            with open(path_join(self.real_dir, 'tools.conf'), 'w') as conf:
+                conf.write('[options]\nTokens\ttokenizer:ptblike\n')
+            with open(path_join(self.real_dir, 'doc.txt'), 'w') as txt_file:
+                txt_file.write('Cannot stop.\n')
+            with open(path_join(self.real_dir, 'doc.ann'), 'w') as ann_file:
+                ann_file.write('T1\tProtein 0 3\tCan\n')
+
+            j_dic = get_document_range(self.collection, 'doc', 1, 9)
+            self.assertEqual(j_dic['text'], u'annot st')
+            # The tokens of the whole text cut at the window edges, not
+            #   those of the text of the window
+            self.assertEqual([tuple(t) for t in j_dic['token_offsets']],
+                    [(0, 2), (2, 5), (6, 8)])
+            self.assertEqual([tuple(s) for s in j_dic['sentence_offsets']],
+                    [(0, 8)])
+            self.assertEqual(j_dic['entities'],
+                    [['T1', 'Protein', [(0, 2)]]])
+
+    unittest.main()
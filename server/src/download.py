@@ -7,20 +7,34 @@ Version:    2011-10-03
 
 from __future__ import with_statement
 
-from os import close as os_close, remove
-from os.path import join as path_join, dirname, basename, normpath
+from os import close as os_close, remove, walk
+from os.path import join as path_join, dirname, basename, normpath, isfile
+from os.path import relpath
 from tempfile import mkstemp
 
 from document import real_directory
-from annotation import open_textfile
+from annotation import (open_textfile, AnnotationsView,
+        JOINED_ANN_FILE_SUFF, JOURNAL_FILE_SUFF)
+from docpack import packed_document
 from common import NoPrintJSONError
 from subprocess import Popen
+from contextlib import closing
+from gzip import GzipFile
+from shutil import copyfileobj
 
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
 
+def _journaled_ann_data(document):
+    # The annotation file of a document as of its edit journal (see
+    # ANNOTATION_JOURNAL), None if it has no journal
+    ann_path = document + '.' + JOINED_ANN_FILE_SUFF
+    if not isfile(ann_path + '.' + JOURNAL_FILE_SUFF):
+        return None
+    return unicode(AnnotationsView(document)).encode('utf-8')
+
 def download_file(document, collection, extension):
     directory = collection
     real_dir = real_directory(directory)
@@ -30,8 +44,22 @@ def download_file(document, collection, extension):
     hdrs = [('Content-Type', 'text/plain; charset=utf-8'),
             ('Content-Disposition',
                 'inline; filename=%s' % fname)]
-    with open_textfile(fpath, 'r') as txt_file:
-        data = txt_file.read().encode('utf-8')
+    try:
+        data = None
+        if extension == JOINED_ANN_FILE_SUFF:
+            # Edits may still be in the journal of the file
+            data = _journaled_ann_data(path_join(real_dir, document))
+        if data is None:
+            with open_textfile(fpath, 'r') as txt_file:
+                data = txt_file.read().encode('utf-8')
+    except IOError:
+        packed = packed_document(path_join(real_dir, document))
+        if packed is None:
+            raise
+        try:
+            data = packed.read_file(extension)
+        except KeyError:
+            raise IOError('No such file: %s' % fpath)
     raise NoPrintJSONError(hdrs, data)
 
 def find_in_directory_tree(directory, filename):
@@ -51,6 +79,22 @@ def find_in_directory_tree(directory, filename):
         depth += 1
     return (None, None)
 
+def _journaled_ann_files(real_dir, dir_name, journal_suffix):
+    # The (name in the archive, data) of the annotation files under the
+    # given directory that have an edit journal
+    journaled = []
+    for root, _, fnames in walk(real_dir):
+        for fname in sorted(fnames):
+            if not fname.endswith(journal_suffix):
+                continue
+            document = path_join(root, fname[:-len(journal_suffix)])
+            data = _journaled_ann_data(document)
+            if data is not None:
+                name = path_join(dir_name, relpath(document, real_dir)
+                        + '.' + JOINED_ANN_FILE_SUFF)
+                journaled.append((name, data))
+    return journaled
+
 def download_collection(collection, include_conf=False):
     directory = collection
     real_dir = real_directory(directory)
@@ -88,15 +132,39 @@ def download_collection(collection, include_conf=False):
                 tar_cmd_split.extend(['--absolute-names', '--transform',
                                       's|.*\\.\\.|%s|' %dir_name])
 
-        tar_cmd_split.extend(['-c', '-z', '-f', tmp_file_path, dir_name])
+        # The edit journals are internal, the annotation files with edits
+        # still in a journal are added as of the journal instead
+        journal_suffix = '.%s.%s' % (JOINED_ANN_FILE_SUFF, JOURNAL_FILE_SUFF)
+        tar_cmd_split.append('--exclude=*%s' % journal_suffix)
+        journaled = _journaled_ann_files(real_dir, dir_name, journal_suffix)
+        if journaled:
+            tar_cmd_split.append('--anchored')
+            tar_cmd_split.extend(['--exclude=%s' % name
+                for name, _ in journaled])
+
+        tar_cmd_split.extend(['-c', '-f', tmp_file_path, dir_name])
         tar_cmd_split.extend(conf_names)
         tar_p = Popen(tar_cmd_split, cwd=path_join(real_dir, '..'))
         tar_p.wait()
 
+        if journaled:
+            from tarfile import open as tar_open, TarInfo
+            from time import time
+            with closing(tar_open(tmp_file_path, 'a')) as tar:
+                for name, data in journaled:
+                    info = TarInfo(name)
+                    info.size = len(data)
+                    info.mtime = time()
+                    info.mode = 0644
+                    tar.addfile(info, StringIO(data))
+
         hdrs = [('Content-Type', 'application/octet-stream'), #'application/x-tgz'),
                 ('Content-Disposition', 'inline; filename=%s' % fname)]
+        tar_data = StringIO()
         with open(tmp_file_path, 'rb') as tmp_file:
-            tar_data = tmp_file.read()
+            with closing(GzipFile(fileobj=tar_data, mode='wb')) as gz_file:
+                copyfileobj(tmp_file, gz_file)
+        tar_data = tar_data.getvalue()
 
         raise NoPrintJSONError(hdrs, tar_data)
     finally:
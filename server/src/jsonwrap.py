@@ -52,6 +52,51 @@ def dumps(dic):
 #     return lib_dumps(dic, sort_keys=True, indent=2)
     return lib_dumps(dic)
 
+# Chunks given by iterdumps() are of (at least) this many characters
+STREAM_CHUNK_SIZE = 64 * 1024
+# and long lists are serialised this many items at a time
+STREAM_LIST_SLICE = 1024
+
+def _iterencode(obj):
+    # Serialise objects and long lists in parts, anything else as a whole
+    if (isinstance(obj, dict)
+            and all(isinstance(k, basestring) for k in obj)):
+        yield '{'
+        sep = ''
+        for key, val in obj.iteritems():
+            yield sep + lib_dumps(key) + ': '
+            for part in _iterencode(val):
+                yield part
+            sep = ', '
+        yield '}'
+    elif isinstance(obj, (list, tuple)) and len(obj) > STREAM_LIST_SLICE:
+        yield '['
+        for i in xrange(0, len(obj), STREAM_LIST_SLICE):
+            if i:
+                yield ', '
+            # Without the brackets of the slice
+            yield lib_dumps(obj[i:i + STREAM_LIST_SLICE])[1:-1]
+        yield ']'
+    else:
+        yield lib_dumps(obj)
+
+def iterdumps(dic):
+    '''
+    Generate the JSON of the given object as consecutive chunks, for it to
+    be sent without ever holding all of it in memory.
+    '''
+    chunk = []
+    chunk_len = 0
+    for part in _iterencode(dic):
+        chunk.append(part)
+        chunk_len += len(part)
+        if chunk_len >= STREAM_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            chunk_len = 0
+    if chunk:
+        yield ''.join(chunk)
+
 def loads(s):
     return lib_loads(s)
 
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+from __future__ import with_statement
+
+'''
+Cache of the token and sentence offsets of document texts, which would
+otherwise be tokenised and sentence split again for every request that
+returns the document.
+
+The offsets of a document are stored under WORK_DIR and reused for as
+long as its text file (or pack, see docpack) and the tokeniser and
+sentence splitter used are unchanged. A cache file consists of the
+pickled key it is valid for, the pickled number of token and sentence
+offsets and the start and end offsets one after the other as binary
+integer arrays (OFFSET_TYPECODE) in the byte order of the machine.
+'''
+
+from array import array
+from cPickle import dump as pickle_dump, load as pickle_load
+from cPickle import HIGHEST_PROTOCOL
+from logging import info as log_info
+from os import close as os_close, makedirs, remove, rename, stat
+from os.path import abspath, dirname, isdir
+from os.path import join as path_join
+from tempfile import mkstemp
+
+from docpack import packed_document
+from workcache import prune_cache_dir
+
+# Token and sentence offsets are cached under WORK_DIR, set to False in
+# config.py to tokenise and sentence split the text for every request
+try:
+    from config import TEXT_OFFSET_CACHE
+except ImportError:
+    TEXT_OFFSET_CACHE = True
+# Cached offsets not written for TEXT_OFFSET_CACHE_MAX_AGE seconds are
+# removed (see workcache), set to None in config.py to keep them for ever
+try:
+    from config import TEXT_OFFSET_CACHE_MAX_AGE
+except ImportError:
+    TEXT_OFFSET_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
+### Constants
+# Directory under WORK_DIR holding the offset cache
+OFFSET_CACHE_DIR = 'offset_cache'
+# Has to be increased whenever the tokenisers, sentence splitters or the
+# cache format change, to invalidate the existing caches
+OFFSET_CACHE_VERSION = 1
+# Type code of the offset arrays, texts are shorter than 2^31 characters
+OFFSET_TYPECODE = 'i'
+###
+
+
+def _cache_path(txt_file_path):
+    try:
+        from config import WORK_DIR
+    except ImportError:
+        return None
+    from hashlib import sha1
+    txt_key = u'%s' % (abspath(txt_file_path), )
+    return path_join(WORK_DIR, OFFSET_CACHE_DIR,
+            sha1(txt_key.encode('utf-8')).hexdigest() + '.offsets')
+
+
+def _cache_key(txt_file_path, text, tok_offset_gen, ss_offset_gen):
+    # The text of packed documents is read from the pack
+    source_path = txt_file_path
+    packed = packed_document(txt_file_path.rsplit('.', 1)[0])
+    if packed is not None:
+        source_path = packed.pack.path
+    try:
+        st = stat(source_path)
+    except OSError:
+        return None
+    return (OFFSET_CACHE_VERSION, abspath(txt_file_path), st.st_size,
+            st.st_mtime, len(text), tok_offset_gen.__name__,
+            ss_offset_gen.__name__)
+
+
+def _offset_pairs(offsets):
+    return zip(offsets[0::2], offsets[1::2])
+
+
+def _load_offsets(cache_path, key):
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            if pickle_load(cache_file) != key:
+                return None
+            token_count, sentence_count = pickle_load(cache_file)
+            token_offsets = array(OFFSET_TYPECODE)
+            token_offsets.fromfile(cache_file, 2 * token_count)
+            sentence_offsets = array(OFFSET_TYPECODE)
+            sentence_offsets.fromfile(cache_file, 2 * sentence_count)
+    except IOError:
+        # Most likely not cached yet
+        return None
+    except Exception, e:
+        log_info('ignoring broken offset cache %s: %s' % (cache_path, e))
+        return None
+    return _offset_pairs(token_offsets), _offset_pairs(sentence_offsets)
+
+
+def _store_offsets(cache_path, key, token_offsets, sentence_offsets):
+    tmp_fname = None
+    try:
+        cache_dir = dirname(cache_path)
+        if not isdir(cache_dir):
+            makedirs(cache_dir)
+        tmp_fh, tmp_fname = mkstemp(dir=cache_dir)
+        os_close(tmp_fh)
+        with open(tmp_fname, 'wb') as tmp_file:
+            pickle_dump(key, tmp_file, HIGHEST_PROTOCOL)
+            pickle_dump((len(token_offsets), len(sentence_offsets)),
+                    tmp_file, HIGHEST_PROTOCOL)
+            for offsets in (token_offsets, sentence_offsets):
+                array(OFFSET_TYPECODE, (o for pair in offsets
+                        for o in pair)).tofile(tmp_file)
+        rename(tmp_fname, cache_path)
+        # Those of texts since renamed or deleted would pile up
+        prune_cache_dir(cache_dir, TEXT_OFFSET_CACHE_MAX_AGE)
+    except Exception, e:
+        # The cache is only an optimisation, never fail because of it
+        log_info('failed to write offset cache %s: %s' % (cache_path, e))
+        if tmp_fname is not None:
+            try:
+                remove(tmp_fname)
+            except OSError:
+                pass
+
+
+def text_offsets(txt_file_path, text, tok_offset_gen, ss_offset_gen):
+    '''
+    Return the token and sentence offsets of the given text of the given
+    text file as generated by the given functions, as lists of (start,
+    end) tuples. The offsets are read from the cache if possible. The text
+    can also be given as a doctext.DocumentText, only decoded if the
+    offsets have to be generated.
+    '''
+
+    cache_path = key = None
+    if TEXT_OFFSET_CACHE:
+        cache_path = _cache_path(txt_file_path)
+        if cache_path is not None:
+            # Determined before generating, in case the text file changes
+            key = _cache_key(txt_file_path, text, tok_offset_gen,
+                    ss_offset_gen)
+    if key is not None:
+        cached = _load_offsets(cache_path, key)
+        if cached is not None:
+            return cached
+
+    text = unicode(text)
+    token_offsets = [o for o in tok_offset_gen(text)]
+    sentence_offsets = [o for o in ss_offset_gen(text)]
+    if key is not None:
+        _store_offsets(cache_path, key, token_offsets, sentence_offsets)
+    return token_offsets, sentence_offsets
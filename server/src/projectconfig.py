@@ -555,6 +555,35 @@ def __read_first_in_directory_tree(directory, filename):
 
     return (result, source)
 
+def __find_first_in_directory_tree(directory, filename):
+    # As __read_first_in_directory_tree(), without reading the file
+    try:
+        from config import BASE_DIR
+    except:
+        BASE_DIR = "/"
+    from os.path import isfile, split, join
+
+    if directory is not None:
+        while BASE_DIR in directory:
+            source = join(directory, filename)
+            if isfile(source):
+                return source
+            parent = split(directory)[0]
+            if parent == directory:
+                break
+            directory = parent
+    return None
+
+def get_config_paths(directory):
+    """
+    Return the paths of the annotation, visual and tools configuration
+    files used for the given directory, None for those that fall back to
+    the defaults.
+    """
+    return [__find_first_in_directory_tree(directory, filename)
+            for filename in (__annotation_config_filename,
+                __visual_config_filename, __tools_config_filename)]
+
 def __parse_configs(configstr, source, expected_sections, optional_sections):
     # top-level config structure is a set of term hierarchies
     # separated by lines consisting of "[SECTION]" where SECTION is
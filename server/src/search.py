@@ -162,7 +162,7 @@ def __filenames_to_annotations(filenames):
             # remove suffixes for Annotations to prompt parsing of all
             # annotation files.
             nosuff_fn = fn.replace(".ann","").replace(".a1","").replace(".a2","").replace(".rel","")
-            ann_obj = annotation.TextAnnotations(nosuff_fn, read_only=True)
+            ann_obj = annotation.TextAnnotationsView(nosuff_fn)
             anns.append(ann_obj)
         except annotation.AnnotationFileNotFoundError:
             print >> sys.stderr, "%s:\tFailed: file not found" % fn
@@ -183,12 +183,12 @@ def __directory_to_annotations(directory):
     Given a directory, returns Annotations objects for contained files.
     """
     # TODO: put this shared functionality in a more reasonable place
-    from document import real_directory,_listdir
+    from document import real_directory,_document_names
     from os.path import join as path_join
 
     real_dir = real_directory(directory)
     # Get the document names
-    base_names = [fn[0:-4] for fn in _listdir(real_dir) if fn.endswith('txt')]
+    base_names = _document_names(real_dir)
 
     filenames = [path_join(real_dir, bn) for bn in base_names]
 
@@ -644,8 +644,8 @@ def search_anns_for_textbound(ann_objs, text, restrict_types=None,
                 text != DEFAULT_EMPTY_STRING and not match_regex.search(t.get_text())):
                 continue
             if nested_types != []:
-                # TODO: massively inefficient
-                nested = [x for x in ann_obj.get_textbounds() 
+                nested = [x for x in ann_obj.overlapping(t.first_start(),
+                                                         t.last_end())
                           if x != t and t.contains(x)]
                 if len([x for x in nested if x.type in nested_types]) == 0:
                     continue
@@ -1036,15 +1036,10 @@ def search_anns_for_text(ann_objs, text,
             # only need to care about embedding annotations if there's
             # some annotation-based restriction
             #if restrict_types == [] and ignore_types == []:
-            # TODO: _extremely_ naive and slow way to find embedding
-            # annotations.  Use some reasonable data structure
-            # instead.
             embedding = []
             # if there are no type restrictions, we can skip this bit
             if restrict_types != [] or ignore_types != []:
-                for t in ann_obj.get_textbounds():
-                    if t.contains(m):
-                        embedding.append(t)
+                embedding = ann_obj.containing(m.start(), m.end())
 
             # Note interpretation of ignore_types here: if the text
             # span is embedded in one or more of the ignore_types or
@@ -28,6 +28,8 @@ PY_VER_STR = '%d.%d.%d-%s-%d' % tuple(version_info)
 REQUIRED_PY_VERSION = (2, 5, 0, 'alpha', 1)
 REQUIRED_PY_VERSION_STR = '%d.%d.%d-%s-%d' % tuple(REQUIRED_PY_VERSION)
 JSON_HDR = ('Content-Type', 'application/json')
+# CGI header for the HTTP status of the response, 200 OK if not given
+NOT_MODIFIED_HDR = ('Status', '304 Not Modified')
 CONF_FNAME = 'config.py'
 CONF_TEMPLATE_FNAME = 'config_template.py'
 CONFIG_CHECK_LOCK = allocate_lock()
@@ -149,7 +151,15 @@ class DefaultNoneDict(dict):
         return None
 
 
-def _safe_serve(params, client_ip, client_hostname, cookie_data):
+def _if_none_match_version(if_none_match):
+    # The (first) entity tag of an If-None-Match header, as a version
+    tag = if_none_match.split(',')[0].strip()
+    if tag.startswith('W/'):
+        tag = tag[2:]
+    return tag.strip('"')
+
+def _safe_serve(params, client_ip, client_hostname, cookie_data,
+        if_none_match=None):
     # Note: Only logging imports here
     from config import WORK_DIR
     from logging import basicConfig as log_basic_config
@@ -167,8 +177,8 @@ def _safe_serve(params, client_ip, client_hostname, cookie_data):
     # Do the necessary imports after enabling the logging, order critical
     try:
         from common import ProtocolError, ProtocolArgumentError, NoPrintJSONError
-        from dispatch import dispatch
-        from jsonwrap import dumps
+        from dispatch import dispatch, STREAMED_RESPONSE_ACTION
+        from jsonwrap import dumps, iterdumps
         from message import Messager
         from session import get_session, init_session, close_session, NoSessionError, SessionStoreError
     except ImportError:
@@ -180,6 +190,7 @@ def _safe_serve(params, client_ip, client_hostname, cookie_data):
 
     init_session(client_ip, cookie_data=cookie_data)
     response_is_JSON = True
+    conditional = False
     try:
         # Unpack the arguments into something less obscure than the
         #   Python FieldStorage object (part dictonary, part list, part FUBAR)
@@ -193,6 +204,14 @@ def _safe_serve(params, client_ip, client_hostname, cookie_data):
                 Messager.error('protocol argument error: expected string argument %s, got %s' % (k, type(params.getvalue(k))))
                 raise ProtocolArgumentError
 
+        # A conditional request for a document is handled as one giving
+        #   the version of the document that the client already has
+        conditional = (if_none_match is not None
+                and http_args['action'] == 'getDocument'
+                and http_args['if_version'] is None)
+        if conditional:
+            http_args['if_version'] = _if_none_match_version(if_none_match)
+
         # Dispatch the request
         json_dic = dispatch(http_args, client_ip, client_hostname)
     except ProtocolError, e:
@@ -219,10 +238,46 @@ def _safe_serve(params, client_ip, client_hostname, cookie_data):
         cookie_hdrs = None
 
     if response_is_JSON:
-        response_data = ((JSON_HDR, ), dumps(Messager.output_json(json_dic)))
+        response_hdrs = [JSON_HDR]
+        if http_args['action'] in STREAMED_RESPONSE_ACTION:
+            # Large, serialised as it is sent (the body is a generator)
+            response_str = _streamed_response(
+                    iterdumps(Messager.output_json(json_dic)))
+        else:
+            response_str = dumps(Messager.output_json(json_dic))
+        if 'document_version' in json_dic:
+            response_hdrs.append(('ETag',
+                '"%s"' % (json_dic['document_version'], )))
+            if conditional and json_dic.get('unchanged'):
+                # Not modified, the response has no body
+                response_hdrs.insert(0, NOT_MODIFIED_HDR)
+                response_str = ''
+        response_data = (tuple(response_hdrs), response_str)
 
     return (cookie_hdrs, response_data)
 
+def _streamed_response(chunks):
+    # The first chunk is serialised right away, so that errors found there
+    #   are handled like those of any other response. Later errors can only
+    #   cut the response short after it has been sent as successful; they
+    #   are logged and passed on for the server to drop the connection.
+    try:
+        first_chunk = chunks.next()
+    except StopIteration:
+        first_chunk = ''
+
+    def _chunks():
+        yield first_chunk
+        try:
+            for chunk in chunks:
+                yield chunk
+        except Exception:
+            # Print to stderr so that the exception is logged by the webserver
+            print >> stderr, ('Error serialising a streamed response, '
+                    'the response was cut short:\n' + _get_stack_trace())
+            raise
+    return _chunks()
+
 # Programmatically access the stack-trace
 def _get_stack_trace():
     from traceback import print_exc
@@ -269,7 +324,11 @@ def _server_crash(cookie_hdrs, e):
     return (cookie_hdrs, ((JSON_HDR, ), dumps(Messager.output_json(json_dic))))
 
 # Serve the client request
-def serve(params, client_ip, client_hostname, cookie_data):
+# The response body is a string, or for potentially large responses
+#   (see dispatch.STREAMED_RESPONSE_ACTION) a generator of consecutive
+#   chunks of it
+def serve(params, client_ip, client_hostname, cookie_data,
+        if_none_match=None):
     # The session relies on the config, wait-for-it
     cookie_hdrs = None
 
@@ -318,7 +377,8 @@ def serve(params, client_ip, client_hostname, cookie_data):
 
     try:
         # Safe region, can throw any exception, has verified installation
-        return _safe_serve(params, client_ip, client_hostname, cookie_data)
+        return _safe_serve(params, client_ip, client_hostname, cookie_data,
+                if_none_match)
     except BaseException, e:
         # Handle the server crash
         return _server_crash(cookie_hdrs, e)
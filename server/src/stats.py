@@ -19,7 +19,9 @@ from os import listdir
 from os.path import isfile, getmtime
 from os.path import join as path_join
 
-from annotation import Annotations, open_textfile
+from annotation import (AnnotationsView, AnnotationFileNotFoundError,
+        BinaryRelationAnnotation, EquivAnnotation, EventAnnotation,
+        TextBoundAnnotation, iter_annotations, open_textfile)
 from config import DATA_DIR, BASE_DIR
 from message import Messager
 from projectconfig import get_config_path, options_get_validation
@@ -35,6 +37,50 @@ def get_stat_cache_by_dir(directory):
 def get_config_py_path():
     return path_join(BASE_DIR, 'config.py')
 
+def _merged_equiv_count(equivs):
+    # Equivs sharing members are merged into one when loaded, count the
+    # merged groups of the given lists of equiv members
+    parent = range(len(equivs))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    first_equiv_by_member = {}
+    for i, members in enumerate(equivs):
+        for member in members:
+            j = first_equiv_by_member.setdefault(member, i)
+            if j != i:
+                parent[find(i)] = find(j)
+    return sum(1 for i in xrange(len(equivs)) if find(i) == i)
+
+def _count_annotations(document):
+    # Entity, relation and event counts of a document, as for an
+    # Annotations object but read without building one
+    try:
+        textbound_ids = set()
+        trigger_ids = set()
+        equivs = []
+        rel_count = 0
+        event_count = 0
+        for ann in iter_annotations(document, categories=('T', 'R', '*', 'E')):
+            if isinstance(ann, TextBoundAnnotation):
+                textbound_ids.add(ann.id)
+            elif isinstance(ann, BinaryRelationAnnotation):
+                rel_count += 1
+            elif isinstance(ann, EquivAnnotation):
+                equivs.append(ann.entities)
+            elif isinstance(ann, EventAnnotation):
+                trigger_ids.add(ann.trigger)
+                event_count += 1
+    except AnnotationFileNotFoundError:
+        # Nothing annotated yet
+        return [0, 0, 0]
+    # Entities are textbounds that are not triggers
+    return [len(textbound_ids - trigger_ids),
+            rel_count + _merged_equiv_count(equivs), event_count]
+
 # TODO: Quick hack, prettify and use some sort of csv format
 def get_statistics(directory, base_names, use_cache=True):
     # Check if we have a cache of the costly satistics generation
@@ -98,8 +144,14 @@ def get_statistics(directory, base_names, use_cache=True):
         docstats = []
         for docname in base_names:
             try:
-                with Annotations(path_join(directory, docname), 
-                        read_only=True) as ann_obj:
+                if options_get_validation(directory) == 'none':
+                    # Only counts are needed
+                    docstats.append(_count_annotations(
+                            path_join(directory, docname)))
+                    continue
+
+                with AnnotationsView(path_join(directory,
+                        docname)) as ann_obj:
                     tb_count = len([a for a in ann_obj.get_entities()])
                     rel_count = (len([a for a in ann_obj.get_relations()]) +
                                  len([a for a in ann_obj.get_equivs()]))
@@ -18,7 +18,7 @@ from urlparse import urlparse
 
 from annotation import TextAnnotations, TextBoundAnnotationWithText
 from annotation import NormalizationAnnotation
-from annotator import _json_from_ann, ModificationTracker
+from annotator import _attach_annotations, ModificationTracker
 from common import ProtocolError
 from document import real_directory
 from jsonwrap import loads
@@ -87,7 +87,7 @@ def _is_textbound(ann):
 def _is_normalization(ann):
     return 'target' in ann
 
-def tag(collection, document, tagger):
+def tag(collection, document, tagger, delta=None):
     pconf = ProjectConfiguration(real_directory(collection))
     for tagger_token, _, _, tagger_service_url in pconf.get_annotator_config():
         if tagger == tagger_token:
@@ -157,8 +157,13 @@ def tag(collection, document, tagger):
         mods = ModificationTracker()
         cidmap = {}
 
-        for cid, ann in ((i, a) for i, a in json_resp.iteritems()
-                         if _is_textbound(a)):
+        textbounds = [(i, a) for i, a in json_resp.iteritems()
+                      if _is_textbound(a)]
+        # Taggers can return thousands of entities, allocate them at once
+        tb_ids = ann_obj.reserve_ids('T', len(textbounds))
+
+        new_anns = []
+        for (cid, ann), _id in zip(textbounds, tb_ids):
             assert 'offsets' in ann, 'Tagger response lacks offsets'
             offsets = ann['offsets']
             assert 'type' in ann, 'Tagger response lacks type'
@@ -173,15 +178,17 @@ def tag(collection, document, tagger):
             start, end = offsets[0]
             text = texts[0]
 
-            _id = ann_obj.get_new_id('T')
             cidmap[cid] = _id
 
             tb = TextBoundAnnotationWithText(offsets, _id, _type, text, " " + ' '.join(texts[1:]))
 
             mods.addition(tb)
-            ann_obj.add_annotation(tb)
+            new_anns.append(tb)
+
+        norms = [a for a in json_resp.itervalues() if _is_normalization(a)]
+        norm_ids = ann_obj.reserve_ids('N', len(norms))
 
-        for norm in (a for a in json_resp.itervalues() if _is_normalization(a)):
+        for norm, _id in zip(norms, norm_ids):
             try:
                 _type = norm['type']
                 target = norm['target']
@@ -190,17 +197,17 @@ def tag(collection, document, tagger):
             except KeyError, e:
                 raise # TODO
 
-            _id = ann_obj.get_new_id('N')
             target = cidmap[target]
 
             na = NormalizationAnnotation(_id, _type, target, refdb, refid, '')
 
             mods.addition(na)
-            ann_obj.add_annotation(na)
+            new_anns.append(na)
+
+        ann_obj.add_many(new_anns)
 
         mod_resp = mods.json_response()
-        mod_resp['annotations'] = _json_from_ann(ann_obj)
-        return mod_resp
+        return _attach_annotations(mod_resp, ann_obj, mods, delta)
 
 if __name__ == '__main__':
     # Silly test, but helps
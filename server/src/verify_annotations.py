@@ -68,23 +68,6 @@ def event_nonum_arg_count(e):
         nnc[arg] = nnc.get(arg, 0) + 1
     return nnc
 
-def check_textbound_overlap(anns):
-    """
-    Checks for overlap between the given TextBoundAnnotations.
-    Returns a list of pairs of overlapping annotations.
-    """
-    overlapping = []
-
-    for a1 in anns:
-        for a2 in anns:
-            if a1 is a2:
-                continue
-            if (a2.first_start() < a1.last_end() and
-                a2.last_end() > a1.first_start()):
-                overlapping.append((a1,a2))
-
-    return overlapping
-
 def verify_equivs(ann_obj, projectconf):
     issues = []
 
@@ -136,9 +119,22 @@ def verify_entity_overlap(ann_obj, projectconf):
     def disp(s):
         return projectconf.preferred_display_form(s)
 
-    # check for overlap between physical entities
-    physical_entities = [a for a in ann_obj.get_textbounds() if projectconf.is_physical_entity_type(a.type)]
-    overlapping = check_textbound_overlap(physical_entities)
+    # check for overlap between physical entities, taking each to extend
+    # from the start of its first span to the end of its last. The span
+    # index finds the annotations with a span in the extent of a given
+    # one, missing those that have the given one in a gap between their
+    # spans; as overlap is symmetric those find it in turn.
+    physical_entities = [a for a in ann_obj.get_textbounds()
+            if projectconf.is_physical_entity_type(a.type)]
+    position = dict((a, i) for i, a in enumerate(physical_entities))
+    overlapping_anns = dict((a, set()) for a in physical_entities)
+    for a1 in physical_entities:
+        for a2 in ann_obj.overlapping(a1.first_start(), a1.last_end()):
+            if a2 is not a1 and a2 in position:
+                overlapping_anns[a1].add(a2)
+                overlapping_anns[a2].add(a1)
+    overlapping = [(a1, a2) for a1 in physical_entities
+            for a2 in sorted(overlapping_anns[a1], key=position.get)]
     for a1, a2 in overlapping:
         if a1.same_span(a2):
             if not projectconf.spans_can_be_equal(a1.type, a2.type):
@@ -415,7 +411,7 @@ def main(argv=None):
             # (TODO: temporarily removing .ann also to work around a
             # bug in TextAnnotations, but this should not be necessary.)
             nosuff_fn = fn.replace(".a2","").replace(".rel","").replace(".ann","")
-            with annotation.TextAnnotations(nosuff_fn) as ann_obj:
+            with annotation.TextAnnotationsView(nosuff_fn) as ann_obj:
                 issues = verify_annotation(ann_obj, projectconf)
                 for i in issues:
                     print "%s:\t%s" % (fn, i.human_readable_str())
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+from __future__ import with_statement
+
+'''
+Removal of old files from the caches kept under WORK_DIR (the parse cache
+of annotation and the offset cache of offsetcache). A cache file is only
+replaced while its document exists, the files of documents that are
+renamed or deleted would otherwise pile up for ever.
+'''
+
+from os import listdir, remove, stat, utime
+from os.path import join as path_join
+from time import time
+
+### Constants
+# Marker file in a cache directory, the time of the last pruning is its
+# modification time
+PRUNE_MARKER = '.pruned'
+# Minimum time between two prunings of a cache directory, in seconds
+PRUNE_INTERVAL = 24 * 60 * 60
+###
+
+
+def prune_cache_dir(cache_dir, max_age, now=None):
+    '''
+    Remove the files in the given cache directory that were last written
+    more than max_age seconds ago, at most once every PRUNE_INTERVAL
+    seconds (in any process). Files that are still needed are simply
+    written again. Never fails, returns the number of files removed.
+    '''
+
+    if max_age is None:
+        return 0
+    if now is None:
+        now = time()
+
+    marker_path = path_join(cache_dir, PRUNE_MARKER)
+    try:
+        if now - stat(marker_path).st_mtime < PRUNE_INTERVAL:
+            return 0
+    except OSError:
+        # Never pruned
+        pass
+    try:
+        # Claim this pruning, for other processes to skip theirs
+        with open(marker_path, 'a'):
+            pass
+        utime(marker_path, (now, now))
+        fnames = listdir(cache_dir)
+    except (IOError, OSError):
+        return 0
+
+    removed = 0
+    for fname in fnames:
+        if fname == PRUNE_MARKER:
+            continue
+        path = path_join(cache_dir, fname)
+        try:
+            if now - stat(path).st_mtime > max_age:
+                remove(path)
+                removed += 1
+        except OSError:
+            # Removed or replaced meanwhile
+            pass
+    return removed
+
+if __name__ == '__main__':
+    from unittest import TestCase
+    from tempfile import mkdtemp
+    from shutil import rmtree
+    import unittest
+
+    class PruneCacheDirTest(TestCase):
+        def setUp(self):
+            self.cache_dir = mkdtemp()
+            self.now = time()
+            for fname, age in (('old', 10 * PRUNE_INTERVAL), ('new', 60), ):
+                path = path_join(self.cache_dir, fname)
+                with open(path, 'w'):
+                    pass
+                utime(path, (self.now - age, self.now - age))
+
+        def tearDown(self):
+            rmtree(self.cache_dir)
+
+        def _left(self):
+            return sorted(f for f in listdir(self.cache_dir)
+                    if f != PRUNE_MARKER)
+
+        def test_prune(self):
+            self.assertEqual(prune_cache_dir(self.cache_dir,
+                PRUNE_INTERVAL, now=self.now), 1)
+            self.assertEqual(self._left(), ['new'])
+
+        def test_interval(self):
+            prune_cache_dir(self.cache_dir, 20 * PRUNE_INTERVAL, now=self.now)
+            # Pruned too recently for the old file to go
+            prune_cache_dir(self.cache_dir, PRUNE_INTERVAL, now=self.now + 60)
+            self.assertEqual(self._left(), ['new', 'old'])
+            prune_cache_dir(self.cache_dir, PRUNE_INTERVAL,
+                    now=self.now + 2 * PRUNE_INTERVAL)
+            self.assertEqual(self._left(), [])
+
+        def test_disabled(self):
+            self.assertEqual(prune_cache_dir(self.cache_dir, None), 0)
+            self.assertEqual(self._left(), ['new', 'old'])
+
+    unittest.main()
@@ -183,6 +183,7 @@ class BratHTTPRequestHandler(SimpleHTTPRequestHandler):
         remote_addr = self.client_address[0]
         remote_host = self.address_string()
         cookie_data = ', '.join(filter(None, self.headers.getheaders('cookie')))
+        if_none_match = self.headers.getheader('if-none-match')
 
         query_string = ''
         i = self.path.find('?')
@@ -205,7 +206,7 @@ class BratHTTPRequestHandler(SimpleHTTPRequestHandler):
 
         # Call main server
         cookie_hdrs, response_data = serve(params, remote_addr, remote_host,
-                                           cookie_data)
+                                           cookie_data, if_none_match)
 
         sys.stdin, sys.stdout, sys.stderr = saved
 
@@ -216,15 +217,29 @@ class BratHTTPRequestHandler(SimpleHTTPRequestHandler):
             response_hdrs = []
         response_hdrs.extend(response_data[0])
 
-        self.send_response(200)
+        # Except for conditional requests, given a (CGI) status by the server
+        response_code = 200
+        for hdr in response_hdrs:
+            if hdr[0] == 'Status':
+                response_code = int(hdr[1].split()[0])
+                response_hdrs.remove(hdr)
+                break
+
+        self.send_response(response_code)
         self.wfile.write('\n'.join('%s: %s' % (k, v) for k, v in response_hdrs))
         self.wfile.write('\n')
         self.wfile.write('\n')
         # Hack to support binary data and general Unicode for SVGs and JSON
         if isinstance(response_data[1], unicode):
             self.wfile.write(response_data[1].encode('utf-8'))
-        else:
+        elif isinstance(response_data[1], str):
             self.wfile.write(response_data[1])
+        else:
+            # Streamed, written as it is serialised; the end of the body
+            #   is marked by closing the (HTTP/1.0) connection
+            for chunk in response_data[1]:
+                self.wfile.write(chunk)
+                self.wfile.flush()
         return 0
 
     def allow_path(self):
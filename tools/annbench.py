@@ -0,0 +1,507 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+'''
+Micro-benchmarks for the annotation handling of the brat server, run on
+synthetic documents generated into a temporary directory.
+
+Usage example:
+
+    python tools/annbench.py delete --lines 50000 --deletes 10000
+    python tools/annbench.py parse example-data/corpora --check
+    python tools/annbench.py memory --annotations 100000 --documents 20
+    python tools/annbench.py equiv --check
+    python tools/annbench.py scan --annotations 100000 --documents 20
+    python tools/annbench.py batch --lines 50000 --entities 10000 --check
+    python tools/annbench.py sentences --entities 50000 --check
+'''
+
+from __future__ import with_statement
+
+import sys
+
+from gc import collect
+from os import walk
+from os.path import dirname, join as path_join
+from random import Random
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+try:
+    import argparse
+except ImportError:
+    from sys import path as sys_path
+    # We are most likely on an old Python and need to use our internal version
+    sys_path.append(path_join(dirname(__file__), '../server/lib'))
+    import argparse
+
+try:
+    import annotation
+except ImportError:
+    from sys import path as sys_path
+    # Guessing that we might be in the brat tools/ directory ...
+    sys_path.append(path_join(dirname(__file__), '../server/src'))
+    import annotation
+
+from annotation import (Annotations, AnnotationsView,
+        DependingAnnotationDeleteError, TextAnnotations, TextAnnotationsView,
+        TextBoundAnnotationWithText, iter_annotations, open_textfile)
+
+# Always parse, even if a parse cache has been configured
+annotation.ANNOTATION_PARSE_CACHE = False
+
+### Constants
+# Number of synthetic events per line of document text
+CYCLES_PER_SENTENCE = 10
+###
+
+
+def _synthetic_document(line_count):
+    '''
+    Generate a document text and standoff annotation lines for it, with
+    a mix of text-bounds, events, attributes, relations, normalizations
+    and notes.
+    '''
+
+    text = []
+    ann_lines = []
+    offset = 0
+    cycle = 0
+    while len(ann_lines) < line_count:
+        cycle += 1
+
+        ent_text = u'P%d' % cycle
+        trig_text = u'expressed%d' % cycle
+        ent_start = offset
+        ent_end = ent_start + len(ent_text)
+        trig_start = ent_end + 1
+        trig_end = trig_start + len(trig_text)
+        sep = u'\n' if cycle % CYCLES_PER_SENTENCE == 0 else u' '
+        text.append(ent_text + u' ' + trig_text + sep)
+        offset = trig_end + 1
+
+        ent_id = u'T%d' % (2 * cycle - 1)
+        trig_id = u'T%d' % (2 * cycle)
+        ann_lines.extend((
+            u'%s\tProtein %d %d\t%s' % (ent_id, ent_start, ent_end, ent_text),
+            u'%s\tGene_expression %d %d\t%s' % (trig_id, trig_start,
+                trig_end, trig_text),
+            u'E%d\tGene_expression:%s Theme:%s' % (cycle, trig_id, ent_id),
+            u'A%d\tNegation E%d' % (cycle, cycle),
+            u'R%d\tCoref Arg1:%s Arg2:T%d' % (cycle, ent_id,
+                max(1, 2 * cycle - 3)),
+            u'N%d\tReference %s UniProt:%s\t%s' % (cycle, ent_id, ent_text,
+                ent_text),
+            u'#%d\tAnnotatorNotes %s\tnote %d' % (cycle, ent_id, cycle),
+            ))
+    return u''.join(text), ann_lines[:line_count]
+
+
+def _write_document(directory, line_count, name='doc'):
+    text, ann_lines = _synthetic_document(line_count)
+    doc_path = path_join(directory, name)
+    with open_textfile(doc_path + '.txt', 'w') as txt_file:
+        txt_file.write(text)
+    with open_textfile(doc_path + '.ann', 'w') as ann_file:
+        ann_file.write(u''.join(l + u'\n' for l in ann_lines))
+    return doc_path, ann_lines
+
+
+def _report(label, seconds, count=None, unit='items'):
+    if count is None:
+        print '%s: %.3fs' % (label, seconds, )
+    else:
+        print '%s: %.3fs (%d %s, %.0f %s/s)' % (label, seconds, count, unit,
+                count / max(seconds, 1e-9), unit, )
+
+
+def bench_delete(args):
+    '''
+    Delete annotations at random positions from a large document and
+    check that serialization preserves the order of the remaining lines.
+    '''
+
+    tmp_dir = mkdtemp()
+    try:
+        doc_path, ann_lines = _write_document(tmp_dir, args.lines)
+
+        start = time()
+        ann_obj = Annotations(doc_path)
+        _report('parse', time() - start, len(ann_obj), 'lines')
+
+        # Attributes, normalizations and notes are left out as they may
+        # already have been deleted along with the annotation they are on
+        candidates = [a for a in ann_obj
+                if a.id[0] not in ('A', 'N', '#')]
+        Random(args.seed).shuffle(candidates)
+
+        deleted = 0
+        start = time()
+        for ann in candidates:
+            if deleted >= args.deletes:
+                break
+            try:
+                ann_obj.del_annotation(ann)
+            except DependingAnnotationDeleteError:
+                continue
+            deleted += 1
+        _report('delete', time() - start, deleted, 'annotations')
+
+        start = time()
+        out_str = unicode(ann_obj)
+        _report('serialize', time() - start, len(ann_obj), 'lines')
+
+        if args.check:
+            remaining = set(unicode(a).rstrip(u'\n') for a in ann_obj)
+            expected = u''.join(l + u'\n' for l in ann_lines
+                    if l in remaining)
+            assert out_str == expected, 'serialized line order changed'
+            print 'serialized order: OK'
+    finally:
+        rmtree(tmp_dir)
+
+
+def bench_equiv(args):
+    '''
+    Parse a document with coreference chains given as pairwise Equiv
+    lines, which have to be merged into a single Equiv per chain.
+    '''
+
+    chain_length = 100
+    tmp_dir = mkdtemp()
+    try:
+        ann_lines = [u'T%d\tProtein %d %d\tP' % (i, i - 1, i)
+                for i in xrange(1, args.lines + 1)]
+        for i in xrange(1, args.lines):
+            if i % chain_length:
+                ann_lines.append(u'*\tEquiv T%d T%d' % (i, i + 1))
+        doc_path = path_join(tmp_dir, 'doc')
+        with open_textfile(doc_path + '.txt', 'w') as txt_file:
+            txt_file.write(u'P' * args.lines)
+        with open_textfile(doc_path + '.ann', 'w') as ann_file:
+            ann_file.write(u''.join(l + u'\n' for l in ann_lines))
+
+        start = time()
+        ann_obj = Annotations(doc_path)
+        _report('parse', time() - start, len(ann_lines), 'lines')
+
+        if args.check:
+            expected = [[u'T%d' % i for i in xrange(first,
+                    min(first + chain_length, args.lines + 1))]
+                    for first in xrange(1, args.lines + 1, chain_length)]
+            merged = [e.entities for e in ann_obj.get_equivs()]
+            assert merged == expected, 'equivs merged incorrectly'
+            print 'merged equivs: OK'
+    finally:
+        rmtree(tmp_dir)
+
+
+def bench_batch(args):
+    '''
+    Add entities such as those returned by a tagger to a large document,
+    once one at a time and once in a single batch.
+    '''
+
+    tmp_dir = mkdtemp()
+    try:
+        doc_path, _ = _write_document(tmp_dir, args.lines)
+        with open_textfile(doc_path + '.txt') as txt_file:
+            text = txt_file.read()
+        rand = Random(args.seed)
+        offsets = []
+        for _ in xrange(args.entities):
+            start = rand.randrange(len(text) - 10)
+            offsets.append((start, start + rand.randint(1, 10)))
+
+        results = []
+        for batched in (False, True):
+            ann_obj = TextAnnotations(doc_path)
+            # As after e.g. sentence splitting, keeping the span index up
+            # to date from then on
+            ann_obj.overlapping(0, 0)
+
+            start = time()
+            ids = ann_obj.reserve_ids('T', len(offsets))
+            anns = [TextBoundAnnotationWithText(((s, e), ), id, 'Tagged',
+                    text[s:e]) for (s, e), id in zip(offsets, ids)]
+            if batched:
+                ann_obj.add_many(anns)
+            else:
+                for ann in anns:
+                    ann_obj.add_annotation(ann)
+            # Queried as when returning the document
+            ann_obj.overlapping(0, 0)
+            _report('add (%s)' % ('batch' if batched else 'one by one', ),
+                    time() - start, len(anns), 'entities')
+            results.append(unicode(ann_obj))
+
+        if args.check:
+            assert results[0] == results[1], 'batch added differently'
+            print 'batch result: OK'
+    finally:
+        rmtree(tmp_dir)
+
+
+def _merge_sentences_by_scan(sentence_offsets, ann_obj):
+    # The merge of sentence offsets crossed by annotations as it was done
+    # before document._merge_crossed_sentences(), one query and list
+    # deletion per crossed sentence end
+    s_breaks = list(sentence_offsets)
+    s_i = 0
+    while s_i < len(s_breaks) - 1:
+        s_start, s_end = s_breaks[s_i]
+        if ann_obj.overlapping(s_end, s_end):
+            s_breaks[s_i] = (s_start, s_breaks[s_i + 1][1])
+            del s_breaks[s_i + 1]
+        else:
+            s_i += 1
+    return s_breaks
+
+
+def bench_sentences(args):
+    '''
+    Merge the sentences of a long document that are crossed by entities,
+    as done when returning the document to the client.
+    '''
+
+    # The document module needs the configuration of the installation
+    from sys import path as sys_path
+    sys_path.append(path_join(dirname(__file__), '..'))
+    from document import _merge_crossed_sentences
+
+    tmp_dir = mkdtemp()
+    try:
+        rand = Random(args.seed)
+        sentence_offsets = []
+        offset = 0
+        for _ in xrange(args.sentences):
+            length = rand.randint(20, 200)
+            sentence_offsets.append((offset, offset + length))
+            offset += length + 1
+        ann_lines = []
+        for i in xrange(1, args.entities + 1):
+            if i % 1000:
+                length = rand.randint(1, 20)
+            else:
+                # The occasional long span, e.g. a section or speaker turn
+                length = rand.randint(200, 2000)
+            start = rand.randrange(offset - length)
+            ann_lines.append(u'T%d\tEntity %d %d\tE' % (i, start,
+                    start + length))
+        doc_path = path_join(tmp_dir, 'doc')
+        with open_textfile(doc_path + '.ann', 'w') as ann_file:
+            ann_file.write(u''.join(l + u'\n' for l in ann_lines))
+        ann_obj = AnnotationsView(doc_path)
+        # Both build on the span index, built once up front
+        ann_obj.overlapping(0, 0)
+
+        def best_time(merge):
+            seconds = []
+            for _ in xrange(args.repeat):
+                collect()
+                start = time()
+                merged = merge(sentence_offsets, ann_obj)
+                seconds.append(time() - start)
+            return min(seconds), merged
+
+        seconds, merged = best_time(_merge_crossed_sentences)
+        _report('merge (sweep)', seconds, len(sentence_offsets), 'sentences')
+
+        if args.check:
+            seconds, expected = best_time(_merge_sentences_by_scan)
+            _report('merge (scan)', seconds, len(sentence_offsets),
+                    'sentences')
+            assert merged == expected, 'sentences merged differently'
+            print 'merged sentences: OK (%d of %d left)' % (len(merged),
+                    len(sentence_offsets))
+    finally:
+        rmtree(tmp_dir)
+
+
+def _find_documents(paths):
+    for path in paths:
+        for dir_path, _, file_names in walk(path):
+            for file_name in sorted(file_names):
+                if file_name.endswith('.ann'):
+                    yield path_join(dir_path, file_name[:-4])
+
+
+def _resident_memory():
+    '''
+    Return the current resident set size of the process in kilobytes, or
+    the peak size if the current one is not available (non-Linux).
+    '''
+
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    from resource import getrusage, RUSAGE_SELF
+    return getrusage(RUSAGE_SELF).ru_maxrss
+
+
+def bench_memory(args):
+    '''
+    Load a synthetic collection into memory all at once, as e.g. a search
+    over a collection does, and report the memory used per annotation.
+    '''
+
+    tmp_dir = mkdtemp()
+    try:
+        per_document = max(1, args.annotations // args.documents)
+        docs = [_write_document(tmp_dir, per_document, 'doc%d' % i)[0]
+                for i in xrange(args.documents)]
+
+        collect()
+        before = _resident_memory()
+        start = time()
+        loaded = [TextAnnotations(doc, read_only=True) for doc in docs]
+        seconds = time() - start
+        collect()
+        used = _resident_memory() - before
+
+        ann_count = sum(len(ann_obj) for ann_obj in loaded)
+        _report('load', seconds, ann_count, 'annotations')
+        print 'memory: %.1f MB (%.0f bytes/annotation)' % (used / 1024.0,
+                used * 1024.0 / max(ann_count, 1), )
+    finally:
+        rmtree(tmp_dir)
+
+
+def bench_scan(args):
+    '''
+    Count the text-bounds of a synthetic collection, once through
+    Annotations objects and once through iter_annotations().
+    '''
+
+    tmp_dir = mkdtemp()
+    try:
+        per_document = max(1, args.annotations // args.documents)
+        docs = [_write_document(tmp_dir, per_document, 'doc%d' % i)[0]
+                for i in xrange(args.documents)]
+        ann_count = per_document * len(docs)
+
+        start = time()
+        counts = []
+        for doc in docs:
+            counts.append(len(list(Annotations(doc,
+                    read_only=True).get_textbounds())))
+        _report('scan (Annotations)', time() - start, ann_count,
+                'annotations')
+
+        start = time()
+        stream_counts = []
+        for doc in docs:
+            stream_counts.append(sum(1 for _ in iter_annotations(doc,
+                    categories=('T', ))))
+        _report('scan (iter_annotations)', time() - start, ann_count,
+                'annotations')
+
+        assert counts == stream_counts, 'text-bound counts differ'
+    finally:
+        rmtree(tmp_dir)
+
+
+def bench_parse(args):
+    '''
+    Parse the annotation files of the given directories and check that
+    they serialize back to the same lines.
+    '''
+
+    docs = list(_find_documents(args.paths or
+            [path_join(dirname(__file__), '../example-data/corpora')]))
+    line_count = 0
+    for doc in docs:
+        with open_textfile(doc + '.ann') as ann_file:
+            line_count += sum(1 for _ in ann_file)
+
+    parsers = (
+            ('Annotations', lambda doc: Annotations(doc, read_only=True)),
+            ('TextAnnotations',
+                lambda doc: TextAnnotations(doc, read_only=True)),
+            ('AnnotationsView', AnnotationsView),
+            ('TextAnnotationsView', TextAnnotationsView),
+            )
+    for name, parse in parsers:
+        start = time()
+        for _ in xrange(args.repeat):
+            for doc in docs:
+                parse(doc)
+        _report('parse (%s)' % name, time() - start,
+                line_count * args.repeat, 'lines')
+
+    if args.check:
+        mismatches = 0
+        for doc in docs:
+            with open_textfile(doc + '.ann') as ann_file:
+                expected = ann_file.read()
+            if expected and not expected.endswith('\n'):
+                expected += '\n'
+            out_strs = (unicode(TextAnnotations(doc, read_only=True)),
+                    unicode(TextAnnotationsView(doc)))
+            if any(out_str != expected for out_str in out_strs):
+                mismatches += 1
+                print 'round-trip differs: %s.ann' % (doc, )
+        print 'round-trip: %d/%d documents identical' % (
+                len(docs) - mismatches, len(docs))
+
+
+BENCHMARKS = {
+        'batch': bench_batch,
+        'delete': bench_delete,
+        'equiv': bench_equiv,
+        'memory': bench_memory,
+        'parse': bench_parse,
+        'scan': bench_scan,
+        'sentences': bench_sentences,
+        }
+
+
+def argparser():
+    ap = argparse.ArgumentParser(description='Run brat annotation '
+            'handling micro-benchmarks on synthetic documents.')
+    ap.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()),
+            help='Benchmark to run')
+    ap.add_argument('-l', '--lines', type=int, default=50000,
+            help='Number of annotation lines in the document (default: '
+            '%(default)s)')
+    ap.add_argument('-e', '--entities', type=int, default=10000,
+            help='Number of entities to add (default: %(default)s)')
+    ap.add_argument('-t', '--sentences', type=int, default=10000,
+            help='Number of sentences in the document (default: '
+            '%(default)s)')
+    ap.add_argument('-d', '--deletes', type=int, default=10000,
+            help='Number of annotations to delete (default: %(default)s)')
+    ap.add_argument('-a', '--annotations', type=int, default=100000,
+            help='Number of annotations in the collection (default: '
+            '%(default)s)')
+    ap.add_argument('-n', '--documents', type=int, default=20,
+            help='Number of documents in the collection (default: '
+            '%(default)s)')
+    ap.add_argument('-s', '--seed', type=int, default=0,
+            help='Random seed (default: %(default)s)')
+    ap.add_argument('-r', '--repeat', type=int, default=5,
+            help='Number of times to parse each document (default: '
+            '%(default)s)')
+    ap.add_argument('-c', '--check', default=False, action='store_true',
+            help='Verify the results (slow, not included in timings)')
+    ap.add_argument('paths', metavar='DIR', nargs='*',
+            help='Directories with annotation files to parse (default: '
+            'example-data/corpora)')
+    return ap
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    args = argparser().parse_args(argv[1:])
+    BENCHMARKS[args.benchmark](args)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
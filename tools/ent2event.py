@@ -16,11 +16,14 @@ from __future__ import with_statement
 
 import sys
 import re
+import os.path
+from sys import path as sys_path
+
+TEST_ARG = '--test'
+
 try:
     import annotation
 except ImportError:
-    import os.path
-    from sys import path as sys_path
     # Guessing that we might be in the brat tools/ directory ...
     sys_path.append(os.path.join(os.path.dirname(__file__), '../server/src'))
     import annotation
@@ -63,10 +66,14 @@ def ent2event(anntype, fn):
                             # need to remap
                             argid = new_id
                             e.args[i] = role, argid
+                            # in-place changes are only written (and
+                            # indexed) once reported
+                            ann_obj.update_annotation(e)
                 for c in ann_obj.get_oneline_comments():
                     if c.target == ann.id:
                         # need to remap
                         c.target = new_id
+                        ann_obj.update_annotation(c)
 
                 # finally, add in the new event annotation
                 ann_obj.add_annotation(eann)
@@ -85,16 +92,52 @@ def argparser():
     import argparse
 
     ap=argparse.ArgumentParser(description="Rewrite entity annotations of a given type as events.")
+    ap.add_argument(TEST_ARG, default=False, action="store_true",
+                    help="Perform self-test and exit.")
     ap.add_argument("-v", "--verbose", default=False, action="store_true", help="Verbose output.")
     ap.add_argument("type", metavar="TYPE", help="Type to rewrite.")
     ap.add_argument("files", metavar="FILE", nargs="+", help="File to process.")
     return ap
 
+def test():
+    import shutil
+    import tempfile
+
+    global options
+
+    options = argparser().parse_args(['ent2event.py', 'Term', 'dummy'])
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        base = os.path.join(tmp_dir, 'test')
+        with open(base + '.txt', 'w') as txt_file:
+            txt_file.write('Angiogenesis of x.\n')
+        with open(base + '.ann', 'w') as ann_file:
+            ann_file.write('T1\tTerm 0 12\tAngiogenesis\n'
+                           'T2\tProtein 16 17\tx\n'
+                           'T3\tPositive_regulation 0 12\tAngiogenesis\n'
+                           'E1\tPositive_regulation:T3 Theme:T1 Cause:T2\n'
+                           '#1\tAnnotatorNotes T1\tnote\n')
+
+        ent2event('Term', base + '.ann')
+
+        with open(base + '.ann') as ann_file:
+            lines = set(l.rstrip('\n') for l in ann_file)
+        assert 'E2\tTerm:T1 ' in lines, lines
+        assert 'E1\tPositive_regulation:T3 Theme:E2 Cause:T2' in lines, lines
+        assert '#1\tAnnotatorNotes E2\tnote' in lines, lines
+    finally:
+        shutil.rmtree(tmp_dir)
+
 def main(argv=None):
     global options
 
     if argv is None:
         argv = sys.argv
+
+    if TEST_ARG in argv:
+        test()
+        return 0
     arg = argparser().parse_args(argv[1:])
 
     options = arg
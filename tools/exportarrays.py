@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+'''
+Export the annotations of brat collections into columnar NumPy arrays
+(see server/src/annarrays.py) and summarise an export. Requires NumPy.
+
+Usage example:
+
+    python tools/exportarrays.py export -r -o corpus.npz data/corpus
+    python tools/exportarrays.py summary corpus.npz
+'''
+
+from __future__ import with_statement
+
+import sys
+
+from os.path import dirname, isdir, join as path_join
+from time import time
+
+try:
+    import argparse
+except ImportError:
+    from sys import path as sys_path
+    # We are most likely on an old Python and need to use our internal version
+    sys_path.append(path_join(dirname(__file__), '../server/lib'))
+    import argparse
+
+try:
+    import annarrays
+except ImportError:
+    from sys import path as sys_path
+    # Guessing that we might be in the brat tools/ directory ...
+    sys_path.append(path_join(dirname(__file__), '../server/src'))
+    import annarrays
+
+from annarrays import CATEGORY_NAMES, export_collections, load_arrays
+
+
+def argparser():
+    ap = argparse.ArgumentParser(description='Export the annotations of '
+            'brat collections into columnar NumPy arrays, or summarise an '
+            'export.')
+    subparsers = ap.add_subparsers(dest='action')
+
+    export = subparsers.add_parser('export', help='Export collections')
+    export.add_argument('-o', '--output', required=True, metavar='NPZ',
+            help='Output .npz file')
+    export.add_argument('-r', '--recursive', default=False,
+            action='store_true', help='Include the collections in '
+            'subdirectories')
+    export.add_argument('-c', '--compressed', default=False,
+            action='store_true', help='Compress the output')
+    export.add_argument('directories', metavar='DIR', nargs='+',
+            help='Collection directory')
+
+    summary = subparsers.add_parser('summary', help='Summarise an export')
+    summary.add_argument('path', metavar='NPZ', help='Exported .npz file')
+    return ap
+
+
+def _print_counts(title, counts):
+    print title
+    for key, count in sorted(counts.items(), key=lambda i: -i[1]):
+        if isinstance(key, tuple):
+            key = ' '.join(k if k is not None else '-' for k in key)
+        print (u'    %-60s %d' % (key, count)).encode('utf-8')
+
+
+def summarise(path):
+    start = time()
+    arrays = load_arrays(path)
+    print '%d documents, %d annotations, %d references (loaded in %.3fs)' % (
+            len(arrays.documents), len(arrays), len(arrays.arg_ann),
+            time() - start)
+
+    start = time()
+    for category, name in enumerate(CATEGORY_NAMES):
+        counts = arrays.count_by_type(category)
+        if counts:
+            _print_counts('%s types:' % name, counts)
+    print 'text-bound span lengths (count, mean, median, max):'
+    for type, stats in sorted(arrays.span_length_summary().items()):
+        print (u'    %-60s %d %.1f %.1f %d' % ((type, ) + stats)
+                ).encode('utf-8')
+    print 'text-bound nesting depths:'
+    for depth, count in enumerate(arrays.depth_counts()):
+        print '    %-60d %d' % (depth, count)
+    _print_counts('attribute values:', arrays.attribute_value_counts())
+    _print_counts('relation argument types:', arrays.relation_type_pairs())
+    _print_counts('event argument types:', arrays.argument_type_counts())
+    print 'queries took %.3fs' % (time() - start, )
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    args = argparser().parse_args(argv[1:])
+
+    try:
+        if args.action == 'export':
+            for directory in args.directories:
+                if not isdir(directory):
+                    print >> sys.stderr, 'Not a directory: %s' % (directory, )
+                    return 1
+            start = time()
+            count = export_collections(args.directories, args.output,
+                    recursive=args.recursive, compressed=args.compressed)
+            print 'Exported %d documents into %s in %.3fs' % (count,
+                    args.output, time() - start)
+        else:
+            summarise(args.path)
+    except ImportError, e:
+        print >> sys.stderr, e
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
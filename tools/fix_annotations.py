@@ -52,12 +52,15 @@ def correct_annotations(orig_fn, ann_fn, change_fn):
         for orig_offset, delta in offsets:
             for index in indices:
                 if index[0] < orig_offset: break
-                frag = list(tbs[index[1]].spans[index[2]])
+                spans = list(tbs[index[1]].spans)
+                frag = list(spans[index[2]])
                 frag[index[3]] += delta
-                tbs[index[1]].spans[index[2]] = tuple(frag)
+                spans[index[2]] = tuple(frag)
+                tbs[index[1]].spans = spans
         for tb in tbs:
             if isinstance(tb, annotation.TextBoundAnnotationWithText):
                 tb.text = annotation.DISCONT_SEP.join((changed_text[start:end] for start, end in tb.spans))
+            anns.update_annotation(tb)
     copy(change_fn, orig_fn)
 # }}}
 
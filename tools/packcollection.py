@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+'''
+Pack the documents of brat collections into a single file per collection
+for fast read access, or unpack them again (see server/src/docpack.py).
+
+Usage example:
+
+    python tools/packcollection.py pack --remove data/large-collection
+    python tools/packcollection.py unpack --remove data/large-collection
+'''
+
+from __future__ import with_statement
+
+import sys
+
+from os.path import dirname, isdir, join as path_join
+
+try:
+    import argparse
+except ImportError:
+    from sys import path as sys_path
+    # We are most likely on an old Python and need to use our internal version
+    sys_path.append(path_join(dirname(__file__), '../server/lib'))
+    import argparse
+
+try:
+    import docpack
+except ImportError:
+    from sys import path as sys_path
+    # Guessing that we might be in the brat tools/ directory ...
+    sys_path.append(path_join(dirname(__file__), '../server/src'))
+    import docpack
+
+from docpack import PACK_FILE_NAME, build_pack, unpack_collection
+
+
+def argparser():
+    ap = argparse.ArgumentParser(description='Pack the documents of brat '
+            'collections into a single %s file per collection, or unpack '
+            'them again.' % (PACK_FILE_NAME, ))
+    ap.add_argument('action', choices=('pack', 'unpack'),
+            help='Pack the documents or unpack them')
+    ap.add_argument('-r', '--remove', default=False, action='store_true',
+            help='Remove the packed documents (pack) or the pack (unpack) '
+            'afterwards. The packed documents are only read from the pack '
+            'once their own files are gone.')
+    ap.add_argument('directories', metavar='DIR', nargs='+',
+            help='Collection directory')
+    return ap
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    args = argparser().parse_args(argv[1:])
+
+    for directory in args.directories:
+        if not isdir(directory):
+            print >> sys.stderr, 'Not a directory: %s' % (directory, )
+            return 1
+        if args.action == 'pack':
+            count = build_pack(directory, remove_loose=args.remove)
+            print 'Packed %d documents into %s' % (count,
+                    path_join(directory, PACK_FILE_NAME))
+        else:
+            count = unpack_collection(directory, remove_pack=args.remove)
+            print 'Unpacked %d documents in %s' % (count, directory)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))